@@ -0,0 +1,100 @@
+"""
+Messages/sec of ChatDB.store_message with a connection per session (the previous behaviour, rollback journal),
+with the pooled WAL connections, and through the batched MessageWriter (measured until everything is flushed).
+
+Run from the repo root:  python -m benchmarks.bench_chat_db --messages 5000 --threads 4
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from server.db.chat_db import ChatDB, ChatDBConfig
+from server.db.message_writer import MessageWriter, PendingMessage
+from utils import epoch_ms_now
+
+
+class UnpooledChatDB(ChatDB):
+    @contextmanager
+    def session(self):
+        connection = sqlite3.connect(self.db_path)
+        try:
+            yield connection
+        finally:
+            connection.commit()
+            connection.close()
+
+
+def _seed(chat_db: ChatDB, *, senders: int) -> None:
+    with chat_db.session() as db_conn:
+        chat_db.setup_database(db_conn=db_conn)
+        chat_db.create_room(db_conn=db_conn, room_name="GLOBAL")
+        for sender_index in range(senders):
+            chat_db.store_user(db_conn=db_conn, sender_name=f"user-{sender_index}")
+
+
+def _store_messages(chat_db: ChatDB, *, sender_name: str, messages: int) -> None:
+    timestamp = epoch_ms_now()
+    for msg_index in range(messages):
+        with chat_db.session() as db_conn:
+            chat_db.store_message(db_conn=db_conn, text_message=f"message {msg_index}", sender_name=sender_name, room_name="GLOBAL", timestamp=timestamp)
+
+
+def _enqueue_messages(message_writer: MessageWriter, *, sender_name: str, messages: int) -> None:
+    timestamp = epoch_ms_now()
+    for msg_index in range(messages):
+        message_writer.put(PendingMessage(text_message=f"message {msg_index}", sender_name=sender_name, room_name="GLOBAL", timestamp=timestamp))
+
+
+def run(chat_db: ChatDB, *, messages: int, threads: int, write_behind: bool = False) -> float:
+    _seed(chat_db, senders=threads)
+
+    if write_behind:
+        target, sink = _enqueue_messages, MessageWriter(chat_db=chat_db)
+    else:
+        target, sink = _store_messages, chat_db
+
+    workers = [
+        threading.Thread(target=target, args=(sink,), kwargs={"sender_name": f"user-{index}", "messages": messages // threads})
+        for index in range(threads)
+    ]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if write_behind:
+        sink.close()
+    elapsed = time.perf_counter() - start
+
+    return (messages // threads * threads) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5_000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, chat_db_cls, write_behind in (
+                ("connection per session", UnpooledChatDB, False),
+                ("pooled WAL", ChatDB, False),
+                ("pooled WAL + writer", ChatDB, True)
+        ):
+            ChatDBConfig.db_path = os.path.join(tmp_dir, name.replace(' ', '_'), 'chat.db')
+            os.makedirs(os.path.dirname(ChatDBConfig.db_path))
+
+            chat_db = chat_db_cls()
+            messages_per_sec = run(chat_db, messages=args.messages, threads=args.threads, write_behind=write_behind)
+            chat_db.close()
+
+            print(f"{name:<24} {messages_per_sec:>10,.0f} messages/sec")
+
+
+if __name__ == '__main__':
+    main()
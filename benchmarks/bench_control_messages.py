@@ -0,0 +1,76 @@
+"""
+Cost of the JSON control messages (room setup, upload and download requests) decoded by the ControlMessage
+structs versus the equivalent pydantic models (ProtocolConfig.strict_validation): import time of the definitions
+each process loads at startup, measured in fresh interpreters, and requests decoded per second from a frame payload.
+pydantic is optional, the pydantic rows are skipped when it isn't installed.
+
+Run from the repo root:  python -m benchmarks.bench_control_messages --requests 200000
+"""
+import argparse
+import importlib.util
+import json
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+from config import ProtocolConfig
+from definitions import ControlMessage, SetupRoomData, UploadFileData, DownloadFileData
+
+PAYLOADS: typing.Tuple[typing.Tuple[typing.Type[ControlMessage], bytes], ...] = (
+    (SetupRoomData, json.dumps({"room_type": "private", "group_name": "friends"}).encode()),
+    (UploadFileData, json.dumps({"filename": "photo.png", "file_size": 1_048_576, "checksum": "ab" * 32, "file_id": None, "parts": 1}).encode()),
+    (DownloadFileData, json.dumps({"file_id": "0b6d0a5e-8f4e-4f0c-9d0c-3f1f0e2c7a11", "offset": 0}).encode()),
+)
+
+HAS_PYDANTIC = importlib.util.find_spec("pydantic") is not None
+
+STARTUP_STATEMENTS = {
+    "structs": "import definitions",
+    "pydantic models": "import definitions; definitions.SetupRoomData.strict_model()",
+}
+
+
+def startup_seconds(statement: str, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def decode_rate(message_class: typing.Type[ControlMessage], payload: bytes, requests: int) -> float:
+    from_json = message_class.from_json
+    start = time.perf_counter()
+    for _ in range(requests):
+        from_json(json.loads(payload))
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--startup-runs", type=int, default=10)
+    args = parser.parse_args()
+
+    if not HAS_PYDANTIC:
+        print("pydantic is not installed, skipping the pydantic models rows")
+
+    baseline = startup_seconds("pass", args.startup_runs)
+    for name, statement in STARTUP_STATEMENTS.items():
+        if name == "pydantic models" and not HAS_PYDANTIC:
+            continue
+        print(f"startup, {name:<16} {(startup_seconds(statement, args.startup_runs) - baseline) * 1000:>8.1f} ms over a bare interpreter")
+
+    for strict_validation in (False, True) if HAS_PYDANTIC else (False,):
+        ProtocolConfig.strict_validation = strict_validation
+        name = "pydantic models" if strict_validation else "structs"
+        for message_class, payload in PAYLOADS:
+            message_class.from_json(json.loads(payload))  # Builds the pydantic model outside the timing
+            print(f"decode, {name:<16} {message_class.__name__:<18} {decode_rate(message_class, payload, args.requests):>10,.0f} requests/sec")
+
+
+if __name__ == '__main__':
+    main()
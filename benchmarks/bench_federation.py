@@ -0,0 +1,109 @@
+"""
+End to end fan out latency of three federated ChatServer nodes sharing a room through the message bus, with the
+in-process hub and with the Unix socket broker. Every node gets --clients-per-node clients in the room, a client
+of node 0 sends --messages messages (one every --interval-ms) and each receiver measures send to receive time.
+Node 0 shows local delivery, nodes 1 and 2 delivery through the bus. All nodes, the broker and the clients share
+this process.
+
+Run from the repo root:  python -m benchmarks.bench_federation --messages 2000
+"""
+import argparse
+import os
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import typing
+
+from server.db.chat_db import ChatDBConfig
+from server.message_bus import InProcessBusHub, MessageBus, UnixSocketBusBroker, UnixSocketMessageBus
+from server.server_chat import ChatServer
+from utils import FrameReader, encode_text_frame, encode_json_frame
+
+NODES = 3
+ROOM_SETUP = {"room_type": "PRIVATE", "group_name": "federated"}
+MARKER = "sent-at-ns "
+
+
+def start_nodes(buses: typing.List[MessageBus]) -> typing.List[int]:
+    ports = []
+    for bus in buses:
+        port = random.randint(20_000, 60_000)
+        chat_server = ChatServer(host='127.0.0.1', listen_port=port, message_bus=bus)
+        threading.Thread(target=chat_server.start, daemon=True).start()
+        ports.append(port)
+    return ports
+
+
+def join_room(port: int, username: str) -> FrameReader:
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(encode_text_frame(username) + encode_json_frame(ROOM_SETUP))
+    frame_reader = FrameReader(sock)
+    while f"{username} joined" not in frame_reader.read_frame().text():
+        pass
+    return frame_reader
+
+
+def receive_latencies(frame_reader: FrameReader, messages: int, latencies: typing.List[float]) -> None:
+    received = 0
+    while received < messages:
+        text = frame_reader.read_frame().text()
+        if MARKER in text:
+            latencies.append((time.perf_counter_ns() - int(text.rsplit(MARKER, 1)[1])) / 1e6)
+            received += 1
+
+
+def run(ports: typing.List[int], args: argparse.Namespace) -> typing.List[typing.List[float]]:
+    latencies: typing.List[typing.List[float]] = [[] for _ in ports]
+    receivers = []
+    for node_index, port in enumerate(ports):
+        for client_index in range(args.clients_per_node):
+            frame_reader = join_room(port, f"receiver-{node_index}-{client_index}-{random.randrange(10**6)}")
+            receiver = threading.Thread(target=receive_latencies, args=(frame_reader, args.messages, latencies[node_index]))
+            receiver.start()
+            receivers.append(receiver)
+
+    sender = join_room(ports[0], f"sender-{random.randrange(10**6)}").sock
+    for _ in range(args.messages):
+        sender.sendall(encode_text_frame(f"{MARKER}{time.perf_counter_ns()}"))
+        time.sleep(args.interval_ms / 1000)
+
+    for receiver in receivers:
+        receiver.join()
+    sender.close()
+    return latencies
+
+
+def report(name: str, latencies: typing.List[typing.List[float]]) -> None:
+    for node_index, node_latencies in enumerate(latencies):
+        percentiles = statistics.quantiles(node_latencies, n=100, method='inclusive')  # Exclusive extrapolates past max on small runs
+        print(
+            f"{name:<12} node {node_index}  p50 {percentiles[49]:>7.2f} ms  p99 {percentiles[98]:>7.2f} ms  "
+            f"max {max(node_latencies):>7.2f} ms  ({len(node_latencies)} deliveries)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2_000)
+    parser.add_argument("--clients-per-node", type=int, default=4)
+    parser.add_argument("--interval-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+
+        hub = InProcessBusHub()
+        report("in-process", run(start_nodes([hub.bus() for _ in range(NODES)]), args))
+
+        broker_socket_path = os.path.join(tmp_dir, 'bus.sock')
+        threading.Thread(target=UnixSocketBusBroker(broker_socket_path).start, daemon=True).start()
+        report("unix socket", run(start_nodes([UnixSocketMessageBus(broker_socket_path) for _ in range(NODES)]), args))
+
+    os._exit(0)  # Server threads never return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Upload throughput of FileTransferServer over loopback, on one connection and split in parts over --streams
+connections, and what a retry costs after the connection drops halfway through: resumed from the server's
+offset versus started over under a new file id.
+Max RSS is the whole process (server and client threads).
+
+Run from the repo root:  python -m benchmarks.bench_file_upload --sizes-mb 1 16 1024 --streams 4
+"""
+import argparse
+import os
+import random
+import resource
+import socket
+import tempfile
+import threading
+import time
+import typing
+
+from client.client import FileClient
+from config import ClientConfig, FileServerConfig
+from definitions import FileHandlerTypes, FileTransferStatus, FrameTypes, UploadFileOffer
+from server.db.chat_db import ChatDBConfig
+from server.server_file_transfer import FileTransferServer
+from utils import encode_text_frame, encode_json_frame, file_checksum, send_chunk, send_frames
+
+
+class InterruptedFileClient(FileClient):
+    """ Closes the connection after stop_after body bytes, like a client losing its network mid upload """
+    def __init__(self, host: str, port: int, *, stop_after: int):
+        super().__init__(host, port)
+        self.stop_after = stop_after
+
+    def start_upload(self, *, file_path: str, upload_data: typing.Dict[str, typing.Any]) -> str:
+        send_frames(self.file_socket, [encode_text_frame(FileHandlerTypes.UPLOAD.value), encode_json_frame(upload_data)])
+
+        response = self._frame_reader.read_frame()
+        if response.type != FrameTypes.JSON:
+            raise RuntimeError(f"Upload failed with {response.text()}")
+
+        upload_offer = UploadFileOffer.from_json(response.json())
+        buffer = memoryview(bytearray(ClientConfig.upload_chunk_size))
+        sent_bytes = 0
+        with open(file_path, 'rb') as file:
+            while sent_bytes < self.stop_after and (chunk_size := file.readinto(buffer)):
+                send_chunk(self.file_socket, buffer[:chunk_size])
+                sent_bytes += chunk_size
+
+        # Waits until the server has seen the disconnect and released the upload
+        self.file_socket.shutdown(socket.SHUT_WR)
+        while self.file_socket.recv(65_536):
+            pass
+        self.file_socket.close()
+        return upload_offer.file_id
+
+
+def start_server() -> int:
+    port = random.randint(20_000, 60_000)
+    file_server = FileTransferServer(host='127.0.0.1', listen_port=port)
+    threading.Thread(target=file_server.start, daemon=True).start()
+    return port
+
+
+def upload(port: int, file_path: str, upload_data: typing.Dict[str, typing.Any]) -> float:
+    file_client = FileClient(host='127.0.0.1', port=port)
+    start = time.perf_counter()
+    if upload_data["parts"] > 1:
+        response = file_client._upload_in_parts(file_path=file_path, upload_data=upload_data)
+    else:
+        response = file_client._upload_from_offset(file_path=file_path, upload_data=upload_data)
+    elapsed = time.perf_counter() - start
+    file_client.file_socket.close()
+
+    if response in (FileTransferStatus.EXCEEDED.value, FileTransferStatus.FAILED.value):
+        raise RuntimeError(f"Upload failed with {response}")
+    return elapsed
+
+
+def interrupted_upload(port: int, file_path: str, upload_data: typing.Dict[str, typing.Any]) -> str:
+    file_client = InterruptedFileClient(host='127.0.0.1', port=port, stop_after=upload_data["file_size"] // 2)
+    return file_client.start_upload(file_path=file_path, upload_data=upload_data)
+
+
+def report(name: str, size_mb: int, elapsed: float) -> None:
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:<18} {size_mb:>6} MB  {elapsed:>8.2f}s  {size_mb / elapsed:>9.1f} MB/s  max rss {max_rss_mb:>7.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb", type=int, nargs='+', default=[1, 16])
+    parser.add_argument("--streams", type=int, default=ClientConfig.upload_streams)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ChatDBConfig.db_path = os.path.join(tmp_dir, 'db', 'chat.db')
+        FileServerConfig.upload_dir = os.path.join(tmp_dir, 'uploads')
+        FileServerConfig.max_file_size = max(args.sizes_mb) * 2**20
+
+        port = start_server()
+        time.sleep(0.2)
+
+        for size_mb in args.sizes_mb:
+            file_path = os.path.join(tmp_dir, f"{size_mb}mb.bin")
+            with open(file_path, 'wb') as file:
+                for _ in range(size_mb):
+                    file.write(os.urandom(2**20))
+
+            upload_data = {
+                "filename": os.path.basename(file_path),
+                "file_size": os.path.getsize(file_path),
+                "checksum": file_checksum(file_path),
+                "file_id": None,
+                "parts": 1
+            }
+            report("full upload", size_mb, upload(port, file_path, upload_data))
+            report(f"{args.streams} streams", size_mb, upload(port, file_path, {**upload_data, "parts": args.streams}))
+
+            interrupted_upload(port, file_path, upload_data)
+            report("retry, from zero", size_mb, upload(port, file_path, upload_data))
+
+            file_id = interrupted_upload(port, file_path, upload_data)
+            report("retry, resumed", size_mb, upload(port, file_path, {**upload_data, "file_id": file_id}))
+
+            # Every upload of a size is the same content, so the blob store keeps a single copy of it
+            os.remove(file_path)
+
+    os._exit(0)  # Server threads never return
+
+
+if __name__ == '__main__':
+    main()
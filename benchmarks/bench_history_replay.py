@@ -0,0 +1,106 @@
+"""
+Replay time and peak memory of a room history with a sender lookup per message and fetchall (the previous
+behaviour) versus the single JOIN streamed with fetchmany, with and without the (room_id, timestamp) index.
+Seeds a database of --messages rows spread over --rooms rooms, the replayed room holds messages / rooms rows.
+
+Run from the repo root:  python -m benchmarks.bench_history_replay --messages 1000000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from definitions import MessageInfo, MessageTypes
+from server.db.chat_db import ChatDB, ChatDBConfig
+
+
+def n_plus_one_history(*, db_conn: sqlite3.Connection, room_name: str) -> typing.Generator[str, None, None]:
+    cursor = db_conn.cursor()
+    room_id = cursor.execute('SELECT id FROM rooms WHERE room_name = ?', (room_name,)).fetchone()[0]
+    cursor.execute('SELECT text_message, sender_id, timestamp FROM messages WHERE room_id = ? ORDER BY timestamp ASC', (room_id,))
+
+    for text_message, sender_id, timestamp in cursor.fetchall():
+        cursor.execute('SELECT username FROM users where id = ?', (sender_id,))
+        msg = MessageInfo(type=MessageTypes.CHAT, text_message=text_message, sender_name=cursor.fetchone()[0], msg_timestamp=timestamp)
+        yield msg.formatted_msg()
+
+
+def joined_history(*, db_conn: sqlite3.Connection, room_name: str) -> typing.Generator[str, None, None]:
+    # The full room replay ChatDB did on join before paginated history, sender names joined and rows streamed in batches
+    cursor = db_conn.cursor()
+    cursor.execute('''
+         SELECT messages.text_message, users.username, messages.timestamp FROM messages
+          JOIN rooms ON rooms.id = messages.room_id
+          JOIN users ON users.id = messages.sender_id
+          WHERE rooms.room_name = ?
+          ORDER BY messages.timestamp ASC, messages.id ASC
+          ''', (room_name,))
+
+    while old_messages := cursor.fetchmany(ChatDBConfig.history_fetch_size):
+        for text_message, sender_name, timestamp in old_messages:
+            msg = MessageInfo(type=MessageTypes.CHAT, text_message=text_message, sender_name=sender_name, msg_timestamp=timestamp)
+            yield msg.formatted_msg()
+
+
+def seed(chat_db: ChatDB, *, messages: int, rooms: int, users: int) -> None:
+    with chat_db.session() as db_conn:
+        chat_db.setup_database(db_conn=db_conn)
+        db_conn.executemany('INSERT INTO users (username) VALUES (?)', ((f"user-{index}",) for index in range(users)))
+        db_conn.executemany('INSERT INTO rooms (room_name) VALUES (?)', ((f"room-{index}",) for index in range(rooms)))
+        db_conn.executemany(
+            'INSERT INTO messages (text_message, sender_id, room_id, timestamp) VALUES (?,?,?,?)',
+            (
+                (f"message number {index} with some text", index % users + 1, index % rooms + 1, 1_735_689_600_000 + index * 10)
+                for index in range(messages)
+            )
+        )
+
+
+def measure(replay: typing.Callable[..., typing.Iterator[str]], chat_db: ChatDB, *, room_name: str) -> typing.Tuple[int, float, int]:
+    # Timed and traced in separate passes, tracemalloc slows every allocation down
+    with chat_db.session() as db_conn:
+        start = time.perf_counter()
+        replayed = sum(1 for _ in replay(db_conn=db_conn, room_name=room_name))
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        for _ in replay(db_conn=db_conn, room_name=room_name):
+            pass
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return replayed, elapsed, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--users", type=int, default=1_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+        chat_db = ChatDB()
+
+        start = time.perf_counter()
+        seed(chat_db, messages=args.messages, rooms=args.rooms, users=args.users)
+        print(f"seeded {args.messages:,} messages in {time.perf_counter() - start:.1f}s")
+
+        for name, replay in (("lookup per message", n_plus_one_history), ("join + fetchmany", joined_history)):
+            replayed, elapsed, peak_memory = measure(replay, chat_db, room_name="room-0")
+            print(f"{name:<28} {replayed:>9,} messages  {elapsed:>7.2f}s  {replayed / elapsed:>10,.0f} messages/sec  peak {peak_memory / 2**20:>7.1f} MiB")
+
+        with chat_db.session() as db_conn:
+            db_conn.execute('DROP INDEX idx_messages_room_timestamp')
+
+        replayed, elapsed, peak_memory = measure(joined_history, chat_db, room_name="room-0")
+        print(f"{'join + fetchmany, no index':<28} {replayed:>9,} messages  {elapsed:>7.2f}s  {replayed / elapsed:>10,.0f} messages/sec  peak {peak_memory / 2**20:>7.1f} MiB")
+
+        chat_db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Send syscalls and throughput for replaying the history of a 10k-message room to a joining client,
+one sendall per frame (the previous behaviour) versus gathered send_frames writes.
+The page is fetched once, only the socket writes are measured, a thread drains the receiving end.
+
+Run from the repo root:  python -m benchmarks.bench_history_send --messages 10000
+"""
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+import typing
+
+from benchmarks.bench_history_replay import seed
+from server.db.chat_db import ChatDB, ChatDBConfig
+from utils import encode_text_frame, send_frames
+
+
+class CountingSocket(socket.socket):
+    send_calls = 0
+
+    def sendall(self, *args, **kwargs):
+        self.send_calls += 1
+        return super().sendall(*args, **kwargs)
+
+    def sendmsg(self, *args, **kwargs):
+        self.send_calls += 1
+        return super().sendmsg(*args, **kwargs)
+
+
+def _drain(sock: socket.socket, expected_bytes: int) -> None:
+    buffer = bytearray(1 << 20)
+    received = 0
+    while received < expected_bytes:
+        received += sock.recv_into(buffer)
+
+
+def measure(send: typing.Callable[[socket.socket, typing.List[str]], None], messages: typing.List[str], *, rounds: int) -> typing.Tuple[int, float]:
+    expected_bytes = sum(len(encode_text_frame(msg)) for msg in messages) * rounds
+    sender, receiver = socket.socketpair()
+    sender = CountingSocket(fileno=sender.detach())
+
+    drainer = threading.Thread(target=_drain, args=(receiver, expected_bytes))
+    drainer.start()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        send(sender, messages)
+    drainer.join()
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    receiver.close()
+    return sender.send_calls // rounds, expected_bytes / elapsed
+
+
+def send_per_frame(sock: socket.socket, messages: typing.List[str]) -> None:
+    for msg in messages:
+        sock.sendall(encode_text_frame(msg))
+
+
+def send_gathered(sock: socket.socket, messages: typing.List[str]) -> None:
+    send_frames(sock, [encode_text_frame(msg) for msg in messages])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+        chat_db = ChatDB()
+        seed(chat_db, messages=args.messages, rooms=1, users=100)
+
+        with chat_db.session() as db_conn:
+            messages = chat_db.get_history_page(db_conn=db_conn, room_name="room-0", limit=args.messages).messages
+        chat_db.close()
+
+    for name, send in (("sendall per frame", send_per_frame), ("send_frames", send_gathered)):
+        send_calls, bytes_per_sec = measure(send, messages, rounds=args.rounds)
+        print(f"{name:<18} {len(messages):>7,} messages  {send_calls:>7,} send calls per join  {bytes_per_sec / 2**20:>8.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Cost of the user and room id lookups: ChatDB.store_message and a MessageWriter sized batch of
+ChatDB.store_messages with the ids looked up by every call (the previous behaviour) and from the id cache,
+then a client connect with the schema setup it used to run against the cached store_user.
+Statements per call are counted with the sqlite trace callback.
+
+Run from the repo root:  python -m benchmarks.bench_id_cache --messages 20000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import typing
+
+from server.db.chat_db import ChatDB, ChatDBConfig
+
+
+class UncachedChatDB(ChatDB):
+    """ Looks every id up, as store_message, create_user_checkin_room and get_user_join_timestamp used to """
+    @staticmethod
+    def _cache_id(ids: typing.Dict[str, int], name: str, row_id: int) -> int:
+        return row_id
+
+    def store_messages(self, *, db_conn: sqlite3.Connection, messages: typing.Sequence[typing.Tuple[str, str, str, int]]) -> typing.Optional[range]:
+        # The previous batch insert resolved the ids with a join per row
+        db_conn.executemany('''
+           INSERT INTO messages (text_message, sender_id, room_id, timestamp)
+           SELECT ?1, users.id, rooms.id, ?4 FROM users, rooms
+           WHERE users.username = ?2 AND rooms.room_name = ?3''', messages)
+        return None
+
+
+def measure(db_conn: sqlite3.Connection, func: typing.Callable[[int], None], calls: int) -> typing.Tuple[float, float]:
+    """ (microseconds, statements) per call """
+    statements = 0
+
+    def count(_statement: str) -> None:
+        nonlocal statements
+        statements += 1
+
+    db_conn.set_trace_callback(count)
+    started = time.perf_counter_ns()
+    for index in range(calls):
+        func(index)
+    elapsed_ns = time.perf_counter_ns() - started
+    db_conn.set_trace_callback(None)
+    return elapsed_ns / calls / 1000, statements / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--connects", type=int, default=2_000)
+    args = parser.parse_args()
+    batch_size = ChatDBConfig.writer_batch_size
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, chat_db_cls in (("uncached", UncachedChatDB), ("cached", ChatDB)):
+            ChatDBConfig.db_path = os.path.join(tmp_dir, name, 'chat.db')
+            chat_db = chat_db_cls(pool_size=1)  # Every session gets the traced connection
+
+            with chat_db.session() as db_conn:
+                chat_db.setup_database(db_conn=db_conn)
+                chat_db.store_user(db_conn=db_conn, sender_name="bench-user")
+                chat_db.create_room(db_conn=db_conn, room_name="bench-room")
+
+                def store_message(index: int) -> None:
+                    chat_db.store_message(db_conn=db_conn, text_message=f"message {index}", sender_name="bench-user", room_name="bench-room", timestamp=index)
+
+                def store_batch(index: int) -> None:
+                    batch = [(f"message {index}-{offset}", "bench-user", "bench-room", index) for offset in range(batch_size)]
+                    chat_db.store_messages(db_conn=db_conn, messages=batch)
+
+                store_us, store_statements = measure(db_conn, store_message, args.messages)
+                batch_us, batch_statements = measure(db_conn, store_batch, max(args.messages // batch_size, 1))
+
+            def connect(index: int) -> None:
+                # The previous client handler ran the schema setup for every connecting client
+                with chat_db.session() as connect_conn:
+                    if chat_db_cls is UncachedChatDB:
+                        chat_db.setup_database(db_conn=connect_conn)
+                    chat_db.store_user(db_conn=connect_conn, sender_name=f"user-{index % 100}")
+
+            connect_us, connect_statements = measure(db_conn, connect, args.connects)
+
+            print(f"{name:<9} store_message {store_us:>7.2f} us ({store_statements:.0f} statements)"
+                  f"   batch of {batch_size} {batch_us / 1000:>6.2f} ms ({batch_statements:.0f} statements)"
+                  f"   connect {connect_us:>7.2f} us ({connect_statements:.0f} statements)")
+            chat_db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Join to first message latency of every chat server mode: --joins clients connect one after another to a private
+room holding --history messages, and each one measures
+- joined: connect until the CHATTING ack (history and join notice received)
+- first message: connect until its first chat message, sent right after the ack, comes back from the room.
+Before the connection state acks the server slept 100ms before every join notice and the client 1s before every
+prompt, so a join took at least 1.1s to the first message.
+
+Run from the repo root:  python -m benchmarks.bench_join --joins 200
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import tempfile
+import time
+import typing
+
+from definitions import ConnectionStates, ConnectionAck, FrameTypes, ServerModes
+from server.db.chat_db import ChatDBConfig
+from utils import FrameReader, encode_text_frame, encode_json_frame
+
+ROOM_NAME = "bench-join-room"
+
+
+def serve(mode: ServerModes, port: int) -> None:
+    if mode == ServerModes.ASYNC:
+        import asyncio
+        from server.async_server_chat import AsyncChatServer
+        asyncio.run(AsyncChatServer(host='127.0.0.1', listen_port=port).start())
+
+    elif mode == ServerModes.SHARDED:
+        from server.sharded_server_chat import ShardedChatServer
+        ShardedChatServer(host='127.0.0.1', listen_port=port, shards=2).start()
+
+    else:
+        from server.server_chat import ChatServer
+        ChatServer(host='127.0.0.1', listen_port=port).start()
+
+
+def read_until_chatting(frame_reader: FrameReader) -> None:
+    while True:
+        frame = frame_reader.read_frame()
+        if frame.type == FrameTypes.JSON and ConnectionAck.from_json(frame.json()).state == ConnectionStates.CHATTING.value:
+            return
+
+
+def join(port: int, username: str) -> typing.Tuple[float, float]:
+    started = time.perf_counter()
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.settimeout(30)
+        sock.sendall(encode_text_frame(username) + encode_json_frame({"room_type": "PRIVATE", "group_name": ROOM_NAME}))
+        frame_reader = FrameReader(sock)
+
+        read_until_chatting(frame_reader)
+        joined = time.perf_counter() - started
+
+        marker = f"first message of {username}"
+        sock.sendall(encode_text_frame(marker))
+        while marker not in frame_reader.read_frame().text():
+            pass
+        return joined, time.perf_counter() - started
+
+
+def fill_history(port: int, messages: int) -> None:
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(encode_text_frame("history-writer") + encode_json_frame({"room_type": "PRIVATE", "group_name": ROOM_NAME}))
+        frame_reader = FrameReader(sock)
+        read_until_chatting(frame_reader)
+        for index in range(messages):
+            sock.sendall(encode_text_frame(f"history message {index}"))
+        while f"history message {messages - 1}" not in frame_reader.read_frame().text():
+            pass
+    time.sleep(0.5)  # Lets the message writer commit them
+
+
+def report(name: str, latencies: typing.List[float]) -> str:
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    percentiles = statistics.quantiles(latencies_ms, n=100, method='inclusive')  # Exclusive extrapolates past max on small runs
+    return f"{name} p50 {percentiles[49]:>7.2f} ms  p99 {percentiles[98]:>7.2f} ms  max {latencies_ms[-1]:>7.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--joins", type=int, default=200)
+    parser.add_argument("--history", type=int, default=50, help="Messages in the room before the clients join")
+    parser.add_argument("--modes", nargs='+', default=[mode.value for mode in ServerModes], type=str.upper)
+    args = parser.parse_args()
+
+    for mode in map(ServerModes, args.modes):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+            port = random.randint(20_000, 60_000)
+            server_process = multiprocessing.get_context('fork').Process(target=serve, args=(mode, port))
+            server_process.start()
+            time.sleep(1)
+
+            if args.history:
+                fill_history(port, args.history)
+            results = [join(port, f"joiner-{index}") for index in range(args.joins)]
+
+            print(f"{mode.value:<9} {report('joined', [joined for joined, _ in results])}   {report('first message', [first for _, first in results])}")
+            server_process.kill()
+            server_process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Cost of the metrics instrumentation: a call of a plain function against the same function wrapped by timed()
+with metrics disabled and enabled, then ChatDB.store_message (timed by the ChatDB class decorator) both ways
+and the time to render the registry for a scrape.
+
+Run from the repo root:  python -m benchmarks.bench_metrics --calls 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from server.db.chat_db import ChatDB, ChatDBConfig
+from server.metrics import METRICS, timed
+
+HISTOGRAM = METRICS.histogram("bench_call_seconds", "Calls of the benchmark function")
+
+
+def plain(value: int) -> int:
+    return value + 1
+
+
+timed_plain = timed(HISTOGRAM)(plain)
+
+
+def per_call_ns(func, calls: int) -> float:
+    started = time.perf_counter_ns()
+    for index in range(calls):
+        func(index)
+    return (time.perf_counter_ns() - started) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=1_000_000)
+    parser.add_argument("--messages", type=int, default=20_000)
+    args = parser.parse_args()
+
+    METRICS.enabled = False
+    print(f"plain call                 {per_call_ns(plain, args.calls):>8.1f} ns")
+    print(f"timed call, disabled       {per_call_ns(timed_plain, args.calls):>8.1f} ns")
+    METRICS.enabled = True
+    print(f"timed call, enabled        {per_call_ns(timed_plain, args.calls):>8.1f} ns")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+        chat_db = ChatDB()
+        with chat_db.session() as db_conn:
+            chat_db.setup_database(db_conn=db_conn)
+            chat_db.store_user(db_conn=db_conn, sender_name="bench-user")
+            chat_db.create_room(db_conn=db_conn, room_name="bench-room")
+
+            for enabled in (False, True):
+                METRICS.enabled = enabled
+                started = time.perf_counter_ns()
+                for index in range(args.messages):
+                    chat_db.store_message(db_conn=db_conn, text_message=f"message {index}", sender_name="bench-user", room_name="bench-room", timestamp=index)
+                elapsed_ns = time.perf_counter_ns() - started
+                print(f"store_message, {'enabled ' if enabled else 'disabled'}   {elapsed_ns / args.messages / 1000:>8.2f} us")
+        chat_db.close()
+
+    started = time.perf_counter_ns()
+    body = METRICS.render()
+    print(f"render                     {(time.perf_counter_ns() - started) / 1e6:>8.2f} ms  ({len(body.splitlines())} lines)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Chat throughput of the threaded ChatServer (one process) versus the SHARDED mode with a growing number of worker
+processes. --rooms private rooms get --clients-per-room clients each, every client sends --messages messages and
+waits until it got all the messages of its room. Clients are spread over --client-processes processes so the load
+generator isn't bound by a single GIL either.
+Delivered is every chat message received by a client, sent is every chat message posted.
+Scaling is bound by the cores of the machine, the load generator shares them with the server.
+
+Run from the repo root:  python -m benchmarks.bench_sharded_chat --shards 1 2 4 --rooms 32
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import typing
+
+from server.db.chat_db import ChatDBConfig
+from server.server_chat import ChatServer
+from server.sharded_server_chat import ShardedChatServer
+from utils import FrameReader, encode_text_frame, encode_json_frame, send_frames
+
+MARKER = "bench-message"
+
+
+def serve(port: int, shards: typing.Optional[int]) -> None:
+    if shards is None:
+        ChatServer(host='127.0.0.1', listen_port=port).start()
+    else:
+        ShardedChatServer(host='127.0.0.1', listen_port=port, shards=shards).start()
+
+
+def join_room(port: int, *, username: str, room_name: str) -> typing.Tuple[socket.socket, FrameReader]:
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(60)  # Fails the run instead of hanging it when messages get lost
+    sock.sendall(encode_text_frame(username) + encode_json_frame({"room_type": "PRIVATE", "group_name": room_name}))
+    frame_reader = FrameReader(sock)
+
+    # Messages sent before a client joined never reach it, so nobody sends before everyone is in
+    while f"{username} joined" not in frame_reader.read_frame().text():
+        pass
+    return sock, frame_reader
+
+
+def run_client(sock: socket.socket, frame_reader: FrameReader, *, username: str, messages: int, expected: int,
+               start: threading.Event, results: typing.List[float]) -> None:
+    start.wait()
+
+    def receive() -> None:
+        received = 0
+        while received < expected:
+            if MARKER in frame_reader.read_frame().text():
+                received += 1
+        results.append(time.monotonic())
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    send_frames(sock, [encode_text_frame(f"{MARKER} {index} from {username}") for index in range(messages)])
+    receiver.join()
+    sock.close()
+
+
+def run_client_process(port: int, clients: typing.List[typing.Tuple[str, str]], *, messages: int, clients_per_room: int,
+                       start_barrier: multiprocessing.Barrier, results: multiprocessing.Queue) -> None:
+    start = threading.Event()
+    end_times: typing.List[float] = []
+    threads = []
+    # Joined one by one, the threaded server accepts a single client at a time with a short listen backlog
+    for username, room_name in clients:
+        sock, frame_reader = join_room(port, username=username, room_name=room_name)
+        thread = threading.Thread(
+            target=run_client,
+            args=(sock, frame_reader),
+            kwargs={"username": username, "messages": messages, "expected": messages * clients_per_room, "start": start, "results": end_times}
+        )
+        thread.start()
+        threads.append(thread)
+
+    # Every process starts sending once all clients of all processes joined their room
+    start_barrier.wait()
+    start_time = time.monotonic()
+    start.set()
+    for thread in threads:
+        thread.join()
+    results.put((start_time, max(end_times)))
+
+
+def measure(port: int, args: argparse.Namespace) -> float:
+    clients = [
+        (f"user-{room_index}-{client_index}", f"bench-room-{room_index}")
+        for room_index in range(args.rooms)
+        for client_index in range(args.clients_per_room)
+    ]
+    context = multiprocessing.get_context('fork')
+    start_barrier = context.Barrier(args.client_processes)
+    results = context.Queue()
+    client_processes = [
+        context.Process(
+            target=run_client_process,
+            args=(port, clients[index::args.client_processes]),
+            kwargs={"messages": args.messages, "clients_per_room": args.clients_per_room, "start_barrier": start_barrier, "results": results}
+        )
+        for index in range(args.client_processes)
+    ]
+    for client_process in client_processes:
+        client_process.start()
+
+    timings = [results.get() for _ in client_processes]
+    for client_process in client_processes:
+        client_process.join()
+    return max(end for _, end in timings) - min(start for start, _ in timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--rooms", type=int, default=32)
+    parser.add_argument("--clients-per-room", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--client-processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cpus, {args.rooms} rooms x {args.clients_per_room} clients, {args.messages} messages per client")
+    sent = args.rooms * args.clients_per_room * args.messages
+    delivered = sent * args.clients_per_room
+
+    for shards in (None, *args.shards):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+            port = random.randint(20_000, 60_000)
+            server_process = multiprocessing.get_context('fork').Process(target=serve, args=(port, shards))
+            server_process.start()
+            time.sleep(1)
+
+            elapsed = measure(port, args)
+            name = "threaded" if shards is None else f"sharded, {shards} shards"
+            print(f"{name:<20} {elapsed:>7.2f}s  sent {sent / elapsed:>9,.0f} messages/sec  delivered {delivered / elapsed:>10,.0f} messages/sec")
+
+            server_process.kill()
+            server_process.join()
+
+
+if __name__ == '__main__':
+    main()
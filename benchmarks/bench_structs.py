@@ -0,0 +1,83 @@
+"""
+Memory and throughput of MessageInfo as a plain dataclass (the previous behaviour, formatted and encoded on every
+use) versus the slotted class that keeps its formatted text and frame: bytes per live message, messages per second
+to construct, to format and encode once, and to send the same message to --fan-out clients.
+
+Run from the repo root:  python -m benchmarks.bench_structs --messages 200000
+"""
+import argparse
+import dataclasses
+import time
+import tracemalloc
+import typing
+
+from definitions import MessageInfo, MessageTypes
+from definitions.structs import _format_epoch_seconds
+from utils import encode_text_frame
+
+
+@dataclasses.dataclass
+class DataclassMessageInfo:
+    type: MessageTypes
+    text_message: str
+    sender_name: typing.Optional[str] = None
+    msg_timestamp: typing.Optional[int] = None
+
+    def formatted_msg(self) -> str:
+        if self.type == MessageTypes.SYSTEM:
+            return f"[SYSTEM]: {self.text_message}"
+        return f"[{_format_epoch_seconds(self.msg_timestamp // 1000)}] [{self.sender_name}]: {self.text_message}"
+
+    def wire_frame(self) -> bytes:
+        return encode_text_frame(self.formatted_msg())
+
+
+def build(message_class: typing.Callable[..., typing.Any], messages: int, text_messages: typing.List[str]) -> typing.List[typing.Any]:
+    return [
+        message_class(type=MessageTypes.CHAT, text_message=text_messages[index % len(text_messages)], sender_name="user", msg_timestamp=1_735_689_600_000 + index)
+        for index in range(messages)
+    ]
+
+
+def bytes_per_message(message_class: typing.Callable[..., typing.Any], messages: int, text_messages: typing.List[str]) -> float:
+    # Texts are shared, so only the message objects themselves (and the list holding them) are traced
+    tracemalloc.start()
+    built_messages = build(message_class, messages, text_messages)
+    traced_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built_messages
+    return traced_memory / messages
+
+
+def rate(work: typing.Callable[[], typing.Any], count: int) -> float:
+    start = time.perf_counter()
+    work()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--fan-out", type=int, default=20)
+    args = parser.parse_args()
+
+    text_messages = [f"message number {index} with some text" for index in range(1_000)]
+
+    for name, message_class in (("dataclass", DataclassMessageInfo), ("slotted, cached", MessageInfo)):
+        per_message = bytes_per_message(message_class, args.messages, text_messages)
+        construct_rate = rate(lambda: build(message_class, args.messages, text_messages), args.messages)
+
+        built_messages = build(message_class, args.messages, text_messages)
+        encode_rate = rate(lambda: [message.wire_frame() for message in built_messages], args.messages)
+
+        built_messages = build(message_class, args.messages, text_messages)
+        fan_out_rate = rate(lambda: [message.wire_frame() for message in built_messages for _ in range(args.fan_out)], args.messages)
+
+        print(
+            f"{name:<16} {per_message:>6.0f} bytes/message  construct {construct_rate:>10,.0f}/s  "
+            f"format+encode {encode_rate:>10,.0f}/s  fan out x{args.fan_out} {fan_out_rate:>10,.0f} messages/s"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+"""
+Headless load generator: starts a chat server (--mode) and a file server in their own processes, then runs
+--sessions simulated users built on the MessageClient and FileClient of the client package, spread over
+--client-processes processes. Every session joins a private room, then until --duration ends picks operations from
+--mix (weights) with exponential think times of --think-time-ms on average:
+- join: reconnects and joins a room, timed until the session gets its own joined message
+- switch: /switch to another room, timed until the joined message of the new room
+- chat: timed until the session gets its own message back from the room
+- upload / download: a file of --file-size-kb, timed until the file server answers (downloads pick one of the
+  files every client process uploads before starting)
+Sessions start evenly over --ramp-up seconds. The report is a JSON document (stdout or --output) with the run
+configuration, throughput, p50/p99/p999 latency and errors per operation and the peak RSS of each server,
+summed over its processes (Linux only, read from /proc), so runs can be diffed against each other.
+
+Run from the repo root:  python -m benchmarks.load_generator --sessions 2000 --duration 60 --output load.json
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import typing
+
+from client.client import FileClient, MessageClient
+from config import FileServerConfig, MessageServerConfig
+from definitions import FileTransferStatus, RoomTypes, ServerModes
+from server.db.chat_db import ChatDBConfig
+from server.server_file_transfer import FileTransferServer
+
+OPERATIONS = ("join", "switch", "chat", "upload", "download")
+FAILED_STATUSES = {status.value for status in FileTransferStatus} - {FileTransferStatus.SUCCEED.value}
+
+
+def parse_mix(mix: str) -> typing.Dict[str, float]:
+    weights = {}
+    for entry in mix.split(','):
+        operation, _, weight = entry.partition('=')
+        if operation.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {operation!r}, expected one of {', '.join(OPERATIONS)}")
+        weights[operation.strip()] = float(weight)
+    return weights
+
+
+def quiet_stdout() -> None:
+    # The servers print their banner, stdout carries the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+
+def serve_chat(mode: str, port: int, shards: int) -> None:
+    quiet_stdout()
+    if ServerModes(mode) == ServerModes.ASYNC:
+        import asyncio
+        from server.async_server_chat import AsyncChatServer
+        asyncio.run(AsyncChatServer(host='127.0.0.1', listen_port=port).start())
+
+    elif ServerModes(mode) == ServerModes.SHARDED:
+        from server.sharded_server_chat import ShardedChatServer
+        ShardedChatServer(host='127.0.0.1', listen_port=port, shards=shards).start()
+
+    else:
+        from server.server_chat import ChatServer
+        ChatServer(host='127.0.0.1', listen_port=port).start()
+
+
+def serve_files(port: int) -> None:
+    quiet_stdout()
+    FileTransferServer(host='127.0.0.1', listen_port=port).start()
+
+
+def process_tree(pid: int) -> typing.List[int]:
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat_file:
+                    # The command name may hold spaces and parentheses, the parent pid is the 2nd field after it
+                    children[int(stat_file.read().rsplit(')', 1)[1].split()[1])].append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+
+    pids, pending = [], [pid]
+    while pending:
+        pids.append(pending.pop())
+        pending.extend(children[pids[-1]])
+    return pids
+
+
+def rss_kb(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass  # Exited meanwhile
+    return 0
+
+
+class RssSampler:
+    """ Samples the RSS of a server and its worker processes in the background """
+    def __init__(self, servers: typing.Dict[str, int], *, interval_seconds: float):
+        self.servers = servers
+        self.interval_seconds = interval_seconds
+        self.peak_kb = dict.fromkeys(servers, 0)
+        self.last_kb = dict.fromkeys(servers, 0)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            for name, pid in self.servers.items():
+                self.last_kb[name] = sum(rss_kb(tree_pid) for tree_pid in process_tree(pid))
+                self.peak_kb[name] = max(self.peak_kb[name], self.last_kb[name])
+            if self._stopped.wait(self.interval_seconds):
+                return
+
+
+class Recorder:
+    """ Latencies and errors of the sessions of one client process, list appends are atomic so sessions share it """
+    def __init__(self):
+        self.latencies: typing.Dict[str, typing.List[float]] = {operation: [] for operation in OPERATIONS}
+        self.errors: typing.Dict[str, int] = dict.fromkeys(OPERATIONS, 0)
+        self._errors_lock = threading.Lock()
+
+    def error(self, operation: str) -> None:
+        with self._errors_lock:
+            self.errors[operation] += 1
+
+    def results(self) -> typing.Dict[str, typing.Any]:
+        return {"latencies": self.latencies, "errors": self.errors}
+
+
+class Session:
+    """ One simulated user, every operation blocks until its outcome is visible to the user """
+    def __init__(self, *, username: str, args: argparse.Namespace, rng: random.Random, file_ids: typing.List[str], download_dir: str):
+        self.username = username
+        self.args = args
+        self.rng = rng
+        self.file_ids = file_ids
+        self.download_dir = download_dir
+        self.message_client: typing.Optional[MessageClient] = None
+        self.file_client: typing.Optional[FileClient] = None
+        self._messages: typing.Optional[typing.Iterator[str]] = None
+        self._sent = 0
+
+    def _random_room(self) -> str:
+        return f"load-room-{self.rng.randrange(self.args.rooms)}"
+
+    def _wait_for(self, text: str) -> None:
+        for message in self._messages:
+            if text in message:
+                return
+
+    def _enter_room(self, room_name: str) -> None:
+        self.message_client.enter_room(room_name=RoomTypes.PRIVATE.value, group_name=room_name)
+        self._wait_for(f"{self.username} joined '{room_name}'")
+
+    def join(self) -> None:
+        self.close()
+        self.message_client = MessageClient(host='127.0.0.1', port=self.args.chat_port)
+        self.message_client.message_socket.settimeout(self.args.op_timeout)
+        self._messages = self.message_client.receive_messages()
+        self.message_client.send_message(self.username)
+        self._enter_room(self._random_room())
+
+    def switch(self) -> None:
+        self.message_client.send_message('/switch')
+        self._enter_room(self._random_room())
+
+    def chat(self) -> None:
+        self._sent += 1
+        marker = f"[{self.username} #{self._sent}]"
+        self.message_client.send_message(marker)
+        self._wait_for(marker)
+
+    def _file_client(self) -> FileClient:
+        if self.file_client is None:
+            self.file_client = FileClient(host='127.0.0.1', port=self.args.file_port)
+            self.file_client.file_socket.settimeout(self.args.op_timeout)
+        return self.file_client
+
+    def upload(self) -> None:
+        result = self._file_client().upload_file(self.rng.choice(self.args.upload_paths))
+        if result in FAILED_STATUSES:
+            raise RuntimeError(f"Upload failed: {result}")
+
+    def download(self) -> None:
+        if not self.file_ids:
+            raise RuntimeError("No uploaded file to download")
+
+        result = self._file_client().download_file(f"/download {self.rng.choice(self.file_ids)} {self.download_dir}")
+        if result != FileTransferStatus.SUCCEED.value:
+            raise RuntimeError(f"Download failed: {result}")
+        for file_name in os.listdir(self.download_dir):
+            os.remove(os.path.join(self.download_dir, file_name))
+
+    def close(self) -> None:
+        if self.message_client:
+            self.message_client.message_socket.close()
+            self.message_client = None
+
+    def close_files(self) -> None:
+        if self.file_client:
+            self.file_client.file_socket.close()
+            self.file_client = None
+
+
+def run_session(session: Session, *, start_at: float, deadline: float, weights: typing.Dict[str, float], recorder: Recorder) -> None:
+    operations, operation_weights = list(weights), list(weights.values())
+    mean_think_seconds = session.args.think_time_ms / 1000
+    time.sleep(max(0.0, start_at - time.monotonic()))
+
+    operation = "join"
+    while True:
+        started = time.perf_counter()
+        try:
+            # A session that lost its chat connection joins again instead of its next chat operation
+            if operation in ("switch", "chat") and session.message_client is None:
+                raise ConnectionError("Not connected to the chat server")
+            getattr(session, operation)()
+            recorder.latencies[operation].append((time.perf_counter() - started) * 1000)
+
+        except Exception:
+            recorder.error(operation)
+            if operation in ("upload", "download"):
+                session.close_files()
+            else:
+                session.close()
+
+        if time.monotonic() >= deadline:
+            break
+        if mean_think_seconds:
+            time.sleep(session.rng.expovariate(1 / mean_think_seconds))
+        operation = "join" if session.message_client is None else session.rng.choices(operations, operation_weights)[0]
+
+    session.close()
+    session.close_files()
+
+
+def run_client_process(process_index: int, session_indexes: typing.Sequence[int], args: argparse.Namespace,
+                       start_at: float, results: multiprocessing.Queue) -> None:
+    logging.getLogger('client').setLevel(logging.CRITICAL)  # Failures are counted in the report
+    threading.stack_size(256 * 1024)  # Thousands of session threads, none of them recursing
+    recorder = Recorder()
+
+    file_ids = []
+    if args.weights.get("download"):
+        uploader = FileClient(host='127.0.0.1', port=args.file_port)
+        file_ids = [file_id for path in args.upload_paths if (file_id := uploader.upload_file(path)) not in FAILED_STATUSES]
+        uploader.file_socket.close()
+
+    deadline = start_at + args.ramp_up + args.duration
+    threads = []
+    with tempfile.TemporaryDirectory() as download_root:
+        for session_index in session_indexes:
+            download_dir = os.path.join(download_root, str(session_index))
+            os.mkdir(download_dir)
+            session = Session(
+                username=f"load-user-{session_index}",
+                args=args,
+                rng=random.Random(f"{args.seed}-{session_index}"),
+                file_ids=file_ids,
+                download_dir=download_dir
+            )
+            thread = threading.Thread(
+                target=run_session,
+                args=(session,),
+                kwargs={
+                    "start_at": start_at + args.ramp_up * session_index / args.sessions,
+                    "deadline": deadline,
+                    "weights": args.weights,
+                    "recorder": recorder
+                },
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+    results.put((process_index, recorder.results()))
+
+
+def percentile(sorted_values: typing.Sequence[float], fraction: float) -> typing.Optional[float]:
+    # Nearest rank, so p999 of a small run is its max rather than an interpolation
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))], 3)
+
+
+def build_report(args: argparse.Namespace, process_results: typing.List[typing.Dict[str, typing.Any]],
+                 elapsed_seconds: float, rss_sampler: RssSampler) -> typing.Dict[str, typing.Any]:
+    operations = {}
+    for operation in OPERATIONS:
+        latencies = sorted(latency for result in process_results for latency in result["latencies"][operation])
+        errors = sum(result["errors"][operation] for result in process_results)
+        if not latencies and not errors:
+            continue
+
+        operations[operation] = {
+            "count": len(latencies),
+            "errors": errors,
+            "per_second": round(len(latencies) / elapsed_seconds, 2),
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p99": percentile(latencies, 0.99),
+                "p999": percentile(latencies, 0.999),
+                "max": round(latencies[-1], 3) if latencies else None
+            }
+        }
+
+    count = sum(stats["count"] for stats in operations.values())
+    return {
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("upload_paths", "chat_port", "file_port", "output")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "operations": operations,
+        "total": {
+            "count": count,
+            "errors": sum(stats["errors"] for stats in operations.values()),
+            "per_second": round(count / elapsed_seconds, 2)
+        },
+        "server_rss_mb": {
+            name: {"peak": round(rss_sampler.peak_kb[name] / 1024, 1), "final": round(rss_sampler.last_kb[name] / 1024, 1)}
+            for name in rss_sampler.servers
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=[mode.value for mode in ServerModes], default=MessageServerConfig.server_mode, type=str.upper)
+    parser.add_argument("--shards", type=int, default=MessageServerConfig.shards)
+    parser.add_argument("--sessions", type=int, default=1_000)
+    parser.add_argument("--client-processes", type=int, default=os.cpu_count())
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load after the ramp up")
+    parser.add_argument("--ramp-up", type=float, default=10.0)
+    parser.add_argument("--mix", dest="weights", type=parse_mix, default="join=2,switch=5,chat=85,upload=4,download=4")
+    parser.add_argument("--think-time-ms", type=float, default=500.0)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--file-size-kb", type=int, default=64)
+    parser.add_argument("--upload-files", type=int, default=4, help="Distinct files the sessions upload")
+    parser.add_argument("--op-timeout", type=float, default=30.0)
+    parser.add_argument("--rss-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Writes the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    # Every session holds sockets on both sides, raised for the servers as well since they are forked from here
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    tmp_dir = tempfile.mkdtemp(prefix='chat-load-')
+    try:
+        ChatDBConfig.db_path = os.path.join(tmp_dir, 'chat.db')
+        FileServerConfig.upload_dir = os.path.join(tmp_dir, 'uploads')
+
+        args.upload_paths = []
+        file_rng = random.Random(args.seed)
+        for file_index in range(args.upload_files):
+            args.upload_paths.append(os.path.join(tmp_dir, f"load-file-{file_index}.bin"))
+            with open(args.upload_paths[-1], 'wb') as upload_file:
+                upload_file.write(file_rng.randbytes(args.file_size_kb * 1024))
+
+        args.chat_port = random.randint(20_000, 40_000)
+        args.file_port = random.randint(40_001, 60_000)
+        context = multiprocessing.get_context('fork')
+        servers = [
+            context.Process(target=serve_chat, args=(args.mode, args.chat_port, args.shards)),
+            context.Process(target=serve_files, args=(args.file_port,))
+        ]
+        for server in servers:
+            server.start()
+        time.sleep(1)
+
+        rss_sampler = RssSampler({"chat": servers[0].pid, "file": servers[1].pid}, interval_seconds=args.rss_interval)
+        rss_sampler.start()
+
+        results = context.Queue()
+        start_at = time.monotonic() + 1  # Leaves the client processes time to start and upload their files
+        session_indexes = range(args.sessions)
+        client_processes = [
+            context.Process(target=run_client_process, args=(index, session_indexes[index::args.client_processes], args, start_at, results))
+            for index in range(args.client_processes)
+        ]
+        for client_process in client_processes:
+            client_process.start()
+
+        process_results = [result for _, result in sorted(results.get() for _ in client_processes)]
+        elapsed_seconds = time.monotonic() - start_at
+        for client_process in client_processes:
+            client_process.join()
+
+        rss_sampler.stop()
+        for server in servers:
+            for pid in process_tree(server.pid):  # Shard workers included
+                os.kill(pid, signal.SIGKILL)
+            server.join()
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report = json.dumps(build_report(args, process_results, elapsed_seconds, rss_sampler), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,15 @@
-import json
 import logging
 import os.path
 import socket
+import threading
 import time
 import typing
 from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
-from config import ClientConfig, MessageServerConfig, FileServerConfig, END_OF_MSG_INDICATOR
-from definitions import MessageInfo, RoomTypes, MessageTypes, FileTransferStatus
-from utils import chunkify
+from config import ClientConfig, MessageServerConfig, FileServerConfig
+from definitions import MessageInfo, RoomTypes, MessageTypes, FileTransferStatus, FileHandlerTypes, FrameTypes, UploadFileOffer, DownloadFileHeader, ConnectionStates, ConnectionAck
+from utils import FrameReader, encode_text_frame, encode_json_frame, send_frames, send_chunk, file_checksum, hash_file_prefix
 
 logger = getLogger(__name__)
 
@@ -20,16 +20,26 @@ class MessageClient:
         try:
             self._message_socket.connect((host, port))
             logger.info(f"Client Successfully connected to Chat Server")
+            self._frame_reader = FrameReader(self._message_socket)
 
         except Exception as e:
             logger.exception("Failed to connect message server ... ")
             raise Exception(f"Unable to connect to messages server - {host}, with port {port}") from e
 
+        # Mirrors the server side state of the connection, moved forward by the acks receive_messages reads
+        self.state = ConnectionStates.AUTH
+        self.room_name: typing.Optional[str] = None
+        self._state_changed = threading.Condition()
+
     @property
     def message_socket(self) -> socket.socket:
         return self._message_socket
 
-    def enter_room(self, *, room_name: str) -> None :
+    def send_message(self, message: str) -> None:
+        self._message_socket.sendall(encode_text_frame(message))
+
+    def enter_room(self, *, room_name: str, group_name: typing.Optional[str] = None) -> None :
+        # group_name of a private room is asked for when not given (headless clients pass it)
         setup_room_data = {}
         while True:
             room_type = RoomTypes[room_name.upper()]
@@ -40,80 +50,223 @@ class MessageClient:
                 }
 
             elif room_type == RoomTypes.PRIVATE:
-                group_name = input("Enter private group name you want to chat: ").strip()
+                if group_name is None:
+                    group_name = input("Enter private group name you want to chat: ").strip()
                 setup_room_data = {
                     "room_type": room_name,
                     "group_name": group_name
                 }
 
-            self._message_socket.send(json.dumps(setup_room_data).encode('utf-8'))
+            self._message_socket.sendall(encode_json_frame(setup_room_data))
             break
 
+    def switch_room(self) -> None:
+        # Set before sending, so waiting for CHATTING afterwards waits for the next room rather than the current one
+        with self._state_changed:
+            self.state = ConnectionStates.SWITCHING
+        self.send_message('/switch')
+
+    def wait_for_state(self, state: ConnectionStates, *, timeout: typing.Optional[float] = None) -> bool:
+        """ Needs receive_messages to be consumed by another thread, returns False on timeout """
+        with self._state_changed:
+            return self._state_changed.wait_for(lambda: self.state == state, timeout=timeout)
+
     def receive_messages(self) -> typing.Generator[str, None, None]:
-        fragmented_msg = ""
+        # Yields the text messages, acks only update the connection state
         while True:
             try:
-                # I consumed buffer of 1024 bytes which can contains more than one message, so I split by end msg indicator
-                buffer_msg = self._message_socket.recv(1024).decode('utf-8')
-                aggrigated_buffer = fragmented_msg + buffer_msg
-
-                messages_in_buffer = aggrigated_buffer.split(END_OF_MSG_INDICATOR)
-
-                if not aggrigated_buffer.endswith(END_OF_MSG_INDICATOR):
-                    fragmented_msg = messages_in_buffer[-1]
-                else:
-                    fragmented_msg = ""
-
-                yield from messages_in_buffer[:-1]
+                frame = self._frame_reader.read_frame()
 
             except Exception as e:
                 self._message_socket.close()
                 logger.exception("Failed to receive messages")
                 raise Exception("Cannot receiving messages...") from e
 
+            if frame.type == FrameTypes.JSON:
+                ack = ConnectionAck.from_json(frame.json())
+                with self._state_changed:
+                    self.state = ConnectionStates(ack.state)
+                    self.room_name = ack.room_name
+                    self._state_changed.notify_all()
+                continue
+
+            yield frame.text()
+
 class FileClient:
     def __init__(self, host: str, port: int):
+        self._host = host
+        self._port = port
+        self._connect()
+
+    @property
+    def file_socket(self) -> socket.socket:
+        return self._file_socket
+
+    def _connect(self, *, timeout: typing.Optional[float] = None) -> None:
         self._file_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._file_socket.settimeout(timeout)
 
         try:
-            self._file_socket.connect((host, port))
+            self._file_socket.connect((self._host, self._port))
             logger.info(f"Client Successfully connected to File Server")
+            self._frame_reader = FrameReader(self._file_socket)
 
         except Exception as e:
             logger.exception("Failed to connect file server ... ")
-            raise Exception(f"Unable to connect to file server - {host}, {port}") from e
+            raise Exception(f"Unable to connect to file server - {self._host}, {self._port}") from e
 
-    @property
-    def file_socket(self) -> socket.socket:
-        return self._file_socket
+    def _with_retries(self, transfer: typing.Callable[[], str]) -> str:
+        # Every attempt continues from what was already transferred, so a retry costs only the missing bytes
+        for attempt in range(ClientConfig.transfer_retries + 1):
+            try:
+                return transfer()
+
+            except OSError as e:
+                logger.warning(f"File transfer interrupted ({e!r}), attempt {attempt + 1} of {ClientConfig.transfer_retries + 1}")
+                timeout = self._file_socket.gettimeout()  # Set by the caller on the socket, kept by the new one
+                self._file_socket.close()
+                time.sleep(ClientConfig.transfer_retry_delay_seconds)
+                try:
+                    self._connect(timeout=timeout)
+                except Exception:
+                    pass  # Next attempt fails on the closed socket and tries to reconnect again
 
-    # Triggers upload_file methode in FileServerTransfer
-    def upload_file(self, file_path: str) -> None :
-        self._file_socket.send("UPLOAD".encode('utf-8'))
+        return FileTransferStatus.FAILED.value
 
-        filename = os.path.basename(file_path)
+    def receive_response(self) -> str:
+        return self._frame_reader.read_frame().text()
+
+    # Triggers upload_file methode in FileServerTransfer, returns the file id or a FileTransferStatus value
+    def upload_file(self, file_path: str) -> str:
         file_size = os.path.getsize(file_path)
         upload_data = {
-            "filename": filename,
-            "file_size": file_size
+            "filename": os.path.basename(file_path),
+            "file_size": file_size,
+            "checksum": file_checksum(file_path),
+            "file_id": None,
+            "parts": 1
         }
-        self._file_socket.sendall(json.dumps(upload_data).encode('utf-8'))
 
+        if file_size >= ClientConfig.parallel_upload_min_size and ClientConfig.upload_streams > 1:
+            upload_data["parts"] = ClientConfig.upload_streams
+            return self._with_retries(lambda: self._upload_in_parts(file_path=file_path, upload_data=upload_data))
+
+        return self._with_retries(lambda: self._upload_from_offset(file_path=file_path, upload_data=upload_data))
+
+    def _upload_from_offset(self, *, file_path: str, upload_data: typing.Dict[str, typing.Any]) -> str:
+        send_frames(self._file_socket, [encode_text_frame(FileHandlerTypes.UPLOAD.value), encode_json_frame(upload_data)])
+
+        response = self._frame_reader.read_frame()
+        if response.type != FrameTypes.JSON:
+            return response.text()
+
+        upload_offer = UploadFileOffer.from_json(response.json())
+        upload_data["file_id"] = upload_offer.file_id  # Retries resume this upload
+
+        self._send_file_range(sock=self._file_socket, file_path=file_path, offset=upload_offer.offset, length=upload_data["file_size"] - upload_offer.offset)
+        return self.receive_response()
+
+    def _upload_in_parts(self, *, file_path: str, upload_data: typing.Dict[str, typing.Any]) -> str:
+        # The file is split in ranges sent concurrently on their own connections, then committed on this one
+        send_frames(self._file_socket, [encode_text_frame(FileHandlerTypes.UPLOAD.value), encode_json_frame(upload_data)])
+
+        response = self._frame_reader.read_frame()
+        if response.type != FrameTypes.JSON:
+            return response.text()
+
+        upload_offer = UploadFileOffer.from_json(response.json())
+        upload_data["file_id"] = upload_offer.file_id  # Retries send only the parts the server is missing
+
+        if upload_offer.missing_parts:
+            with ThreadPoolExecutor(max_workers=len(upload_offer.missing_parts)) as part_senders:
+                part_results = list(part_senders.map(
+                    lambda part_index: self._upload_part(file_path=file_path, file_id=upload_offer.file_id, part_index=part_index),
+                    upload_offer.missing_parts
+                ))
+
+            if failed_results := [result for result in part_results if result != FileTransferStatus.SUCCEED.value]:
+                return failed_results[0]
+
+        send_frames(self._file_socket, [encode_text_frame(FileHandlerTypes.UPLOAD_COMMIT.value), encode_json_frame({"file_id": upload_offer.file_id})])
+        return self.receive_response()
+
+    def _upload_part(self, *, file_path: str, file_id: str, part_index: int) -> str:
+        timeout = self._file_socket.gettimeout() or ClientConfig.part_timeout_seconds
+        with socket.create_connection((self._host, self._port), timeout=timeout) as part_socket:
+            frame_reader = FrameReader(part_socket)
+            send_frames(part_socket, [encode_text_frame(FileHandlerTypes.UPLOAD_PART.value), encode_json_frame({"file_id": file_id, "part_index": part_index})])
+
+            response = frame_reader.read_frame()
+            if response.type != FrameTypes.JSON:
+                return response.text()
+
+            part_offer = UploadFileOffer.from_json(response.json())
+            self._send_file_range(sock=part_socket, file_path=file_path, offset=part_offer.offset, length=part_offer.length)
+            return frame_reader.read_frame().text()
+
+    @staticmethod
+    def _send_file_range(*, sock: socket.socket, file_path: str, offset: int, length: int) -> None:
+        buffer = memoryview(bytearray(ClientConfig.upload_chunk_size))
         with open(file_path, 'rb') as file:
-            for chunk in chunkify(reader_file=file, chunk_size=1024):
-                self._file_socket.sendall(chunk)
+            file.seek(offset)
+            while length and (chunk_size := file.readinto(buffer[:min(len(buffer), length)])):
+                send_chunk(sock, buffer[:chunk_size])
+                length -= chunk_size
 
-    # Triggers download_file methode in FileServerTransfer
-    def download_file(self, message: str) -> None:
-        self.file_socket.send("DOWNLOAD".encode('utf-8'))
+    # Triggers download_file methode in FileServerTransfer, the file is streamed back and written to dst path
+    def download_file(self, message: str) -> str:
         file_id = message.split()[1].strip()
         user_dir_dst_path = message.split()[2].strip()
 
-        download_data = {
-            "file_id": file_id,
-            "dst_path": user_dir_dst_path
-        }
-        self.file_socket.sendall(json.dumps(download_data).encode('utf-8'))
+        if not os.path.isdir(user_dir_dst_path):
+            return FileTransferStatus.FAILED.value
+
+        return self._with_retries(lambda: self._download_from_offset(file_id=file_id, user_dir_dst_path=user_dir_dst_path))
+
+    def _download_from_offset(self, *, file_id: str, user_dir_dst_path: str) -> str:
+        # Received bytes are kept in '<file id>.part' until the checksum matches, a later download resumes from it
+        partial_file_path = os.path.join(user_dir_dst_path, f"{os.path.basename(file_id)}.part")
+        try:
+            file = open(partial_file_path, 'r+b' if os.path.exists(partial_file_path) else 'w+b')
+        except OSError:
+            logger.exception(f"Cannot write to {user_dir_dst_path}")
+            return FileTransferStatus.FAILED.value
+
+        with file:
+            download_data = {
+                "file_id": file_id,
+                "offset": os.fstat(file.fileno()).st_size
+            }
+            send_frames(self._file_socket, [encode_text_frame(FileHandlerTypes.DOWNLOAD.value), encode_json_frame(download_data)])
+
+            response = self._frame_reader.read_frame()
+            if response.type != FrameTypes.JSON:
+                file.close()
+                os.remove(partial_file_path)
+                return response.text()
+
+            download_header = DownloadFileHeader.from_json(response.json())
+            file_hash = hash_file_prefix(reader_file=file, size=download_header.offset)
+            file.truncate(download_header.offset)
+
+            buffer = memoryview(bytearray(ClientConfig.download_buffer_size))
+            received_bytes = 0
+            while received_bytes < download_header.length:
+                chunk_size = self._frame_reader.recv_into(buffer[:min(len(buffer), download_header.length - received_bytes)])
+                if not chunk_size:
+                    raise ConnectionResetError("File server closed connection in the middle of a download")
+
+                file.write(buffer[:chunk_size])
+                file_hash.update(buffer[:chunk_size])
+                received_bytes += chunk_size
+
+        if download_header.checksum and file_hash.hexdigest() != download_header.checksum:
+            os.remove(partial_file_path)
+            logger.warning(f"Checksum mismatch for {file_id}, download is discarded")
+            return FileTransferStatus.FAILED.value
+
+        os.replace(partial_file_path, os.path.join(user_dir_dst_path, os.path.basename(download_header.file_name)))
+        return FileTransferStatus.SUCCEED.value
 
 class ClientUI:
 
@@ -139,12 +292,13 @@ def main():
     while True:
         username = input("Enter your username: ")
         if username:
-            message_client.message_socket.send(username.encode('utf-8'))
+            message_client.send_message(username)
             break
         else:
             ClientUI.render(msg_type=MessageTypes.SYSTEM, text="You've entered an empty username, try again... \n")
 
     with ThreadPoolExecutor(max_workers=5) as background_threads:
+        background_threads.submit(ClientUI.start_receiving, message_client)
         while True:
             try:
                 print(f"\n Available rooms to chat:")
@@ -154,21 +308,25 @@ def main():
                 chosen_room = input("Enter room type: ").strip().upper()
                 message_client.enter_room(room_name=chosen_room)
 
+                # History and the join notice come before the ack, so the prompt shows up after them
+                if not message_client.wait_for_state(ConnectionStates.CHATTING, timeout=ClientConfig.join_timeout_seconds):
+                    ClientUI.render(msg_type=MessageTypes.SYSTEM, text="The chat server didn't let you in, try again later")
+                    message_client.message_socket.close()
+                    return
+
             except KeyError:
                 ClientUI.clear_screen()
                 ClientUI.render(msg_type=MessageTypes.SYSTEM, text=f"Got an unexpected room type {chosen_room}, try again")
 
             else:
-                background_threads.submit(ClientUI.start_receiving,message_client)
                 while True:
-                    time.sleep(1)     # Waits for all messages to arrive and then writing a message
-                    msg = input(f"\n Enter a message (text, /switch, /file <path>, /download <file_id> <path> :  ")
+                    msg = input(f"\n Enter a message (text, /switch, /history, /file <path>, /download <file_id> <path> :  ")
 
                     if not msg:
                         ClientUI.render(msg_type=MessageTypes.SYSTEM, text="An empy message could not be sent ...")
 
                     if msg.lower() == "/switch":
-                        message_client.message_socket.send(msg.encode('utf-8'))
+                        message_client.switch_room()
                         ClientUI.clear_screen()
                         break
 
@@ -185,16 +343,17 @@ def main():
 
                         try:
                             ClientUI.render(msg_type=MessageTypes.SYSTEM, text=f"Uploading file ...")
-                            background_threads.submit(file_client.upload_file, file_path_from_msg)
-
-                            if result_from_server := file_client.file_socket.recv(1024).decode():
+                            if result_from_server := file_client.upload_file(file_path_from_msg):
                                 if result_from_server == FileTransferStatus.EXCEEDED.value:
                                     ClientUI.render(msg_type=MessageTypes.SYSTEM, text="Upload failed, file size exceeded")
 
+                                elif result_from_server == FileTransferStatus.FAILED.value:
+                                    ClientUI.render(msg_type=MessageTypes.SYSTEM, text="Upload failed ...")
+
                                 else:
                                     file_id = result_from_server
                                     ClientUI.render(msg_type=MessageTypes.SYSTEM, text=f"File is uploaded successfully!")
-                                    message_client.message_socket.send(file_id.encode('utf-8'))
+                                    message_client.send_message(file_id)
 
                         except Exception as e:
                             file_client.file_socket.close()
@@ -210,9 +369,8 @@ def main():
                             continue
 
                         ClientUI.render(msg_type=MessageTypes.SYSTEM, text=f"Downloading file ...")
-                        background_threads.submit(file_client.download_file, msg)
 
-                        if result_from_server := file_client.file_socket.recv(1024).decode():
+                        if result_from_server := file_client.download_file(msg):
                             if result_from_server == FileTransferStatus.SUCCEED.value:
                                 ClientUI.render(msg_type=MessageTypes.SYSTEM, text="File is downloaded successfully!")
 
@@ -228,7 +386,7 @@ def main():
                         return
 
                     else:
-                        message_client.message_socket.send(msg.encode('utf-8'))
+                        message_client.send_message(msg)
 
 
 if __name__ == '__main__':
@@ -1 +1 @@
-from .config import ClientConfig, MessageServerConfig, FileServerConfig, END_OF_MSG_INDICATOR
\ No newline at end of file
+from .config import ClientConfig, MessageServerConfig, FileServerConfig, ProtocolConfig, MetricsConfig, DiagnosticsConfig
\ No newline at end of file
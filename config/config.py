@@ -1,30 +1,83 @@
 import dataclasses
 import os
+import typing
 
-END_OF_MSG_INDICATOR = '@'
+@dataclasses.dataclass(frozen=True)
+class ProtocolConfig:
+    version: int = 1
+    frame_buffer_size: int = 65_536
+    max_frame_payload_size: int = 1_048_576  # 1mb, control and chat frames only (file bodies aren't framed)
+    strict_validation: bool = False  # Decodes control messages with pydantic models (needs pydantic installed)
 
 @dataclasses.dataclass(frozen=True)
 class ClientConfig:
     host_ip: str = '127.0.0.1'
     allowed_input_user_pattern: str = "/^[a-zA-Z0-9._]+$/"  # For future: use login enforcement
+    download_buffer_size: int = 1_048_576  # Reused receive buffer per download
+    upload_chunk_size: int = 1_048_576  # Every chunk is sent with its own CRC32, must fit the server upload_buffer_size
+    transfer_retries: int = 3  # Reconnects and resumes from the last verified byte before giving up
+    transfer_retry_delay_seconds: float = 1.0
+    upload_streams: int = 4  # Connections per upload in parts
+    part_timeout_seconds: float = 60.0  # Socket timeout of part connections when the file socket has none
+    parallel_upload_min_size: int = 67_108_864  # 64mb, smaller files go over a single connection
+    join_timeout_seconds: float = 30.0  # Waiting for the server to acknowledge a room setup
 
 @dataclasses.dataclass(frozen=True)
 class MessageServerConfig:
     listening_port: int = 1
     listener_limit_number: int = 5
     max_threads_number: int = 7
+    server_mode: str = "THREADED"  # THREADED, ASYNC or SHARDED
+    async_listener_limit_number: int = 1024
+    history_page_size: int = 50  # Messages sent on join and per /history request
+    slow_consumer_policy: str = "BUFFER"  # DROP, DISCONNECT or BUFFER, applied when a client's outbox is full
+    outbox_max_pending_bytes: int = 1_048_576
+    outbox_buffer_timeout_seconds: float = 5.0  # BUFFER lets a client stay over outbox_max_pending_bytes this long, then disconnects it
+    outbox_buffer_max_pending_bytes: int = 16_777_216  # BUFFER disconnects a client right away past this
+    history_cache_room_size: int = 200  # Newest messages kept in memory per recently used room
+    history_cache_max_bytes: int = 67_108_864  # 64mb for all rooms, least recently used rooms are dropped first
+    shards: int = 4  # Worker processes of the SHARDED mode, rooms are spread over them by consistent hashing
+    shard_virtual_nodes: int = 64  # Points per shard on the hash ring, more spread rooms more evenly
+    shard_handoff_timeout_seconds: float = 900.0  # A new client idle this long before sending its username and room is dropped
+    shard_handoff_sweep_seconds: float = 5.0  # How often the acceptor looks for such clients
+    shard_run_dir: typing.Optional[str] = None  # Unix sockets between the shard processes, a temp dir when not set
+
+@dataclasses.dataclass(frozen=True)
+class MetricsConfig:
+    enabled: bool = False  # Serves the metrics on the ports below, --metrics-port of the servers does the same
+    host: str = '127.0.0.1'
+    chat_port: int = 9101  # SHARDED workers serve on the following ports, one per shard
+    file_port: int = 9102
+    latency_buckets_seconds: typing.Tuple[float, ...] = (
+        0.000_05, 0.000_1, 0.000_25, 0.000_5, 0.001, 0.002_5, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+@dataclasses.dataclass(frozen=True)
+class DiagnosticsConfig:
+    profile_signal: str = "SIGUSR2"  # Profiles every thread of the server for profile_seconds, see server/profiler.py
+    profile_seconds: float = 10.0
+    max_profile_seconds: float = 120.0  # Cap of /debug/profile?seconds= on the metrics endpoint
+    profile_sample_interval_seconds: float = 0.005
+    profile_dir: typing.Optional[str] = None  # Signal triggered profiles are written here, the temp dir when not set
+    trace_messages: bool = False  # Also enabled by --trace-slow-ms of the chat server
+    slow_trace_ms: float = 250.0  # Traced messages slower than this, from receipt to commit, are logged with their spans
 
 @dataclasses.dataclass(frozen=True)
 class FileServerConfig:
     listening_port: int = 2
     listener_limit_number: int = 5
-    max_file_size: int = 16_000_000  #16mb
-    max_files_stored_in_uploads: int = 20
-    max_threads_number: int = 7
+    max_file_size: int = 2_147_483_648  #2gb, failed transfers resume instead of starting over
+    max_files_stored_in_uploads: int = 20  # Distinct contents kept, the least recently downloaded are evicted first
+    max_uploads_size: int = 10_737_418_240  #10gb, total size of those contents
+    upload_buffer_size: int = 1_048_576  # Reused receive buffer per upload, also the max upload chunk size
+    upload_dir: typing.Optional[str] = None  # Overrides the OS default below
+    max_upload_parts: int = 16
 
     @classmethod
     def upload_dir_dst_path(cls)-> str:
-        if os.name == 'nt':  # For Windows
+        if cls.upload_dir:
+            upload_dir = cls.upload_dir
+        elif os.name == 'nt':  # For Windows
             upload_dir = r"C:\Uploads"
         else:  # For Linux/macOS
             upload_dir = "/opt/uploads"
@@ -1,3 +1,4 @@
-from .types import RoomTypes, MessageTypes, FileHandlerTypes, FileTransferStatus
-from .structs import ClientInfo, MessageInfo, UploadFileData, DownloadFileData, SetupRoomData
+from .types import RoomTypes, MessageTypes, FileHandlerTypes, FileTransferStatus, ServerModes, FrameTypes, SlowConsumerPolicies, ConnectionStates
+from .structs import ClientInfo, AsyncClientInfo, MessageInfo, UploadFileData, UploadFilePartData, UploadCommitData, UploadFileOffer, DownloadFileData, DownloadFileHeader, SetupRoomData, ConnectionAck
+from .control_message import ControlMessage
 from .errors import *
\ No newline at end of file
@@ -0,0 +1,112 @@
+import functools
+import typing
+
+from config import ProtocolConfig
+from .errors import InvalidMessageError
+
+_MISSING = object()
+
+_T = typing.TypeVar('_T', bound='ControlMessage')
+
+class _Field(typing.NamedTuple):
+    name: str
+    annotation: typing.Any
+    accepted_types: typing.Tuple[type, ...]  # Exact types, so a JSON true isn't taken for an int
+    item_type: typing.Optional[type]  # Element type of list fields
+    default: typing.Any  # _MISSING for required fields
+
+def _compile_field(name: str, annotation: typing.Any, default: typing.Any) -> _Field:
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin is typing.Union and type(None) in args:  # Optional[X]
+        (inner_annotation,) = (arg for arg in args if arg is not type(None))
+        return _Field(name, annotation, (inner_annotation, type(None)), None, default)
+
+    if origin is list:
+        return _Field(name, annotation, (list,), args[0], default)
+
+    return _Field(name, annotation, (annotation,), None, default)
+
+
+class ControlMessage:
+    """
+    Base of the JSON control messages (room setup, upload and download handshakes), declared like dataclasses.
+    Decoding checks the exact JSON types of the declared fields and ignores unknown keys, without pydantic's import
+    and per model validation cost. ProtocolConfig.strict_validation decodes with an equivalent pydantic model instead.
+    """
+    _fields: typing.ClassVar[typing.Tuple[_Field, ...]] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(
+            _compile_field(name, annotation, cls.__dict__.get(name, _MISSING))
+            for name, annotation in typing.get_type_hints(cls).items()
+            if typing.get_origin(annotation) is not typing.ClassVar
+        )
+
+    def __init__(self, **kwargs: typing.Any):
+        values = {}
+        for name, annotation, accepted_types, item_type, default in self._fields:
+            value = kwargs.get(name, _MISSING)
+
+            if value is _MISSING:
+                if default is _MISSING:
+                    raise InvalidMessageError(f"{type(self).__name__}.{name} is missing")
+                value = list(default) if type(default) is list else default
+
+            elif type(value) not in accepted_types or (item_type is not None and any(type(item) is not item_type for item in value)):
+                raise InvalidMessageError(f"{type(self).__name__}.{name} expects {getattr(annotation, '__name__', annotation)}, got {value!r}")
+
+            values[name] = value
+
+        self.__dict__.update(values)
+
+    @classmethod
+    def from_json(cls: typing.Type[_T], json_data: typing.Any) -> _T:
+        """ Decodes a received JSON frame payload, raises InvalidMessageError if it doesn't match the fields """
+        if not isinstance(json_data, dict):
+            raise InvalidMessageError(f"{cls.__name__} expects a JSON object, got {type(json_data).__name__}")
+
+        if ProtocolConfig.strict_validation:
+            return cls._strict_from_json(json_data)
+
+        return cls(**json_data)
+
+    @classmethod
+    def _strict_from_json(cls: typing.Type[_T], json_data: typing.Dict[str, typing.Any]) -> _T:
+        from pydantic import ValidationError
+
+        try:
+            model = cls.strict_model().model_validate(json_data)
+        except ValidationError as e:
+            raise InvalidMessageError(str(e)) from e
+
+        # Pydantic already checked the values, so they are set without the type checks of __init__
+        message = cls.__new__(cls)
+        message.__dict__.update(model.model_dump())
+        return message
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def strict_model(cls) -> typing.Any:
+        """ The pydantic model with the same fields, built on first use so pydantic is imported only in strict mode """
+        from pydantic import create_model
+
+        return create_model(
+            cls.__name__,
+            **{field.name: (field.annotation, ... if field.default is _MISSING else field.default) for field in cls._fields}
+        )
+
+    def as_dict(self) -> typing.Dict[str, typing.Any]:
+        return {field.name: getattr(self, field.name) for field in self._fields}
+
+    def __eq__(self, other: object) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{name}={value!r}' for name, value in self.as_dict().items())})"
@@ -9,4 +9,10 @@ class DownloadFileError(Exception):
     pass
 
 class FileIdNotFoundError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class ProtocolError(Exception):
+    pass
+
+class InvalidMessageError(ProtocolError):
+    pass
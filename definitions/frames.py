@@ -0,0 +1,21 @@
+import json
+import struct
+import typing
+
+from config import ProtocolConfig
+from .types import FrameTypes
+
+# Frame layout: version (1 byte) | frame type (1 byte) | payload length (4 bytes, big endian) | payload
+FRAME_HEADER = struct.Struct('!BBI')
+
+
+def encode_frame(frame_type: FrameTypes, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(ProtocolConfig.version, frame_type, len(payload)) + payload
+
+
+def encode_text_frame(text: str) -> bytes:
+    return encode_frame(FrameTypes.TEXT, text.encode('utf-8'))
+
+
+def encode_json_frame(data: typing.Any) -> bytes:
+    return encode_frame(FrameTypes.JSON, json.dumps(data).encode('utf-8'))
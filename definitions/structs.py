@@ -1,43 +1,163 @@
-import dataclasses
+import asyncio
+import functools
 import socket
-import threading
+import time
 import typing
 
-from pydantic import BaseModel
+from .control_message import ControlMessage
+from .frames import encode_text_frame
+from .types import RoomTypes, MessageTypes, ConnectionStates
 
-from .types import RoomTypes, MessageTypes
+if typing.TYPE_CHECKING:
+    from server.fan_out import ClientOutbox, AsyncClientOutbox
 
 
-@dataclasses.dataclass
 class ClientInfo:
-    client_conn: socket.socket
-    username: str
-    room_type: RoomTypes = None
-    current_room: typing.Optional[str] = None
-    room_setup_done_flag: threading.Event = dataclasses.field(default_factory=threading.Event)
+    """ Connection state of a threaded server client, slotted since the server holds one per connected client """
+    __slots__ = ('client_conn', 'username', 'state', 'room_type', 'current_room', 'join_timestamp', 'history_cursor', 'has_older_history', 'outbox')
+
+    def __init__(
+            self,
+            *,
+            client_conn: socket.socket,
+            username: str,
+            room_type: typing.Optional[RoomTypes] = None,
+            current_room: typing.Optional[str] = None,
+            outbox: typing.Optional["ClientOutbox"] = None
+    ):
+        self.client_conn = client_conn
+        self.username = username
+        self.state = ConnectionStates.AUTH
+        self.room_type = room_type
+        self.current_room = current_room
+        self.join_timestamp: typing.Optional[int] = None  # First join to the current private room, history starts there
+        self.history_cursor: typing.Optional[int] = None  # Oldest message id sent from the current room history
+        self.has_older_history = False
+        self.outbox = outbox  # Every write to the client goes through its outbox
+
+    def __repr__(self) -> str:
+        return f"ClientInfo(username={self.username!r}, current_room={self.current_room!r})"
+
+class AsyncClientInfo:
+    """ Connection state of an async server client """
+    __slots__ = ('writer', 'username', 'state', 'room_type', 'current_room', 'join_timestamp', 'history_cursor', 'has_older_history', 'outbox')
+
+    def __init__(
+            self,
+            *,
+            writer: asyncio.StreamWriter,
+            username: str,
+            room_type: typing.Optional[RoomTypes] = None,
+            current_room: typing.Optional[str] = None,
+            outbox: typing.Optional["AsyncClientOutbox"] = None
+    ):
+        self.writer = writer
+        self.username = username
+        self.state = ConnectionStates.AUTH
+        self.room_type = room_type
+        self.current_room = current_room
+        self.join_timestamp: typing.Optional[int] = None
+        self.history_cursor: typing.Optional[int] = None
+        self.has_older_history = False
+        self.outbox = outbox
+
+    def __repr__(self) -> str:
+        return f"AsyncClientInfo(username={self.username!r}, current_room={self.current_room!r})"
+
+@functools.lru_cache(maxsize=4096)
+def _format_epoch_seconds(epoch_seconds: int) -> str:
+    # Messages are displayed with a seconds resolution, so bursts and history replays share the formatted time
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(epoch_seconds))
 
-@dataclasses.dataclass
 class MessageInfo:
-    type: MessageTypes
-    text_message: str
-    sender_name: typing.Optional[str] = None
-    msg_timestamp: typing.Optional[str] = None
+    """
+    A chat or system message, treated as immutable once created.
+    Slotted (no per instance __dict__), the formatted text and its encoded frame are built on first use and kept,
+    so a message broadcast to a room and then cached for history is formatted and encoded once.
+    """
+    __slots__ = ('type', 'text_message', 'sender_name', 'msg_timestamp', '_formatted_msg', '_wire_frame')
+
+    def __init__(
+            self,
+            type: MessageTypes,
+            text_message: str,
+            sender_name: typing.Optional[str] = None,
+            msg_timestamp: typing.Optional[int] = None  # Epoch milliseconds
+    ):
+        self.type = type
+        self.text_message = text_message
+        self.sender_name = sender_name
+        self.msg_timestamp = msg_timestamp
+        self._formatted_msg: typing.Optional[str] = None
+        self._wire_frame: typing.Optional[bytes] = None
 
     def formatted_msg(self) -> str:
-        if self.type == MessageTypes.SYSTEM:
-            return f"[SYSTEM]: {self.text_message}"
+        if self._formatted_msg is None:
+            if self.type == MessageTypes.SYSTEM:
+                self._formatted_msg = f"[SYSTEM]: {self.text_message}"
+
+            else:
+                self._formatted_msg = f"[{_format_epoch_seconds(self.msg_timestamp // 1000)}] [{self.sender_name}]: {self.text_message}"
+
+        return self._formatted_msg
+
+    def wire_frame(self) -> bytes:
+        """ formatted_msg() encoded as a text frame, ready to send """
+        if self._wire_frame is None:
+            self._wire_frame = encode_text_frame(self.formatted_msg())
+
+        return self._wire_frame
 
-        else:
-            return f"[{self.msg_timestamp}] [{self.sender_name}]: {self.text_message}"
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, MessageInfo):
+            return NotImplemented
+        return (self.type, self.text_message, self.sender_name, self.msg_timestamp) == (other.type, other.text_message, other.sender_name, other.msg_timestamp)
 
-class SetupRoomData(BaseModel):
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return (
+            f"MessageInfo(type={self.type!r}, text_message={self.text_message!r}, "
+            f"sender_name={self.sender_name!r}, msg_timestamp={self.msg_timestamp!r})"
+        )
+
+class SetupRoomData(ControlMessage):
     room_type: str
     group_name: typing.Optional[str] = None
 
-class UploadFileData(BaseModel):
+class ConnectionAck(ControlMessage):
+    state: str  # ConnectionStates value the chat connection just entered
+    room_name: typing.Optional[str] = None  # Set when entering CHATTING
+
+class UploadFileData(ControlMessage):
     filename: str
     file_size: int
+    checksum: str  # BLAKE2b hex digest of the whole file
+    file_id: typing.Optional[str] = None  # Set to resume an unfinished upload
+    parts: int = 1  # More than one splits the file into ranges, each sent on its own connection with UPLOAD_PART
 
-class DownloadFileData(BaseModel):
+class UploadFilePartData(ControlMessage):
     file_id: str
-    dst_path: str
+    part_index: int
+
+class UploadCommitData(ControlMessage):
+    file_id: str
+
+class UploadFileOffer(ControlMessage):
+    file_id: str
+    offset: int  # Bytes the server already holds, the client sends the rest
+    length: typing.Optional[int] = None  # Bytes expected from offset, set for a single part
+    missing_parts: typing.List[int] = []  # Part indexes still to be sent, for uploads in parts
+
+class DownloadFileData(ControlMessage):
+    file_id: str
+    dst_path: typing.Optional[str] = None  # Set only to copy on the server disk instead of streaming the file
+    offset: int = 0
+    length: typing.Optional[int] = None  # Up to the end of the file when not set
+
+class DownloadFileHeader(ControlMessage):
+    file_name: str
+    file_size: int
+    offset: int = 0
+    length: int  # Body bytes following this header
+    checksum: typing.Optional[str] = None  # BLAKE2b of the whole file, missing for files uploaded before checksums
@@ -10,6 +10,8 @@ class MessageTypes(enum.Enum):
 
 class FileHandlerTypes(enum.Enum):
     UPLOAD = "UPLOAD"
+    UPLOAD_PART = "UPLOAD_PART"
+    UPLOAD_COMMIT = "UPLOAD_COMMIT"
     DOWNLOAD = "DOWNLOAD"
 
 class FileTransferStatus(enum.Enum):
@@ -17,3 +19,26 @@ class FileTransferStatus(enum.Enum):
     EXCEEDED = "EXCEEDED"
     NOT_FOUND = "NOT_FOUND"
     FAILED = "FAILED"
+
+class ServerModes(enum.Enum):
+    THREADED = "THREADED"
+    ASYNC = "ASYNC"
+    SHARDED = "SHARDED"
+
+class FrameTypes(enum.IntEnum):
+    TEXT = 1  # Usernames, chat messages, commands and statuses
+    JSON = 2  # Control data, e.g. room setup and file transfer requests
+    BINARY = 3  # Opaque bytes, e.g. message bus payloads between chat servers
+
+class ConnectionStates(enum.Enum):
+    # A chat connection goes AUTH -> SETUP -> CHATTING, then SWITCHING -> CHATTING on every /switch.
+    # The server acknowledges every transition with a ConnectionAck frame, after the frames that belong to the previous state
+    AUTH = "AUTH"  # Waiting for the username
+    SETUP = "SETUP"  # Waiting for the first room setup
+    CHATTING = "CHATTING"  # In a room, history and join notice are sent
+    SWITCHING = "SWITCHING"  # Left its room after /switch, waiting for the next room setup
+
+class SlowConsumerPolicies(enum.Enum):
+    DROP = "DROP"  # Skip broadcasts for the lagging client
+    DISCONNECT = "DISCONNECT"
+    BUFFER = "BUFFER"  # Keep queuing past the limit for a while (bounded by a timeout and a hard cap, then disconnects)
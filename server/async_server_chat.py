@@ -0,0 +1,198 @@
+import asyncio
+import queue
+from logging import getLogger
+
+from config import MessageServerConfig
+from definitions import AsyncClientInfo, MessageInfo, SetupRoomData, RoomTypes, MessageTypes, ConnectionStates
+from server.chat_server_base import ChatServerBase
+from server.db.chat_db import HistoryPage
+from server.db.message_writer import PendingMessage
+from server.metrics import BROADCAST_BYTES, BROADCAST_SECONDS, HISTORY_FETCH_SECONDS, timed
+from server.tracing import TRACER
+from server.fan_out import AsyncClientOutbox
+from utils import AsyncFrameReader, encode_text_frame, epoch_ms_now
+
+logger = getLogger(__name__)
+
+class AsyncChatServer(ChatServerBase):
+    """
+    Event loop variant of ChatServer, every client is served by a single coroutine instead of two threads,
+    so idle connections only cost a socket and a StreamReader/StreamWriter pair.
+    Blocking sqlite calls are pushed to the default executor in order to keep the loop responsive.
+    """
+    def __init__(self, *, host: str, listen_port: int):
+        self.host = host
+        self.listen_port = listen_port
+
+        self._setup_chat_state()
+
+    async def client_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client_info = None
+        frame_reader = AsyncFrameReader(reader)
+        try:
+            sender_name = (await frame_reader.read_frame()).text()
+
+            await asyncio.to_thread(self._store_user, sender_name.strip())
+
+            client_info = AsyncClientInfo(writer=writer, username=sender_name, outbox=AsyncClientOutbox(writer, username=sender_name))
+            self._enter_state(client_info, ConnectionStates.SETUP)
+
+            await self._setup_room(frame_reader, client_info)
+            await self._receive_messages(frame_reader, client_info)
+
+        except ConnectionError:
+            logger.info(f"Client {client_info.username if client_info else ''} disconnected")
+
+        except Exception:
+            logger.exception("Unexpected error while handling client")
+
+        finally:
+            if client_info and client_info.current_room:
+                self._remove_client_in_current_room(current_room=client_info.current_room, client_info=client_info)
+
+            writer.close()
+
+    async def _setup_room(self, frame_reader: AsyncFrameReader, client_info: AsyncClientInfo) -> None:
+        setup_room_data = SetupRoomData.from_json((await frame_reader.read_frame()).json())
+
+        room_type = setup_room_data.room_type
+        group_name = self.setup_room_name(setup_room_data)
+
+        client_info.join_timestamp = None
+        client_info.history_cursor = None
+
+        if RoomTypes[room_type.upper()] == RoomTypes.PRIVATE:
+            join_timestamp = epoch_ms_now()
+
+            # Check-ins of a cached room are cached as well, so joining it again doesn't touch the db
+            if (user_join_timestamp := self.history_cache.get_join_timestamp(group_name, client_info.username)) is None:
+                user_join_timestamp = await asyncio.to_thread(
+                    self._check_in_private_room,
+                    username=client_info.username,
+                    join_timestamp=join_timestamp,
+                    group_name=group_name
+                )
+
+            # Users in private rooms will get only messages came after their first joining group timestamp
+            client_info.join_timestamp = user_join_timestamp
+
+        else:
+            # A cached room is known to exist
+            if not self.history_cache.is_cached(group_name):
+                await asyncio.to_thread(self._create_room, group_name)
+
+        # Hot rooms are served from memory on the loop, a miss loads the room from the db off the loop
+        history_page = self.history_cache.peek_history_page(group_name, limit=MessageServerConfig.history_page_size, join_timestamp=client_info.join_timestamp)
+        if history_page is None:
+            history_page = await asyncio.to_thread(
+                self.history_cache.get_history_page,
+                group_name,
+                limit=MessageServerConfig.history_page_size,
+                join_timestamp=client_info.join_timestamp
+            )
+
+        client_info.history_cursor = history_page.oldest_message_id
+        client_info.has_older_history = history_page.has_more
+        self._send_history_frames(client_info=client_info, frames=history_page.frames, has_more=history_page.has_more)
+
+        if client_info.join_timestamp:
+            self.history_cache.set_join_timestamp(group_name, client_info.username, client_info.join_timestamp)
+
+        client_info.room_type = RoomTypes(room_type.upper())
+        client_info.current_room = group_name
+        self.room_registry.join(group_name, client_info)
+
+        # Coroutine is sequential, so the joining msg is always written after the history without sleeping
+        msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message=f"{client_info.username} joined '{group_name}' group")
+        await self._broadcast_to_all_active_clients_in_room(msg=msg_obj, current_room=client_info.current_room)
+        self._enter_state(client_info, ConnectionStates.CHATTING)
+
+    @timed(HISTORY_FETCH_SECONDS)
+    def _load_older_history_page(self, *, client_info: AsyncClientInfo) -> HistoryPage:
+        with self.chat_db.session() as db_conn:
+            return self._load_history_page(client_info=client_info, db_conn=db_conn, group_name=client_info.current_room)
+
+    async def _receive_messages(self, frame_reader: AsyncFrameReader, client_info: AsyncClientInfo) -> None:
+        while True:
+            msg = (await frame_reader.read_frame()).text()
+            if not msg:  # Empty messages are neither broadcast nor stored, as in the threaded server
+                continue
+
+            if msg == '/switch':
+                self._remove_client_in_current_room(current_room=client_info.current_room, client_info=client_info)
+
+                msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message=f"{client_info.username} disconnected from '{client_info.current_room}'")
+                await self._broadcast_to_all_active_clients_in_room(
+                    msg=msg_obj,
+                    current_room=client_info.current_room
+                )
+
+                client_info.current_room = None
+                self._enter_state(client_info, ConnectionStates.SWITCHING)
+                await self._setup_room(frame_reader, client_info)
+
+            elif msg == '/history':
+                if client_info.has_older_history:
+                    history_page = await asyncio.to_thread(self._load_older_history_page, client_info=client_info)
+                    self._send_history_frames(
+                        client_info=client_info,
+                        frames=[encode_text_frame(msg) for msg in history_page.messages],
+                        has_more=history_page.has_more
+                    )
+
+                else:
+                    msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message=f"No older messages in '{client_info.current_room}'")
+                    client_info.outbox.put_many([msg_obj.wire_frame()])
+
+            else:
+                trace = TRACER.start(client_info.current_room)
+                msg_timestamp = epoch_ms_now()
+                msg_obj = MessageInfo(type=MessageTypes.CHAT, text_message=msg, sender_name=client_info.username, msg_timestamp=msg_timestamp)
+
+                final_msg = await self._broadcast_to_all_active_clients_in_room(
+                    msg=msg_obj,
+                    current_room=client_info.current_room
+                )
+                if trace:
+                    trace.span("broadcast")
+
+                pending_message = PendingMessage(
+                    text_message=msg,
+                    sender_name=client_info.username,
+                    room_name=client_info.current_room,
+                    timestamp=msg_timestamp,
+                    frame=final_msg,
+                    trace=trace
+                )
+                try:
+                    self.message_writer.put(pending_message, block=False)
+                except queue.Full:
+                    # Backpressure, wait for the writer off the loop so other clients are still served
+                    await asyncio.to_thread(self.message_writer.put, pending_message)
+
+    @timed(BROADCAST_SECONDS)
+    async def _broadcast_to_all_active_clients_in_room(self, *, msg: MessageInfo, current_room: str) -> bytes:
+        final_msg = msg.wire_frame()
+        if clients_in_room := self.room_registry.members(current_room):
+            for client in clients_in_room:
+                client.outbox.put(final_msg)
+            BROADCAST_BYTES.inc(len(final_msg) * len(clients_in_room))
+        return final_msg
+
+    def _remove_client_in_current_room(self, *, current_room: str, client_info: AsyncClientInfo) -> None:
+        self.room_registry.leave(current_room, client_info)
+
+    async def start(self) -> None:
+        server = await asyncio.start_server(
+            self.client_handler,
+            host=self.host,
+            port=self.listen_port,
+            backlog=MessageServerConfig.async_listener_limit_number
+        )
+        print("Chat Server started (async mode)...")
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await asyncio.to_thread(self.message_writer.close)
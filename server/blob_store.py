@@ -0,0 +1,91 @@
+import os
+import typing
+from logging import getLogger
+
+from config import FileServerConfig
+from server.db.chat_db import ChatDB, Blob
+from utils import epoch_ms_now
+
+logger = getLogger(__name__)
+
+def blobs_root_dir() -> str:
+    return os.path.join(FileServerConfig.upload_dir_dst_path(), 'blobs')
+
+def blob_path(root_dir: str, checksum: str) -> str:
+    # Two levels of 256 dirs keep every directory small
+    return os.path.join(root_dir, checksum[:2], checksum[2:4], checksum)
+
+class BlobStore:
+    """
+    Content addressed storage for uploads, a file is kept once per checksum under <root>/<ab>/<cd>/<checksum>
+    however many file ids point to it. Blobs are counted in the db (refcount, last download) and the least
+    recently downloaded ones are evicted whenever the count or total size limits are exceeded.
+    """
+    def __init__(self, *, chat_db: ChatDB, root_dir: str):
+        self.chat_db = chat_db
+        self.root_dir = root_dir
+
+    def blob_path(self, checksum: str) -> str:
+        return blob_path(self.root_dir, checksum)
+
+    def store(self, *, file_path: str, file_id: str, file_size: int, checksum: str) -> str:
+        """
+        Adds a verified file under file_id and returns its blob path. file_path is moved into the store,
+        or removed if a file with the same content is already there.
+        """
+        blob_path = self.blob_path(checksum)
+
+        with self.chat_db.session() as db_conn:
+            # The upsert takes the db write lock until commit, so concurrent uploads of the same content are serialized
+            refcount = self.chat_db.add_blob_reference(
+                db_conn=db_conn,
+                checksum=checksum,
+                blob_path=blob_path,
+                file_size=file_size,
+                accessed_at=epoch_ms_now()
+            )
+            if refcount == 1:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(file_path, blob_path)
+            else:
+                os.remove(file_path)
+                logger.info(f"{file_id} has the same content as {refcount - 1} stored files, blob is reused")
+
+            self.chat_db.store_file_in_files(db_conn=db_conn, file_path=blob_path, file_id=file_id, file_size=file_size, checksum=checksum)
+
+        self.evict(keep_checksum=checksum)
+        return blob_path
+
+    def touch(self, checksum: str) -> None:
+        with self.chat_db.session() as db_conn:
+            self.chat_db.touch_blob(db_conn=db_conn, checksum=checksum, accessed_at=epoch_ms_now())
+
+    def evict(self, *, keep_checksum: str) -> typing.List[Blob]:
+        """ Removes least recently downloaded blobs (and their file ids) until the configured limits hold """
+        evicted_blobs: typing.List[Blob] = []
+
+        with self.chat_db.session() as db_conn:
+            blobs_count, blobs_size = self.chat_db.get_blobs_usage(db_conn=db_conn)
+            if blobs_count <= FileServerConfig.max_files_stored_in_uploads and blobs_size <= FileServerConfig.max_uploads_size:
+                return evicted_blobs
+
+            for blob in self.chat_db.get_least_recently_used_blobs(db_conn=db_conn, exclude_checksum=keep_checksum):
+                if blobs_count <= FileServerConfig.max_files_stored_in_uploads and blobs_size <= FileServerConfig.max_uploads_size:
+                    break
+
+                evicted_blobs.append(blob)
+                blobs_count -= 1
+                blobs_size -= blob.file_size
+
+            for blob in evicted_blobs:
+                self.chat_db.delete_blob(db_conn=db_conn, checksum=blob.checksum)
+
+        # Removed after commit so no file id points at a missing blob, a download already streaming keeps its open file
+        for blob in evicted_blobs:
+            try:
+                os.remove(blob.blob_path)
+            except FileNotFoundError:
+                pass
+            logger.info(f"Evicted blob {blob.checksum} ({blob.file_size} bytes)")
+
+        return evicted_blobs
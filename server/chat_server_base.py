@@ -0,0 +1,109 @@
+import sqlite3
+import typing
+
+from config import MessageServerConfig
+from definitions import AsyncClientInfo, ClientInfo, ConnectionAck, ConnectionStates, MessageInfo, MessageTypes, RoomTypes, SetupRoomData
+from server.db.chat_db import ChatDB, HistoryPage
+from server.db.message_writer import MessageWriter, PendingMessage
+from server.history_cache import HistoryCache
+from server.metrics import METRICS
+from server.room_registry import RoomRegistry
+from utils import encode_json_frame
+
+AnyClientInfo = typing.Union[ClientInfo, AsyncClientInfo]
+
+class ChatServerBase:
+    """
+    Room setup and db helpers shared by the threaded ChatServer and the AsyncChatServer.
+    The db helpers block on sqlite, the async server runs them off the loop with asyncio.to_thread.
+    """
+    def _setup_chat_state(self) -> None:
+        self.room_registry: RoomRegistry = RoomRegistry()
+
+        self.chat_db = ChatDB()
+        with self.chat_db.session() as db_conn:
+            self.chat_db.setup_database(db_conn=db_conn)
+
+        self.history_cache = HistoryCache(chat_db=self.chat_db)
+        self.message_writer = MessageWriter(chat_db=self.chat_db, on_stored=self._on_messages_stored)
+
+        # Read on scrape only
+        METRICS.stats_gauges("chat_history_cache", "History cache of the chat server", self.history_cache.stats)
+        METRICS.stats_gauges("chat_room_registry", "Rooms of the chat server", self.room_registry.stats)
+        METRICS.gauge("chat_message_writer_pending", "Chat messages waiting to be stored", lambda: self.message_writer.pending)
+        METRICS.gauge("chat_outbox_pending_bytes", "Bytes queued to clients and not sent yet", self._outbox_pending_bytes)
+
+    def _on_messages_stored(self, messages: typing.Sequence[PendingMessage], message_ids: typing.Optional[range]) -> None:
+        self.history_cache.add_stored_messages(messages, message_ids)
+
+    def _outbox_pending_bytes(self) -> int:
+        return sum(client.outbox.pending_bytes for room_name in self.room_registry.occupancy() for client in self.room_registry.members(room_name))
+
+    @staticmethod
+    def _enter_state(client_info: AnyClientInfo, state: ConnectionStates) -> None:
+        client_info.state = state
+        ack = ConnectionAck(state=state.value, room_name=client_info.current_room if state == ConnectionStates.CHATTING else None)
+        client_info.outbox.put_many([encode_json_frame(ack.as_dict())])
+
+    @staticmethod
+    def setup_room_name(setup_room_data: SetupRoomData) -> str:
+        # Private rooms are named by the user, the global room by its type
+        if RoomTypes[setup_room_data.room_type.upper()] == RoomTypes.PRIVATE:
+            return setup_room_data.group_name
+        return setup_room_data.room_type
+
+    def _store_user(self, sender_name: str) -> None:
+        with self.chat_db.session() as db_conn:
+            self.chat_db.store_user(db_conn=db_conn, sender_name=sender_name)
+
+    def _create_room(self, group_name: str) -> None:
+        with self.chat_db.session() as db_conn:
+            self.chat_db.create_room(db_conn=db_conn, room_name=group_name)
+
+    def _check_in_private_room(self, *, username: str, join_timestamp: int, group_name: str) -> int:
+        with self.chat_db.session() as db_conn:
+            room_id = self.chat_db.get_room_id_from_rooms(db_conn=db_conn, room_name=group_name)
+
+            user_join_timestamp = self.chat_db.get_user_join_timestamp(
+                db_conn=db_conn,
+                sender_name=username,
+                room_name=group_name
+            )
+            # If room still not exist, then create and add to 'checkin_room' table
+            if not room_id:
+                self.chat_db.create_room(db_conn=db_conn, room_name=group_name)
+                user_join_timestamp = join_timestamp
+                self.chat_db.create_user_checkin_room(db_conn=db_conn, sender_name=username, room_name=group_name, join_timestamp=user_join_timestamp)
+
+            # If room exists but user haven't checkin to this room yet
+            if not user_join_timestamp:
+                user_join_timestamp = join_timestamp
+                self.chat_db.create_user_checkin_room(db_conn=db_conn, sender_name=username, room_name=group_name, join_timestamp=user_join_timestamp)
+
+            return user_join_timestamp
+
+    def _load_history_page(self, *, client_info: AnyClientInfo, db_conn: sqlite3.Connection, group_name: str) -> HistoryPage:
+        # Next older page from the client's cursor (kept per client, reset on every room setup)
+        history_page = self.chat_db.get_history_page(
+            db_conn=db_conn,
+            room_name=group_name,
+            limit=MessageServerConfig.history_page_size,
+            join_timestamp=client_info.join_timestamp,
+            before_message_id=client_info.history_cursor
+        )
+        client_info.history_cursor = history_page.oldest_message_id
+        client_info.has_older_history = history_page.has_more
+        return history_page
+
+    @staticmethod
+    def _send_history_frames(*, client_info: AnyClientInfo, frames: typing.List[bytes], has_more: bool) -> None:
+        if has_more:
+            msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message="Enter /history to load older messages")
+            frames = [msg_obj.wire_frame(), *frames]
+
+        elif not frames:
+            msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message=f"No messages in this chat yet ...")
+            frames = [msg_obj.wire_frame()]
+
+        # The whole page is queued at once and goes out in a single gathered write
+        client_info.outbox.put_many(frames)
@@ -1 +1,2 @@
-from server.db.chat_db import ChatDB
\ No newline at end of file
+from server.db.chat_db import ChatDB, HistoryPage, FileRecord, PartialUpload, Blob
+from server.db.message_writer import MessageWriter, PendingMessage
\ No newline at end of file
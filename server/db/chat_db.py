@@ -1,139 +1,229 @@
 import os
+import queue
 import sqlite3
+import threading
 import typing
 from logging import getLogger
 
 from definitions import MessageInfo, MessageTypes
 from contextlib import contextmanager
+from server.db.migrations import migrate
+from server.metrics import timed_methods
 
 logger = getLogger(__name__)
 
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+class HistoryPage(typing.NamedTuple):
+    messages: typing.List[str]  # Formatted, oldest first
+    oldest_message_id: typing.Optional[int]  # Keyset cursor for the next (older) page
+    has_more: bool
+
+class FileRecord(typing.NamedTuple):
+    file_path: str
+    file_size: typing.Optional[int]  # NULL for files uploaded before checksums were stored
+    checksum: typing.Optional[str]
+
+class PartialUpload(typing.NamedTuple):
+    file_id: str
+    file_name: str
+    file_size: int
+    checksum: str
+    parts: int
+
+    def part_range(self, part_index: int) -> typing.Tuple[int, int]:
+        """ (offset, length) of a part, every part but the last has the same size """
+        part_size = -(-self.file_size // self.parts)
+        offset = min(part_index * part_size, self.file_size)
+        return offset, min(part_size, self.file_size - offset)
+
+class Blob(typing.NamedTuple):
+    checksum: str
+    blob_path: str
+    file_size: int
+
 class ChatDBConfig:
     db_path: str = os.path.join(os.getcwd(),'db', 'chat.db')
-
+    pool_size: int = 8
+    busy_timeout_seconds: float = 5.0
+    cached_statements: int = 256  # Per connection cache of compiled statements, reused as long as the connection lives
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"  # Safe with WAL, only the last transactions may roll back after a power loss
+    cache_size_kib: int = 16_384
+    writer_queue_size: int = 10_000
+    writer_batch_size: int = 500
+    writer_flush_interval_ms: int = 50
+    history_fetch_size: int = 1_000
+    id_cache_size: int = 100_000  # User and room ids per name cache, cleared when it outgrows this
+
+@timed_methods("chat_db_seconds", "Time spent in ChatDB methods", exclude=("session", "forget_ids", "close"))
 class ChatDB:
-    def __init__(self):
+    def __init__(self, *, pool_size: int = ChatDBConfig.pool_size):
         self.db_path = ChatDBConfig.db_path
+        self.pool_size = pool_size
+
+        self._pool: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=pool_size)
+        self._created_connections = 0
+        self._pool_lock = threading.Lock()
+
+        # Users and rooms are never renamed or deleted, so their ids are cached for the life of the process.
+        # Only found or created ids are cached, a missing name is looked up again next time.
+        self._user_ids: typing.Dict[str, int] = {}
+        self._room_ids: typing.Dict[str, int] = {}
 
     @contextmanager
-    def session(self):
-        connection = sqlite3.connect(self.db_path)
+    def session(self) -> typing.Generator[sqlite3.Connection, None, None]:
+        connection = self._acquire_connection()
         try:
             yield connection
-        finally:
             connection.commit()
-            connection.close()
 
-    def setup_database(self, db_conn: sqlite3.Connection):
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-        cursor = db_conn.cursor()
+        except Exception:
+            connection.rollback()
+            self.forget_ids()  # Ids created by the rolled back transaction don't exist anymore
+            raise
 
-        cursor.execute('''
-           CREATE TABLE IF NOT EXISTS users (
-               id INTEGER PRIMARY KEY AUTOINCREMENT,
-               username TEXT UNIQUE NOT NULL
-               );
-           ''')
+        finally:
+            self._pool.put(connection)
 
-        cursor.execute('''
-           CREATE TABLE IF NOT EXISTS rooms (
-               id INTEGER PRIMARY KEY AUTOINCREMENT,
-               room_name TEXT UNIQUE NOT NULL
-               );
-           ''')
+    def forget_ids(self) -> None:
+        self._user_ids.clear()
+        self._room_ids.clear()
 
-        cursor.execute('''
-           CREATE TABLE IF NOT EXISTS messages (
-               id INTEGER PRIMARY KEY AUTOINCREMENT,
-               text_message TEXT NOT NULL,
-               sender_id INTEGER NOT NULL,
-               room_id INTEGER NOT NULL,
-               timestamp DATETIME NOT NULL,
-               FOREIGN KEY (sender_id) REFERENCES users(id), 
-               FOREIGN KEY (room_id) REFERENCES rooms(id) 
-               );
-           ''')
+    def close(self) -> None:
+        while self._created_connections:
+            self._pool.get().close()
+            self._created_connections -= 1
 
-        cursor.execute('''
-             CREATE TABLE IF NOT EXISTS room_checkins (
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 sender_id INTEGER NOT NULL,
-                 room_id INTEGER NOT NULL,
-                 join_timestamp DATETIME NOT NULL,
-                 FOREIGN KEY (sender_id) REFERENCES users(id), 
-                 FOREIGN KEY (room_id) REFERENCES rooms(id) 
-                 );
-             ''')
+    def _acquire_connection(self) -> sqlite3.Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
 
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            file_path TEXT NOT NULL,
-            file_id TEXT NOT NULL
-            );
-        ''')
+        with self._pool_lock:
+            if self._created_connections < self.pool_size:
+                self._created_connections += 1
+                return self._connect()
 
-    @classmethod
-    def send_previous_messages_in_room(cls, *, db_conn: sqlite3.Connection, room_name: str, join_timestamp: typing.Optional[str] = None) -> typing.Generator[str, None, None]:
-        cursor = db_conn.cursor()
-
-        room_id = cls.get_room_id_from_rooms(db_conn=db_conn, room_name=room_name)
-
-        if join_timestamp:
-            cursor.execute('''
-              SELECT text_message, sender_id, timestamp FROM messages
-               WHERE room_id = ? 
-               AND timestamp > ? 
-               ORDER BY timestamp ASC
-               ''', (room_id, join_timestamp))
-
-        else:
-            cursor.execute('''
-                 SELECT text_message, sender_id, timestamp FROM messages
-                  WHERE room_id = ? 
-                  ORDER BY timestamp ASC
-                  ''', (room_id,))
-
-        if old_messages := cursor.fetchall():
-            for text_message, sender_id, timestamp in old_messages:
-                 old_msg_sender = cls._get_sender_name_from_users(sender_id=sender_id, cursor=cursor)
-                 msg = MessageInfo(type=MessageTypes.CHAT,text_message=text_message, sender_name=old_msg_sender, msg_timestamp=timestamp)
-                 yield msg.formatted_msg()
-        else:
-            return None
+        # Pool is exhausted, wait for a session to return its connection
+        return self._pool.get()
 
-    @classmethod
-    def store_user(cls, *, db_conn: sqlite3.Connection, sender_name: str):
-        cursor = db_conn.cursor()
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
 
-        cursor.execute('SELECT username from users WHERE username = ?', (sender_name,))
-        username = cursor.fetchone()
+        connection = sqlite3.connect(
+            self.db_path,
+            timeout=ChatDBConfig.busy_timeout_seconds,
+            cached_statements=ChatDBConfig.cached_statements,
+            check_same_thread=False  # Connections move between threads, but a single session owns each one at a time
+        )
+        connection.execute(f'PRAGMA journal_mode = {ChatDBConfig.journal_mode}')
+        connection.execute(f'PRAGMA synchronous = {ChatDBConfig.synchronous}')
+        connection.execute(f'PRAGMA cache_size = -{ChatDBConfig.cache_size_kib}')
+        connection.execute('PRAGMA temp_store = MEMORY')
+        return connection
 
-        if not username:
-            cursor.execute('INSERT INTO users (username) VALUES (?)', (sender_name,))
+    def setup_database(self, db_conn: sqlite3.Connection):
+        # Creates the schema on a new database and migrates existing chat.db files in place, once at server startup
+        migrate(db_conn)
 
     @classmethod
-    def create_room(cls, *, db_conn: sqlite3.Connection, room_name: str):
+    def get_history_page(
+            cls,
+            *,
+            db_conn: sqlite3.Connection,
+            room_name: str,
+            limit: int,
+            join_timestamp: typing.Optional[int] = None,
+            before_message_id: typing.Optional[int] = None
+    ) -> HistoryPage:
+        # Keyset pagination walks the (room_id, id) index backwards from the cursor, so any page costs the same
+        # regardless of the room size. '+' keeps the planner off the timestamp index for the join filter.
         cursor = db_conn.cursor()
-        cursor.execute('INSERT INTO rooms (room_name) VALUES (?) ON CONFLICT(room_name) DO NOTHING', (room_name,))
-
-    @classmethod
-    def store_message(cls, *, db_conn: sqlite3.Connection, text_message: str, sender_name: str, room_name: str, timestamp: str):
+        cursor.execute('''
+            SELECT messages.id, messages.text_message, users.username, messages.timestamp FROM messages
+             JOIN rooms ON rooms.id = messages.room_id
+             JOIN users ON users.id = messages.sender_id
+             WHERE rooms.room_name = ?
+             AND +messages.timestamp > ?
+             AND messages.id < ?
+             ORDER BY messages.id DESC
+             LIMIT ?
+             ''', (room_name, join_timestamp or -1, before_message_id or MAX_MESSAGE_ID, limit + 1))
+
+        rows = cursor.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        messages = [
+            MessageInfo(type=MessageTypes.CHAT, text_message=text_message, sender_name=sender_name, msg_timestamp=timestamp).formatted_msg()
+            for _, text_message, sender_name, timestamp in reversed(rows)
+        ]
+        return HistoryPage(messages=messages, oldest_message_id=rows[-1][0] if rows else before_message_id, has_more=has_more)
+
+    def store_user(self, *, db_conn: sqlite3.Connection, sender_name: str) -> int:
+        return self._get_or_create_id(db_conn=db_conn, table='users', column='username', name=sender_name, ids=self._user_ids)
+
+    def create_room(self, *, db_conn: sqlite3.Connection, room_name: str) -> int:
+        return self._get_or_create_id(db_conn=db_conn, table='rooms', column='room_name', name=room_name, ids=self._room_ids)
+
+    def store_message(self, *, db_conn: sqlite3.Connection, text_message: str, sender_name: str, room_name: str, timestamp: int):
+        # Cached ids make a stored message a single insert
         cursor = db_conn.cursor()
 
-        sender_id = cls._get_sender_id_from_users(sender_name=sender_name, cursor=cursor)
-        room_id = cls.get_room_id_from_rooms(db_conn=db_conn, room_name=room_name)
+        sender_id = self._get_sender_id_from_users(db_conn=db_conn, sender_name=sender_name)
+        room_id = self._get_room_id(db_conn=db_conn, room_name=room_name)
 
         cursor.execute('''
            INSERT INTO messages (text_message, sender_id, room_id, timestamp)
            VALUES (?,?,?,?)''', (text_message, sender_id, room_id, timestamp))
 
     @classmethod
-    def create_user_checkin_room(cls, *, db_conn: sqlite3.Connection, sender_name: str, room_name: str, join_timestamp: str):
+    def get_latest_messages(cls, *, db_conn: sqlite3.Connection, room_name: str, limit: int) -> typing.List[typing.Tuple[int, int, str]]:
+        """ (message id, timestamp, formatted message) of the newest messages in the room, oldest first """
+        cursor = db_conn.cursor()
+        cursor.execute('''
+            SELECT messages.id, messages.text_message, users.username, messages.timestamp FROM messages
+             JOIN rooms ON rooms.id = messages.room_id
+             JOIN users ON users.id = messages.sender_id
+             WHERE rooms.room_name = ?
+             ORDER BY messages.id DESC
+             LIMIT ?
+             ''', (room_name, limit))
+
+        return [
+            (message_id, timestamp, MessageInfo(type=MessageTypes.CHAT, text_message=text_message, sender_name=sender_name, msg_timestamp=timestamp).formatted_msg())
+            for message_id, text_message, sender_name, timestamp in reversed(cursor.fetchall())
+        ]
+
+    def store_messages(self, *, db_conn: sqlite3.Connection, messages: typing.Sequence[typing.Tuple[str, str, str, int]]) -> typing.Optional[range]:
+        """
+        Sender and room ids come from the id cache (the db on a miss), so a whole batch is a single executemany.
+        Returns the ids of the stored messages in order, or None if some weren't stored (unknown sender or room).
+        """
+        rows = []
+        for text_message, sender_name, room_name, timestamp in messages:
+            sender_id = self._get_sender_id_from_users(db_conn=db_conn, sender_name=sender_name)
+            room_id = self._get_room_id(db_conn=db_conn, room_name=room_name)
+            if sender_id is not None and room_id is not None:
+                rows.append((text_message, sender_id, room_id, timestamp))
+
         cursor = db_conn.cursor()
+        cursor.executemany('INSERT INTO messages (text_message, sender_id, room_id, timestamp) VALUES (?,?,?,?)', rows)
 
-        sender_id = cls._get_sender_id_from_users(sender_name=sender_name, cursor=cursor)
-        room_id = cls.get_room_id_from_rooms(db_conn=db_conn, room_name=room_name)
+        if len(rows) != len(messages):
+            return None
+
+        # One transaction holds the write lock, so AUTOINCREMENT ids of the batch are consecutive
+        last_message_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return range(last_message_id - len(messages) + 1, last_message_id + 1)
+
+    def create_user_checkin_room(self, *, db_conn: sqlite3.Connection, sender_name: str, room_name: str, join_timestamp: int):
+        cursor = db_conn.cursor()
+
+        sender_id = self._get_sender_id_from_users(db_conn=db_conn, sender_name=sender_name)
+        room_id = self._get_room_id(db_conn=db_conn, room_name=room_name)
 
         cursor.execute(
             '''
@@ -143,12 +233,11 @@ class ChatDB:
             (sender_id, room_id, join_timestamp)
         )
 
-    @classmethod
-    def get_user_join_timestamp(cls, *, db_conn: sqlite3.Connection, sender_name: str, room_name: str) -> typing.Optional[str]:
+    def get_user_join_timestamp(self, *, db_conn: sqlite3.Connection, sender_name: str, room_name: str) -> typing.Optional[int]:
         cursor = db_conn.cursor()
 
-        sender_id = cls._get_sender_id_from_users(sender_name=sender_name, cursor=cursor)
-        room_id = cls.get_room_id_from_rooms(db_conn=db_conn, room_name=room_name)
+        sender_id = self._get_sender_id_from_users(db_conn=db_conn, sender_name=sender_name)
+        room_id = self._get_room_id(db_conn=db_conn, room_name=room_name)
 
         cursor.execute(
             'SELECT join_timestamp FROM room_checkins WHERE sender_id = ? AND room_id = ?',
@@ -161,42 +250,145 @@ class ChatDB:
         return user_join_timestamp[0]
 
     @classmethod
-    def store_file_in_files(cls, *, db_conn: sqlite3.Connection, file_path: str, file_id: str):
+    def store_file_in_files(
+            cls,
+            *,
+            db_conn: sqlite3.Connection,
+            file_path: str,
+            file_id: str,
+            file_size: typing.Optional[int] = None,
+            checksum: typing.Optional[str] = None
+    ):
         cursor = db_conn.cursor()
         cursor.execute('''
-               INSERT INTO files (file_path, file_id)
-               VALUES (?,?)''', (file_path, file_id))
+               INSERT INTO files (file_path, file_id, file_size, checksum)
+               VALUES (?,?,?,?)''', (file_path, file_id, file_size, checksum))
 
     @classmethod
-    def get_file_path_by_file_id(cls, *, db_conn: sqlite3.Connection, file_id: str) -> typing.Optional[str]:
+    def get_file_by_file_id(cls, *, db_conn: sqlite3.Connection, file_id: str) -> typing.Optional[FileRecord]:
         cursor = db_conn.cursor()
-        cursor.execute('SELECT file_path FROM files WHERE file_id = ?', (file_id,))
+        cursor.execute('SELECT file_path, file_size, checksum FROM files WHERE file_id = ?', (file_id,))
         record = cursor.fetchone()
         if record:
-            return record[0]
+            return FileRecord(*record)
         return None
 
     @classmethod
-    def get_room_id_from_rooms(cls, *, db_conn: sqlite3.Connection, room_name: str) -> typing.Optional[int]:
+    def store_partial_upload(
+            cls,
+            *,
+            db_conn: sqlite3.Connection,
+            file_id: str,
+            file_name: str,
+            file_size: int,
+            checksum: str,
+            created_at: int,
+            parts: int = 1
+    ):
         cursor = db_conn.cursor()
+        cursor.execute('''
+               INSERT INTO partial_uploads (file_id, file_name, file_size, checksum, created_at, parts)
+               VALUES (?,?,?,?,?,?)''', (file_id, file_name, file_size, checksum, created_at, parts))
 
-        cursor.execute('SELECT id FROM rooms WHERE room_name = ?', (room_name,))
+    @classmethod
+    def get_partial_upload(cls, *, db_conn: sqlite3.Connection, file_id: str) -> typing.Optional[PartialUpload]:
+        cursor = db_conn.cursor()
+        cursor.execute('SELECT file_id, file_name, file_size, checksum, parts FROM partial_uploads WHERE file_id = ?', (file_id,))
         record = cursor.fetchone()
-
         if record:
-            return record[0]
+            return PartialUpload(*record)
         return None
 
     @classmethod
-    def _get_sender_id_from_users(cls, *, sender_name: str, cursor: sqlite3.Cursor) -> int:
-        cursor.execute('SELECT id FROM users where username = ?', (sender_name,))
+    def delete_partial_upload(cls, *, db_conn: sqlite3.Connection, file_id: str):
+        cursor = db_conn.cursor()
+        cursor.execute('DELETE FROM partial_uploads WHERE file_id = ?', (file_id,))
+        cursor.execute('DELETE FROM partial_upload_parts WHERE file_id = ?', (file_id,))
+
+    @classmethod
+    def store_upload_part(cls, *, db_conn: sqlite3.Connection, file_id: str, part_index: int):
+        cursor = db_conn.cursor()
+        cursor.execute('INSERT OR IGNORE INTO partial_upload_parts (file_id, part_index) VALUES (?,?)', (file_id, part_index))
+
+    @classmethod
+    def get_uploaded_parts(cls, *, db_conn: sqlite3.Connection, file_id: str) -> typing.Set[int]:
+        cursor = db_conn.cursor()
+        cursor.execute('SELECT part_index FROM partial_upload_parts WHERE file_id = ?', (file_id,))
+        return {part_index for part_index, in cursor.fetchall()}
+
+    @classmethod
+    def add_blob_reference(cls, *, db_conn: sqlite3.Connection, checksum: str, blob_path: str, file_size: int, accessed_at: int) -> int:
+        """ Counts one more file of this content, returns the refcount (1 means the blob is new) """
+        cursor = db_conn.cursor()
+        cursor.execute('''
+               INSERT INTO blobs (checksum, blob_path, file_size, refcount, last_accessed)
+               VALUES (?,?,?,1,?)
+               ON CONFLICT(checksum) DO UPDATE SET refcount = refcount + 1, last_accessed = excluded.last_accessed
+               RETURNING refcount''', (checksum, blob_path, file_size, accessed_at))
         return cursor.fetchone()[0]
 
     @classmethod
-    def _get_sender_name_from_users(cls, *, sender_id: int, cursor: sqlite3.Cursor) -> typing.Optional[str]:
-        cursor.execute('SELECT username FROM users where id = ?', (sender_id,))
-        record = cursor.fetchone()
+    def touch_blob(cls, *, db_conn: sqlite3.Connection, checksum: str, accessed_at: int):
+        cursor = db_conn.cursor()
+        cursor.execute('UPDATE blobs SET last_accessed = ? WHERE checksum = ?', (accessed_at, checksum))
+
+    @classmethod
+    def get_blobs_usage(cls, *, db_conn: sqlite3.Connection) -> typing.Tuple[int, int]:
+        """ (number of blobs, their total size in bytes) """
+        cursor = db_conn.cursor()
+        cursor.execute('SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM blobs')
+        return cursor.fetchone()
+
+    @classmethod
+    def get_least_recently_used_blobs(cls, *, db_conn: sqlite3.Connection, exclude_checksum: str) -> typing.Generator[Blob, None, None]:
+        cursor = db_conn.cursor()
+        cursor.execute('''
+               SELECT checksum, blob_path, file_size FROM blobs
+                WHERE checksum != ?
+                ORDER BY last_accessed ASC''', (exclude_checksum,))
+        while blobs := cursor.fetchmany(ChatDBConfig.history_fetch_size):
+            for blob in blobs:
+                yield Blob(*blob)
+
+    @classmethod
+    def delete_blob(cls, *, db_conn: sqlite3.Connection, checksum: str):
+        # Every file id of this content goes with it
+        cursor = db_conn.cursor()
+        cursor.execute('DELETE FROM files WHERE checksum = ?', (checksum,))
+        cursor.execute('DELETE FROM blobs WHERE checksum = ?', (checksum,))
+
+    def get_room_id_from_rooms(self, *, db_conn: sqlite3.Connection, room_name: str) -> typing.Optional[int]:
+        return self._get_room_id(db_conn=db_conn, room_name=room_name)
+
+    def _get_room_id(self, *, db_conn: sqlite3.Connection, room_name: str) -> typing.Optional[int]:
+        # Used by the other methods, so they don't time the lookup a second time
+        return self._get_id(db_conn=db_conn, table='rooms', column='room_name', name=room_name, ids=self._room_ids)
+
+    def _get_sender_id_from_users(self, *, db_conn: sqlite3.Connection, sender_name: str) -> typing.Optional[int]:
+        return self._get_id(db_conn=db_conn, table='users', column='username', name=sender_name, ids=self._user_ids)
+
+    @staticmethod
+    def _cache_id(ids: typing.Dict[str, int], name: str, row_id: int) -> int:
+        if len(ids) >= ChatDBConfig.id_cache_size:
+            ids.clear()
+        ids[name] = row_id
+        return row_id
+
+    def _get_id(self, *, db_conn: sqlite3.Connection, table: str, column: str, name: str, ids: typing.Dict[str, int]) -> typing.Optional[int]:
+        if (row_id := ids.get(name)) is not None:
+            return row_id
+
+        record = db_conn.execute(f'SELECT id FROM {table} WHERE {column} = ?', (name,)).fetchone()
         if record:
-            return record[0]
+            return self._cache_id(ids, name, record[0])
         return None
 
+    def _get_or_create_id(self, *, db_conn: sqlite3.Connection, table: str, column: str, name: str, ids: typing.Dict[str, int]) -> int:
+        if (row_id := ids.get(name)) is not None:
+            return row_id
+
+        # DO NOTHING returns no row for an existing name, only then it is looked up
+        record = db_conn.execute(f'INSERT INTO {table} ({column}) VALUES (?) ON CONFLICT({column}) DO NOTHING RETURNING id', (name,)).fetchone()
+        if record is None:
+            record = db_conn.execute(f'SELECT id FROM {table} WHERE {column} = ?', (name,)).fetchone()
+        return self._cache_id(ids, name, record[0])
@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+import typing
+from logging import getLogger
+
+from server.db.chat_db import ChatDB, ChatDBConfig
+from server.tracing import TRACER, MessageTrace
+
+logger = getLogger(__name__)
+
+class PendingMessage(typing.NamedTuple):
+    text_message: str
+    sender_name: str
+    room_name: str
+    timestamp: int  # Epoch milliseconds
+    frame: typing.Optional[bytes] = None  # Encoded broadcast frame, handed to on_stored with the message id
+    trace: typing.Optional[MessageTrace] = None  # Set while tracing is enabled, spans are added until on_stored is done
+
+_STOP = object()
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages.
+    Messages are queued by the receiving threads and a single writer thread stores them in batches, each batch is
+    one transaction which is flushed after batch_size messages or flush_interval_ms, whichever comes first.
+    A full queue blocks (or raises queue.Full) the producers, so memory stays bounded when the disk can't keep up.
+    """
+    def __init__(
+            self,
+            *,
+            chat_db: ChatDB,
+            queue_size: int = ChatDBConfig.writer_queue_size,
+            batch_size: int = ChatDBConfig.writer_batch_size,
+            flush_interval_ms: int = ChatDBConfig.writer_flush_interval_ms,
+            on_stored: typing.Optional[typing.Callable[[typing.Sequence[PendingMessage], typing.Optional[range]], None]] = None
+    ):
+        self.chat_db = chat_db
+        self.on_stored = on_stored  # Called from the writer thread after every committed batch, with the message ids
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+
+        self._writer_thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._writer_thread.start()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def put(self, message: PendingMessage, *, block: bool = True, timeout: typing.Optional[float] = None) -> None:
+        if self._closed:
+            raise RuntimeError("Message writer is closed")
+        self._queue.put(message, block=block, timeout=timeout)
+
+    def close(self) -> None:
+        # Everything queued before the stop marker is flushed before the writer thread exits
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer_thread.join()
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch, stopped = self._collect_batch()
+            if batch:
+                self._flush(batch)
+
+    def _collect_batch(self) -> typing.Tuple[typing.List[PendingMessage], bool]:
+        batch = []
+
+        first_message = self._queue.get()
+        if first_message is _STOP:
+            return batch, True
+        batch.append(first_message)
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                message = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if message is _STOP:
+                return batch, True
+            batch.append(message)
+
+        return batch, False
+
+    def _flush(self, batch: typing.List[PendingMessage]) -> None:
+        traces = [message.trace for message in batch if message.trace]
+        for trace in traces:
+            trace.span("queued")
+
+        try:
+            with self.chat_db.session() as db_conn:
+                message_ids = self.chat_db.store_messages(db_conn=db_conn, messages=[message[:4] for message in batch])
+
+        except Exception:
+            trace_ids = f" (traces {', '.join(trace.trace_id for trace in traces)})" if traces else ""
+            logger.exception(f"Failed to store batch of {len(batch)} messages{trace_ids}")
+            return
+
+        for trace in traces:
+            trace.span("stored")
+
+        if self.on_stored:
+            try:
+                self.on_stored(batch, message_ids)
+            except Exception:
+                logger.exception("on_stored callback failed")
+
+        for trace in traces:
+            trace.span("on_stored")
+            TRACER.finish(trace)
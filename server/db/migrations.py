@@ -0,0 +1,262 @@
+import datetime
+import os
+import sqlite3
+import typing
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Legacy text timestamps were written with datetime.now(), so they are converted as local time
+LEGACY_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _create_base_schema(cursor: sqlite3.Cursor) -> None:
+    # Original schema, 'IF NOT EXISTS' keeps it a no-op for databases created before migrations were tracked
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS users (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           username TEXT UNIQUE NOT NULL
+           );
+       ''')
+
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS rooms (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           room_name TEXT UNIQUE NOT NULL
+           );
+       ''')
+
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS messages (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           text_message TEXT NOT NULL,
+           sender_id INTEGER NOT NULL,
+           room_id INTEGER NOT NULL,
+           timestamp DATETIME NOT NULL,
+           FOREIGN KEY (sender_id) REFERENCES users(id), 
+           FOREIGN KEY (room_id) REFERENCES rooms(id) 
+           );
+       ''')
+
+    cursor.execute('''
+         CREATE TABLE IF NOT EXISTS room_checkins (
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             sender_id INTEGER NOT NULL,
+             room_id INTEGER NOT NULL,
+             join_timestamp DATETIME NOT NULL,
+             FOREIGN KEY (sender_id) REFERENCES users(id), 
+             FOREIGN KEY (room_id) REFERENCES rooms(id) 
+             );
+         ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_path TEXT NOT NULL,
+        file_id TEXT NOT NULL
+        );
+    ''')
+
+
+def _legacy_timestamp_to_epoch_ms(value: typing.Union[str, int, None]) -> typing.Optional[int]:
+    if value is None or isinstance(value, int):
+        return value
+    return int(datetime.datetime.strptime(value, LEGACY_TIMESTAMP_FORMAT).timestamp() * 1000)
+
+
+def _epoch_ms_timestamps(cursor: sqlite3.Cursor) -> None:
+    # Column types can't be altered in sqlite, so both tables are rebuilt with INTEGER columns
+    cursor.connection.create_function('legacy_timestamp_to_epoch_ms', 1, _legacy_timestamp_to_epoch_ms, deterministic=True)
+
+    cursor.execute('''
+       CREATE TABLE messages_migrated (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           text_message TEXT NOT NULL,
+           sender_id INTEGER NOT NULL,
+           room_id INTEGER NOT NULL,
+           timestamp INTEGER NOT NULL,
+           FOREIGN KEY (sender_id) REFERENCES users(id), 
+           FOREIGN KEY (room_id) REFERENCES rooms(id) 
+           );
+       ''')
+    cursor.execute('''
+       INSERT INTO messages_migrated (id, text_message, sender_id, room_id, timestamp)
+       SELECT id, text_message, sender_id, room_id, legacy_timestamp_to_epoch_ms(timestamp) FROM messages
+       ''')
+    cursor.execute('DROP TABLE messages')
+    cursor.execute('ALTER TABLE messages_migrated RENAME TO messages')
+
+    cursor.execute('''
+         CREATE TABLE room_checkins_migrated (
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             sender_id INTEGER NOT NULL,
+             room_id INTEGER NOT NULL,
+             join_timestamp INTEGER NOT NULL,
+             FOREIGN KEY (sender_id) REFERENCES users(id), 
+             FOREIGN KEY (room_id) REFERENCES rooms(id) 
+             );
+         ''')
+    cursor.execute('''
+         INSERT INTO room_checkins_migrated (id, sender_id, room_id, join_timestamp)
+         SELECT id, sender_id, room_id, legacy_timestamp_to_epoch_ms(join_timestamp) FROM room_checkins
+         ''')
+    cursor.execute('DROP TABLE room_checkins')
+    cursor.execute('ALTER TABLE room_checkins_migrated RENAME TO room_checkins')
+
+
+def _add_lookup_indexes(cursor: sqlite3.Cursor) -> None:
+    # History replay filters by room and orders by time, check-ins are looked up by user and room
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_room_timestamp ON messages (room_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_room_checkins_sender_room ON room_checkins (sender_id, room_id)')
+
+
+def _add_history_page_index(cursor: sqlite3.Cursor) -> None:
+    # Paginated history walks a room by message id (the rowid is implicitly the last index column)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room_id)')
+
+
+def _add_resumable_uploads(cursor: sqlite3.Cursor) -> None:
+    # Completed files keep their size and checksum for verified (ranged) downloads, files uploaded before stay NULL.
+    # Unfinished uploads are kept by file id, the bytes received so far are the size of the '.part' file on disk
+    cursor.execute('ALTER TABLE files ADD COLUMN file_size INTEGER')
+    cursor.execute('ALTER TABLE files ADD COLUMN checksum TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_file_id ON files (file_id)')
+
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS partial_uploads (
+           file_id TEXT PRIMARY KEY,
+           file_name TEXT NOT NULL,
+           file_size INTEGER NOT NULL,
+           checksum TEXT NOT NULL,
+           created_at INTEGER NOT NULL
+           );
+       ''')
+
+
+def _add_upload_parts(cursor: sqlite3.Cursor) -> None:
+    # Uploads in parts are written in place at their offsets, so progress is kept per finished part instead
+    cursor.execute('ALTER TABLE partial_uploads ADD COLUMN parts INTEGER NOT NULL DEFAULT 1')
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS partial_upload_parts (
+           file_id TEXT NOT NULL,
+           part_index INTEGER NOT NULL,
+           PRIMARY KEY (file_id, part_index)
+           );
+       ''')
+
+
+def _add_blob_store(cursor: sqlite3.Cursor) -> None:
+    # Uploads are stored once per content (the checksum), files rows of the same content share one blob.
+    # Files stored so far are moved into the store, files uploaded before checksums were kept are hashed first so the
+    # store limits count them too, and the other copies of a content are removed
+    from server.blob_store import blob_path, blobs_root_dir
+    from utils import hash_file_prefix
+
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS blobs (
+           checksum TEXT PRIMARY KEY,
+           blob_path TEXT NOT NULL,
+           file_size INTEGER NOT NULL,
+           refcount INTEGER NOT NULL,
+           last_accessed INTEGER NOT NULL
+           );
+       ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_blobs_last_accessed ON blobs (last_accessed)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_checksum ON files (checksum)')
+
+    files = cursor.execute('SELECT id, file_path, file_size, checksum FROM files').fetchall()
+    if not files:
+        return
+
+    root_dir = blobs_root_dir()
+    blobs: typing.Dict[str, typing.List[typing.Any]] = {}  # Checksum -> [blob path, file size, refcount]
+    moves: typing.Dict[str, str] = {}  # First copy of every content -> its blob path
+    removals: typing.Set[str] = set()  # Other copies
+
+    for row_id, file_path, file_size, checksum in files:
+        if checksum is None:
+            try:
+                with open(file_path, 'rb') as file:
+                    file_size = os.fstat(file.fileno()).st_size
+                    checksum = hash_file_prefix(reader_file=file, size=file_size).hexdigest()
+            except OSError as e:
+                logger.warning(f"Left {file_path} out of the blob store, it can't be read: {e!r}")
+                continue
+
+        file_blob_path = blob_path(root_dir, checksum)
+        if checksum in blobs:
+            blobs[checksum][2] += 1
+            if file_path != file_blob_path and file_path not in moves:
+                removals.add(file_path)
+        else:
+            blobs[checksum] = [file_blob_path, file_size, 1]
+            if file_path != file_blob_path:
+                moves[file_path] = file_blob_path
+
+        cursor.execute('UPDATE files SET file_path = ?, file_size = ?, checksum = ? WHERE id = ?', (file_blob_path, file_size, checksum, row_id))
+
+    cursor.executemany('''
+       INSERT INTO blobs (checksum, blob_path, file_size, refcount, last_accessed)
+       VALUES (?,?,?,?,0)''', [(checksum, *blob) for checksum, blob in blobs.items()])
+
+    # Files are moved last, right before the commit. A rerun after a failed commit finds them already in place
+    for file_path, file_blob_path in moves.items():
+        if os.path.exists(file_blob_path):
+            removals.add(file_path)
+            continue
+        os.makedirs(os.path.dirname(file_blob_path), exist_ok=True)
+        try:
+            os.replace(file_path, file_blob_path)
+        except FileNotFoundError:
+            logger.warning(f"{file_path} is missing, its file ids can't be downloaded")
+
+    for file_path in removals:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+    logger.info(f"Moved {len(moves)} uploaded files into the blob store, removed {len(removals)} duplicate copies")
+
+
+# Append only, a migration's position is its schema version (stored in PRAGMA user_version)
+MIGRATIONS: typing.Tuple[typing.Callable[[sqlite3.Cursor], None], ...] = (
+    _create_base_schema,
+    _epoch_ms_timestamps,
+    _add_lookup_indexes,
+    _add_history_page_index,
+    _add_resumable_uploads,
+    _add_upload_parts,
+    _add_blob_store,
+)
+
+
+def get_schema_version(db_conn: sqlite3.Connection) -> int:
+    return db_conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db_conn: sqlite3.Connection) -> int:
+    """
+    Brings the database up to the latest schema version, each migration runs in its own transaction.
+    BEGIN IMMEDIATE takes the write lock before the version is checked, so servers starting together migrate once.
+    """
+    db_conn.commit()
+
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if get_schema_version(db_conn) >= version:
+            continue
+
+        cursor = db_conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(db_conn) < version:
+                logger.info(f"Migrating chat db to schema version {version} ({migration.__name__})")
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {version}')
+            db_conn.commit()
+
+        except Exception:
+            db_conn.rollback()
+            logger.exception(f"Failed to migrate chat db to schema version {version}")
+            raise
+
+    return get_schema_version(db_conn)
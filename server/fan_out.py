@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+import typing
+from logging import getLogger
+
+from config import MessageServerConfig
+from definitions import SlowConsumerPolicies
+from utils import send_frames
+
+logger = getLogger(__name__)
+
+class ClientOutbox:
+    """
+    Outbound queue of a single client, drained by its own writer thread.
+    Broadcasters only append the already encoded frame and never wait, so a slow client never blocks delivery to
+    the others. Everything queued while the writer was busy goes out in one gathered write.
+    """
+    def __init__(
+            self,
+            conn: socket.socket,
+            *,
+            username: str,
+            policy: SlowConsumerPolicies = SlowConsumerPolicies(MessageServerConfig.slow_consumer_policy),
+            max_pending_bytes: int = MessageServerConfig.outbox_max_pending_bytes,
+            buffer_timeout_seconds: float = MessageServerConfig.outbox_buffer_timeout_seconds,
+            buffer_max_pending_bytes: int = MessageServerConfig.outbox_buffer_max_pending_bytes
+    ):
+        self.conn = conn
+        self.username = username
+        self.policy = policy
+        self.max_pending_bytes = max_pending_bytes
+        self.buffer_timeout_seconds = buffer_timeout_seconds
+        self.buffer_max_pending_bytes = buffer_max_pending_bytes
+
+        self.dropped_frames = 0
+        self._frames: typing.Deque[bytes] = collections.deque()
+        self._pending_bytes = 0
+        self._behind_since: typing.Optional[float] = None  # When the outbox went over max_pending_bytes (BUFFER)
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self._writer_thread = threading.Thread(target=self._run, name=f"outbox-{username}", daemon=True)
+        self._writer_thread.start()
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._pending_bytes
+
+    def put(self, frame: bytes) -> bool:
+        """ Queues a broadcast frame, the slow consumer policy decides what happens when the client is behind """
+        with self._condition:
+            if self._closed:
+                return False
+
+            if self._is_over_limit(frame):
+                if self.policy == SlowConsumerPolicies.DROP:
+                    self.dropped_frames += 1
+                    return False
+
+                if self.policy != SlowConsumerPolicies.BUFFER or self._buffered_too_much(frame):
+                    logger.warning(f"Disconnecting slow client {self.username}, {self._pending_bytes} bytes are pending")
+                    self._abort_locked()
+                    return False
+
+            self._append_locked(frame)
+            return True
+
+    def put_many(self, frames: typing.Sequence[bytes]) -> None:
+        """ Queues frames the client must get (e.g. a history page), regardless of the slow consumer policy """
+        with self._condition:
+            if self._closed:
+                return
+            for frame in frames:
+                self._append_locked(frame)
+
+    def close(self) -> None:
+        # Writer thread sends whatever is still queued and exits
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def abort(self) -> None:
+        with self._condition:
+            self._abort_locked()
+
+    def _is_over_limit(self, frame: bytes) -> bool:
+        # A single frame bigger than the limit still goes through an empty outbox
+        return self._pending_bytes and self._pending_bytes + len(frame) > self.max_pending_bytes
+
+    def _buffered_too_much(self, frame: bytes) -> bool:
+        # BUFFER queues past the limit, until the client stays behind for the timeout or reaches the hard cap
+        if self._behind_since is None:
+            self._behind_since = time.monotonic()
+        return (
+            self._pending_bytes + len(frame) > self.buffer_max_pending_bytes
+            or time.monotonic() - self._behind_since > self.buffer_timeout_seconds
+        )
+
+    def _append_locked(self, frame: bytes) -> None:
+        self._frames.append(frame)
+        self._pending_bytes += len(frame)
+        self._condition.notify_all()
+
+    def _abort_locked(self) -> None:
+        self._closed = True
+        self._frames.clear()
+        self._condition.notify_all()
+        try:
+            # Wakes up the client's receiving thread, which cleans the client up
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._frames or self._closed)
+                if not self._frames:
+                    return
+                frames = list(self._frames)
+                self._frames.clear()
+
+            try:
+                send_frames(self.conn, frames)
+            except OSError:
+                logger.info(f"Stopped writing to {self.username}, connection is closed")
+                self.abort()
+                return
+
+            with self._condition:
+                self._pending_bytes -= sum(len(frame) for frame in frames)
+                if self._behind_since is not None:
+                    if self._pending_bytes <= self.max_pending_bytes:
+                        self._behind_since = None
+                    elif time.monotonic() - self._behind_since > self.buffer_timeout_seconds:
+                        logger.warning(f"Disconnecting slow client {self.username}, still {self._pending_bytes} bytes behind")
+                        self._abort_locked()
+                        return
+                self._condition.notify_all()
+
+
+class AsyncClientOutbox:
+    """
+    Event loop counterpart of ClientOutbox, the transport write buffer is the client's queue and the event loop
+    is its writer, so the policy is applied to the transport's pending bytes.
+    """
+    def __init__(
+            self,
+            writer: asyncio.StreamWriter,
+            *,
+            username: str,
+            policy: SlowConsumerPolicies = SlowConsumerPolicies(MessageServerConfig.slow_consumer_policy),
+            max_pending_bytes: int = MessageServerConfig.outbox_max_pending_bytes,
+            buffer_timeout_seconds: float = MessageServerConfig.outbox_buffer_timeout_seconds,
+            buffer_max_pending_bytes: int = MessageServerConfig.outbox_buffer_max_pending_bytes
+    ):
+        self.writer = writer
+        self.username = username
+        self.policy = policy
+        self.max_pending_bytes = max_pending_bytes
+        self.buffer_timeout_seconds = buffer_timeout_seconds
+        self.buffer_max_pending_bytes = buffer_max_pending_bytes
+
+        self.dropped_frames = 0
+        self._behind_since: typing.Optional[float] = None  # Since when puts found the buffer over max_pending_bytes (BUFFER)
+
+    @property
+    def pending_bytes(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+    def put(self, frame: bytes) -> bool:
+        # Never awaits, the transport buffers the frame and the event loop writes it out
+        if self.writer.is_closing():
+            return False
+
+        if not self._is_over_limit(frame):
+            self._behind_since = None
+
+        else:
+            if self.policy == SlowConsumerPolicies.DROP:
+                self.dropped_frames += 1
+                return False
+
+            if self.policy != SlowConsumerPolicies.BUFFER or self._buffered_too_much(frame):
+                logger.warning(f"Disconnecting slow client {self.username}, {self.pending_bytes} bytes are pending")
+                self.abort()
+                return False
+
+        self.writer.write(frame)
+        return True
+
+    def put_many(self, frames: typing.Sequence[bytes]) -> None:
+        if not self.writer.is_closing():
+            self.writer.writelines(frames)
+
+    def abort(self) -> None:
+        self.writer.transport.abort()
+
+    def _is_over_limit(self, frame: bytes) -> bool:
+        pending_bytes = self.pending_bytes
+        return pending_bytes and pending_bytes + len(frame) > self.max_pending_bytes
+
+    def _buffered_too_much(self, frame: bytes) -> bool:
+        if self._behind_since is None:
+            self._behind_since = time.monotonic()
+        return (
+            self.pending_bytes + len(frame) > self.buffer_max_pending_bytes
+            or time.monotonic() - self._behind_since > self.buffer_timeout_seconds
+        )
@@ -0,0 +1,208 @@
+import collections
+import threading
+import typing
+from logging import getLogger
+
+from config import MessageServerConfig
+from server.db.chat_db import ChatDB
+from server.db.message_writer import PendingMessage
+from utils import encode_text_frame
+
+logger = getLogger(__name__)
+
+# Rough per message cost on top of the frame itself (tuple, ints and the deque slot)
+_MESSAGE_OVERHEAD_BYTES = 120
+_JOIN_TIMESTAMP_OVERHEAD_BYTES = 100
+
+class CachedMessage(typing.NamedTuple):
+    message_id: int
+    msg_timestamp: int  # Epoch milliseconds
+    frame: bytes  # Encoded text frame, sent as is
+
+class CachedHistoryPage(typing.NamedTuple):
+    frames: typing.List[bytes]  # Oldest first
+    oldest_message_id: typing.Optional[int]  # Keyset cursor for the next (older) page, read from the db
+    has_more: bool
+
+class _RoomHistory:
+    __slots__ = ('messages', 'complete', 'join_timestamps', 'size_bytes')
+
+    def __init__(self, *, messages: typing.Iterable[CachedMessage], room_size: int, complete: bool):
+        self.messages: typing.Deque[CachedMessage] = collections.deque(messages, maxlen=room_size)
+        self.complete = complete  # Holds the whole room history, nothing older is left in the db
+        self.join_timestamps: typing.Dict[str, int] = {}  # Private room check-ins, they never change once stored
+        self.size_bytes = sum(len(message.frame) + _MESSAGE_OVERHEAD_BYTES for message in self.messages)
+
+
+class HistoryCache:
+    """
+    Newest messages of recently used rooms as pre-encoded frames, so joining a hot room doesn't touch the db.
+    A room is loaded from the db on its first join and then kept up to date by the message writer after every
+    commit, so it holds exactly what the db holds (with message ids, /history continues from the db with the same cursor).
+    Rooms are dropped least recently used first once max_bytes is exceeded.
+    """
+    def __init__(
+            self,
+            *,
+            chat_db: ChatDB,
+            room_size: int = MessageServerConfig.history_cache_room_size,
+            max_bytes: int = MessageServerConfig.history_cache_max_bytes,
+            lock_stripes: int = 64
+    ):
+        self.chat_db = chat_db
+        self.room_size = room_size
+        self.max_bytes = max_bytes
+
+        self._rooms: typing.OrderedDict[str, _RoomHistory] = collections.OrderedDict()  # Least recently used first
+        self._size_bytes = 0
+        self._lock = threading.Lock()  # Guards the rooms and their contents, held for in memory work only
+
+        # Loading a room and adding stored messages to it are serialized per room (striped, so rooms cost no lock each),
+        # a commit landing while the room is read from the db is then either in that read or added right after it
+        self._load_locks = tuple(threading.Lock() for _ in range(lock_stripes))
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted_rooms = 0
+
+    def is_cached(self, room_name: str) -> bool:
+        return room_name in self._rooms
+
+    def peek_history_page(self, room_name: str, *, limit: int, join_timestamp: typing.Optional[int] = None) -> typing.Optional[CachedHistoryPage]:
+        """ Newest page of a cached room, None if the room isn't cached """
+        with self._lock:
+            history_page = self._history_page_locked(room_name, limit=limit, join_timestamp=join_timestamp)
+            if history_page:
+                self.hits += 1
+            return history_page
+
+    def get_history_page(self, room_name: str, *, limit: int, join_timestamp: typing.Optional[int] = None) -> CachedHistoryPage:
+        """ Newest page of a room, loads the room from the db first if needed (blocking) """
+        if history_page := self.peek_history_page(room_name, limit=limit, join_timestamp=join_timestamp):
+            return history_page
+
+        with self._load_lock(room_name):
+            with self._lock:
+                history_page = self._history_page_locked(room_name, limit=limit, join_timestamp=join_timestamp)
+                if history_page:  # Loaded by another join meanwhile
+                    self.hits += 1
+                    return history_page
+                self.misses += 1
+
+            with self.chat_db.session() as db_conn:
+                latest_messages = self.chat_db.get_latest_messages(db_conn=db_conn, room_name=room_name, limit=self.room_size + 1)
+
+            room_history = _RoomHistory(
+                messages=(
+                    CachedMessage(message_id=message_id, msg_timestamp=timestamp, frame=encode_text_frame(formatted_msg))
+                    for message_id, timestamp, formatted_msg in latest_messages[-self.room_size:]
+                ),
+                room_size=self.room_size,
+                complete=len(latest_messages) <= self.room_size
+            )
+
+            with self._lock:
+                self._rooms[room_name] = room_history
+                self._size_bytes += room_history.size_bytes
+                self._evict_locked(keep_room_name=room_name)
+                return self._history_page_locked(room_name, limit=limit, join_timestamp=join_timestamp)
+
+    def get_join_timestamp(self, room_name: str, username: str) -> typing.Optional[int]:
+        room_history = self._rooms.get(room_name)
+        return room_history.join_timestamps.get(username) if room_history else None
+
+    def set_join_timestamp(self, room_name: str, username: str, join_timestamp: int) -> None:
+        with self._lock:
+            if (room_history := self._rooms.get(room_name)) and username not in room_history.join_timestamps:
+                room_history.join_timestamps[username] = join_timestamp
+                room_history.size_bytes += _JOIN_TIMESTAMP_OVERHEAD_BYTES
+                self._size_bytes += _JOIN_TIMESTAMP_OVERHEAD_BYTES
+
+    def add_stored_messages(self, messages: typing.Sequence[PendingMessage], message_ids: typing.Optional[range]) -> None:
+        """ MessageWriter on_stored callback, appends committed messages of cached rooms """
+        if message_ids is None:
+            # Ids are unknown, so the affected rooms can't be kept in sync with the db anymore
+            for room_name in {message.room_name for message in messages}:
+                self.invalidate(room_name)
+            return
+
+        for message, message_id in zip(messages, message_ids):
+            with self._load_lock(message.room_name):
+                with self._lock:
+                    room_history = self._rooms.get(message.room_name)
+                    if room_history is None:
+                        continue
+
+                    if message.frame is None:
+                        self._remove_locked(message.room_name)
+                        continue
+
+                    # Skips messages the room already got when it was loaded from the db
+                    if room_history.messages and message_id <= room_history.messages[-1].message_id:
+                        continue
+
+                    if len(room_history.messages) == self.room_size:
+                        dropped_message = room_history.messages[0]
+                        room_history.size_bytes -= len(dropped_message.frame) + _MESSAGE_OVERHEAD_BYTES
+                        self._size_bytes -= len(dropped_message.frame) + _MESSAGE_OVERHEAD_BYTES
+                        room_history.complete = False
+
+                    room_history.messages.append(CachedMessage(message_id=message_id, msg_timestamp=message.timestamp, frame=message.frame))
+                    room_history.size_bytes += len(message.frame) + _MESSAGE_OVERHEAD_BYTES
+                    self._size_bytes += len(message.frame) + _MESSAGE_OVERHEAD_BYTES
+                    self._rooms.move_to_end(message.room_name)
+
+        with self._lock:
+            self._evict_locked()
+
+    def invalidate(self, room_name: str) -> None:
+        with self._load_lock(room_name):
+            with self._lock:
+                self._remove_locked(room_name)
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            "cached_rooms": len(self._rooms),
+            "cached_bytes": self._size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_rooms": self.evicted_rooms,
+        }
+
+    def _load_lock(self, room_name: str) -> threading.Lock:
+        return self._load_locks[hash(room_name) % len(self._load_locks)]
+
+    def _history_page_locked(self, room_name: str, *, limit: int, join_timestamp: typing.Optional[int]) -> typing.Optional[CachedHistoryPage]:
+        room_history = self._rooms.get(room_name)
+        if room_history is None:
+            return None
+        self._rooms.move_to_end(room_name)
+
+        # Users of private rooms get only messages from their first join on
+        if join_timestamp:
+            visible_messages = [message for message in room_history.messages if message.msg_timestamp > join_timestamp]
+        else:
+            visible_messages = list(room_history.messages)
+
+        page = visible_messages[-limit:] if limit else []
+        has_more = len(visible_messages) > len(page) or (
+            # Older messages may still be visible in the db, unless the cache already got to messages before the join
+            not room_history.complete and len(visible_messages) == len(room_history.messages)
+        )
+        return CachedHistoryPage(
+            frames=[message.frame for message in page],
+            oldest_message_id=page[0].message_id if page else None,
+            has_more=has_more
+        )
+
+    def _evict_locked(self, *, keep_room_name: typing.Optional[str] = None) -> None:
+        for room_name in list(self._rooms):
+            if self._size_bytes <= self.max_bytes:
+                break
+            if room_name != keep_room_name:
+                self._remove_locked(room_name)
+                self.evicted_rooms += 1
+
+    def _remove_locked(self, room_name: str) -> None:
+        if (room_history := self._rooms.pop(room_name, None)) is not None:
+            self._size_bytes -= room_history.size_bytes
@@ -0,0 +1,275 @@
+import abc
+import argparse
+import collections
+import logging
+import os
+import socket
+import threading
+import typing
+from logging import getLogger
+
+from definitions import FrameTypes
+from server.shard_bus import connect_unix_socket
+from utils import FrameReader, encode_frame, encode_json_frame, send_frames
+
+logger = getLogger(__name__)
+
+MessageHandler = typing.Callable[[str, bytes], None]
+
+class MessageBus(abc.ABC):
+    """
+    Publish/subscribe between chat server nodes, so several ChatServer instances share their rooms.
+    A payload published to a channel is handed to on_message of every other node subscribed to it, never back
+    to the publisher, and the payloads of one publisher arrive in the order they were published.
+    subscribe and unsubscribe are counted per channel, only the first subscribe and the last unsubscribe reach
+    the transport, so a node can call them once per local member of a room.
+    """
+    def __init__(self):
+        self.on_message: typing.Optional[MessageHandler] = None
+        self._subscriptions: typing.Dict[str, int] = {}
+        self._subscriptions_lock = threading.Lock()
+
+    def start(self, on_message: MessageHandler) -> None:
+        self.on_message = on_message
+        self._connect()
+
+    def subscribe(self, channel: str) -> None:
+        with self._subscriptions_lock:
+            self._subscriptions[channel] = self._subscriptions.get(channel, 0) + 1
+            if self._subscriptions[channel] == 1:
+                self._subscribe(channel)
+
+    def unsubscribe(self, channel: str) -> None:
+        with self._subscriptions_lock:
+            if channel not in self._subscriptions:
+                return
+            self._subscriptions[channel] -= 1
+            if not self._subscriptions[channel]:
+                del self._subscriptions[channel]
+                self._unsubscribe(channel)
+
+    @abc.abstractmethod
+    def publish(self, channel: str, payload: bytes) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _connect(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def _subscribe(self, channel: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def _unsubscribe(self, channel: str) -> None:
+        ...
+
+
+class InProcessBusHub:
+    """ Routes between the InProcessMessageBus instances created on it, e.g. several nodes started by one test """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: typing.Dict[str, typing.FrozenSet["InProcessMessageBus"]] = {}
+
+    def bus(self) -> "InProcessMessageBus":
+        return InProcessMessageBus(self)
+
+    def subscribe(self, channel: str, bus: "InProcessMessageBus") -> None:
+        with self._lock:
+            # Replaced rather than mutated, publishers iterate the set without the lock
+            self._subscribers[channel] = self._subscribers.get(channel, frozenset()) | {bus}
+
+    def unsubscribe(self, channel: str, bus: "InProcessMessageBus") -> None:
+        with self._lock:
+            if subscribers := self._subscribers.get(channel, frozenset()) - {bus}:
+                self._subscribers[channel] = subscribers
+            else:
+                self._subscribers.pop(channel, None)
+
+    def publish(self, channel: str, payload: bytes, publisher: "InProcessMessageBus") -> None:
+        for bus in self._subscribers.get(channel, ()):
+            if bus is not publisher:
+                bus.on_message(channel, payload)
+
+
+class InProcessMessageBus(MessageBus):
+    """ Delivers synchronously, in the publishing thread """
+    def __init__(self, hub: InProcessBusHub):
+        super().__init__()
+        self.hub = hub
+
+    def publish(self, channel: str, payload: bytes) -> None:
+        self.hub.publish(channel, payload, self)
+
+    def _connect(self) -> None:
+        pass
+
+    def _subscribe(self, channel: str) -> None:
+        self.hub.subscribe(channel, self)
+
+    def _unsubscribe(self, channel: str) -> None:
+        self.hub.unsubscribe(channel, self)
+
+
+class _BusConnection:
+    """ One end of a broker connection: operations are queued and sent by a writer thread, so callers never block on the socket """
+    def __init__(self, sock: socket.socket, *, name: str):
+        self.sock = sock
+        self._frames: typing.Deque[bytes] = collections.deque()
+        self._closed = False
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name=f"bus-writer-{name}", daemon=True).start()
+
+    def put(self, op: str, channel: str, payload: typing.Optional[bytes] = None) -> None:
+        frames = [encode_json_frame({"op": op, "channel": channel})]
+        if payload is not None:
+            frames.append(encode_frame(FrameTypes.BINARY, payload))
+
+        with self._condition:
+            self._frames.extend(frames)
+            self._condition.notify()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._frames or self._closed)
+                    if self._closed:
+                        return
+                    frames = list(self._frames)
+                    self._frames.clear()
+                # Everything queued meanwhile goes out in one gathered write
+                send_frames(self.sock, frames)
+
+        except OSError as e:
+            logger.warning(f"Message bus connection lost: {repr(e)}")
+
+        finally:
+            self.sock.close()
+
+
+def _read_operations(sock: socket.socket) -> typing.Iterator[typing.Tuple[str, str, typing.Optional[bytes]]]:
+    frame_reader = FrameReader(sock)
+    while True:
+        header = frame_reader.read_frame().json()
+        payload = bytes(frame_reader.read_frame().payload) if header["op"] in ("publish", "message") else None
+        yield header["op"], header["channel"], payload
+
+
+class UnixSocketBusBroker:
+    """
+    Reference broker for UnixSocketMessageBus: nodes connect to its Unix socket, subscribe to channels and publish
+    to them, and every publish is forwarded to the other subscribed nodes (each behind its own writer thread,
+    so a slow node doesn't hold up the others).
+    """
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(socket_path)
+        self._listener.listen()
+
+        self._lock = threading.Lock()
+        self._subscribers: typing.Dict[str, typing.FrozenSet[_BusConnection]] = {}
+
+    def start(self) -> None:
+        while True:
+            node_sock, _ = self._listener.accept()
+            threading.Thread(target=self._serve_node, args=(node_sock,), name="bus-broker-node", daemon=True).start()
+
+    def _serve_node(self, node_sock: socket.socket) -> None:
+        node = _BusConnection(node_sock, name="broker")
+        channels: typing.Set[str] = set()
+        try:
+            for op, channel, payload in _read_operations(node_sock):
+                if op == "subscribe":
+                    channels.add(channel)
+                    with self._lock:
+                        self._subscribers[channel] = self._subscribers.get(channel, frozenset()) | {node}
+
+                elif op == "unsubscribe":
+                    channels.discard(channel)
+                    self._remove_subscriber(channel, node)
+
+                elif op == "publish":
+                    for subscriber in self._subscribers.get(channel, ()):
+                        if subscriber is not node:
+                            subscriber.put("message", channel, payload)
+
+        except ConnectionError:
+            logger.info("A node disconnected from the message bus")
+
+        finally:
+            for channel in channels:
+                self._remove_subscriber(channel, node)
+            node.close()
+
+    def _remove_subscriber(self, channel: str, node: _BusConnection) -> None:
+        with self._lock:
+            if subscribers := self._subscribers.get(channel, frozenset()) - {node}:
+                self._subscribers[channel] = subscribers
+            else:
+                self._subscribers.pop(channel, None)
+
+
+class UnixSocketMessageBus(MessageBus):
+    """ Node side of a UnixSocketBusBroker, on_message is called from the bus reader thread """
+    def __init__(self, socket_path: str):
+        super().__init__()
+        self.socket_path = socket_path
+        self._connection: typing.Optional[_BusConnection] = None
+
+    def publish(self, channel: str, payload: bytes) -> None:
+        self._connection.put("publish", channel, payload)
+
+    def close(self) -> None:
+        if self._connection:
+            self._connection.close()
+
+    def _connect(self) -> None:
+        sock = connect_unix_socket(self.socket_path)
+        self._connection = _BusConnection(sock, name="node")
+        threading.Thread(target=self._read_messages, args=(sock,), name="bus-reader", daemon=True).start()
+
+    def _subscribe(self, channel: str) -> None:
+        self._connection.put("subscribe", channel)
+
+    def _unsubscribe(self, channel: str) -> None:
+        self._connection.put("unsubscribe", channel)
+
+    def _read_messages(self, sock: socket.socket) -> None:
+        try:
+            for _, channel, payload in _read_operations(sock):
+                try:
+                    self.on_message(channel, payload)
+                except Exception:
+                    logger.exception(f"Failed to handle a message bus payload of {channel}")
+
+        except (ConnectionError, OSError):
+            logger.warning("Lost the message bus broker, rooms are no longer shared with other nodes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message bus broker for federated chat servers")
+    parser.add_argument("--socket", required=True, help="Unix socket path the chat servers connect to (--bus-socket)")
+    args = parser.parse_args()
+
+    print("Message bus broker started...")
+    UnixSocketBusBroker(args.socket).start()
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
+    main()
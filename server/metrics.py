@@ -0,0 +1,264 @@
+import bisect
+import functools
+import http.server
+import inspect
+import threading
+import time
+import typing
+import urllib.parse
+from logging import getLogger
+
+from config import DiagnosticsConfig, MetricsConfig
+from server.profiler import SamplingProfiler
+
+logger = getLogger(__name__)
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+def _format_labels(labels: Labels, extra: typing.Optional[typing.Tuple[str, str]] = None) -> str:
+    pairs = [*labels, extra] if extra else labels
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ('registry', 'labels', 'value', '_lock')
+
+    def __init__(self, registry: "MetricsRegistry", labels: Labels):
+        self.registry = registry
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        if self.registry.enabled:
+            lock = self._lock
+            lock.acquire()
+            self.value += amount
+            lock.release()
+
+    def samples(self, name: str) -> typing.Iterator[str]:
+        yield f"{name}_total{_format_labels(self.labels)} {_format_value(self.value)}"
+
+
+class Histogram:
+    """ observe only bumps one bucket under the lock, the cumulative buckets and the count are computed on scrape """
+    __slots__ = ('registry', 'labels', 'buckets', 'bucket_counts', 'sum', '_lock')
+
+    def __init__(self, registry: "MetricsRegistry", labels: Labels, buckets: typing.Sequence[float]):
+        self.registry = registry
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf, the count is their sum
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if self.registry.enabled:
+            index = bisect.bisect_left(self.buckets, value)
+            lock = self._lock
+            lock.acquire()
+            self.bucket_counts[index] += 1
+            self.sum += value
+            lock.release()
+
+    def samples(self, name: str) -> typing.Iterator[str]:
+        with self._lock:
+            bucket_counts, total = list(self.bucket_counts), self.sum
+        count = sum(bucket_counts)
+
+        cumulative = 0
+        for upper_bound, bucket_count in zip((*self.buckets, float('inf')), bucket_counts):
+            cumulative += bucket_count
+            yield f"{name}_bucket{_format_labels(self.labels, ('le', _format_value(upper_bound)))} {cumulative}"
+        yield f"{name}_sum{_format_labels(self.labels)} {_format_value(total)}"
+        yield f"{name}_count{_format_labels(self.labels)} {count}"
+
+
+class Gauge:
+    """ Read from its callback on scrape, so the instrumented code pays nothing for it """
+    __slots__ = ('labels', 'callback')
+
+    def __init__(self, labels: Labels, callback: typing.Callable[[], float]):
+        self.labels = labels
+        self.callback = callback
+
+    def samples(self, name: str) -> typing.Iterator[str]:
+        yield f"{name}{_format_labels(self.labels)} {_format_value(self.callback())}"
+
+
+class _Family(typing.NamedTuple):
+    type: str
+    help: str
+    metrics: typing.Dict[Labels, typing.Union[Counter, Histogram, Gauge]]
+
+
+class MetricsRegistry:
+    """
+    Counters, histograms and gauges rendered in the Prometheus text format. Metrics are declared once (at import
+    time for the hot paths) and only record while enabled, so a disabled registry costs a flag check per call.
+    Asking for an existing metric (same name and labels) returns it, a gauge is replaced by the new callback.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._families: typing.Dict[str, _Family] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+        return self._metric(name, "counter", help_text, labels, lambda label_items: Counter(self, label_items))
+
+    def histogram(self, name: str, help_text: str, *, buckets: typing.Sequence[float] = MetricsConfig.latency_buckets_seconds, **labels: str) -> Histogram:
+        return self._metric(name, "histogram", help_text, labels, lambda label_items: Histogram(self, label_items, buckets))
+
+    def gauge(self, name: str, help_text: str, callback: typing.Callable[[], float], **labels: str) -> Gauge:
+        label_items = tuple(labels.items())
+        gauge = Gauge(label_items, callback)
+        with self._lock:
+            self._family(name, "gauge", help_text).metrics[label_items] = gauge
+        return gauge
+
+    def stats_gauges(self, prefix: str, help_text: str, stats: typing.Callable[[], typing.Dict[str, float]]) -> None:
+        """ One gauge per key of a stats() dict, e.g. HistoryCache.stats """
+        for key in stats():
+            self.gauge(f"{prefix}_{key}", help_text, lambda key=key: stats()[key])
+
+    def _metric(self, name: str, metric_type: str, help_text: str, labels: typing.Dict[str, str], create: typing.Callable[[Labels], typing.Any]):
+        label_items = tuple(labels.items())
+        with self._lock:
+            family = self._family(name, metric_type, help_text)
+            if (metric := family.metrics.get(label_items)) is None:
+                metric = family.metrics[label_items] = create(label_items)
+        return metric
+
+    def _family(self, name: str, metric_type: str, help_text: str) -> _Family:
+        family = self._families.setdefault(name, _Family(metric_type, help_text, {}))
+        if family.type != metric_type:
+            raise ValueError(f"Metric {name} is already registered as a {family.type}")
+        return family
+
+    def render(self) -> str:
+        with self._lock:
+            families = [(name, family, list(family.metrics.values())) for name, family in sorted(self._families.items())]
+
+        lines = []
+        for name, family, metrics in families:
+            lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.type}")
+            for metric in metrics:
+                try:
+                    lines.extend(metric.samples(name))
+                except Exception:
+                    logger.exception(f"Failed to collect {name}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, *, port: int, host: str = MetricsConfig.host) -> http.server.ThreadingHTTPServer:
+        """
+        Enables recording and serves from a background thread:
+        GET /metrics, and GET /debug/profile?seconds=N which profiles every thread of the server for N seconds
+        (up to DiagnosticsConfig.max_profile_seconds) and answers with the collapsed stacks.
+        """
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                url = urllib.parse.urlsplit(self.path)
+                if url.path == '/metrics':
+                    self._reply(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+                elif url.path == '/debug/profile':
+                    try:
+                        seconds = float(urllib.parse.parse_qs(url.query).get('seconds', [DiagnosticsConfig.profile_seconds])[0])
+                    except ValueError:
+                        self.send_error(400, "seconds must be a number")
+                        return
+
+                    try:
+                        stacks = SamplingProfiler().profile(min(max(seconds, 0.0), DiagnosticsConfig.max_profile_seconds))
+                    except RuntimeError as e:
+                        self.send_error(409, str(e))
+                        return
+                    self._reply(SamplingProfiler.collapsed(stacks), content_type='text/plain; charset=utf-8')
+
+                else:
+                    self.send_error(404)
+
+            def _reply(self, text: str, *, content_type: str) -> None:
+                body = text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: typing.Any) -> None:
+                pass  # A scrape every few seconds would flood the server log
+
+        self.enabled = True
+        http_server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        http_server.daemon_threads = True
+        threading.Thread(target=http_server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return http_server
+
+
+METRICS = MetricsRegistry()
+
+def timed(histogram: Histogram) -> typing.Callable:
+    """ Observes the duration of every call of the decorated function (or coroutine function) while metrics are enabled """
+    def decorator(func: typing.Callable) -> typing.Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not histogram.registry.enabled:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not histogram.registry.enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+
+    return decorator
+
+def timed_methods(name: str, help_text: str, *, exclude: typing.Collection[str] = ()) -> typing.Callable[[type], type]:
+    """
+    Class decorator, times every public method (class and static methods included) in the histogram name with
+    a method label. Generator methods are left alone, a call only creates the generator.
+    """
+    def decorator(cls: type) -> type:
+        for attribute_name, attribute in list(vars(cls).items()):
+            if attribute_name.startswith('_') or attribute_name in exclude:
+                continue
+
+            wrapper_type = type(attribute) if isinstance(attribute, (classmethod, staticmethod)) else None
+            func = attribute.__func__ if wrapper_type else attribute
+            if not inspect.isfunction(func) or inspect.isgeneratorfunction(func):
+                continue
+
+            timed_func = timed(METRICS.histogram(name, help_text, method=attribute_name))(func)
+            setattr(cls, attribute_name, wrapper_type(timed_func) if wrapper_type else timed_func)
+        return cls
+
+    return decorator
+
+# Shared by the threaded and the async chat server
+BROADCAST_SECONDS = METRICS.histogram("chat_broadcast_seconds", "Time to queue a message to every client of its room")
+BROADCAST_BYTES = METRICS.counter("chat_broadcast_bytes", "Frame bytes queued to clients by broadcasts")
+HISTORY_FETCH_SECONDS = METRICS.histogram("chat_history_fetch_seconds", "Time to load a /history page from the db and queue it")
@@ -0,0 +1,91 @@
+import collections
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import typing
+from logging import getLogger
+
+from config import DiagnosticsConfig
+
+logger = getLogger(__name__)
+
+_profile_lock = threading.Lock()  # One profile per process at a time, two would sample each other
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of every thread of the process (sys._current_frames) every interval_seconds and
+    counts identical stacks, so threads stuck in a blocking send, a sqlite lock or a sleep show up as wide frames.
+    The result is in the collapsed stack format (flamegraph.pl, speedscope, inferno): one
+    "thread;outermost frame;...;innermost frame count" line per distinct stack. Threads are named up to their
+    first dash, e.g. every outbox-<username> writer is counted as "outbox".
+    """
+    def __init__(self, *, interval_seconds: float = DiagnosticsConfig.profile_sample_interval_seconds):
+        self.interval_seconds = interval_seconds
+        self._frame_labels: typing.Dict[typing.Tuple[typing.Any, int], str] = {}
+
+    def profile(self, seconds: float) -> typing.Counter[str]:
+        """ Blocks for the given seconds, raises RuntimeError if another profile is running """
+        if not _profile_lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+
+        try:
+            stacks: typing.Counter[str] = collections.Counter()
+            own_thread_id = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                thread_names = {thread.ident: thread.name.split('-', 1)[0] for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread_id:
+                        stacks[self._collapse(thread_names.get(thread_id, "unknown"), frame)] += 1
+                time.sleep(self.interval_seconds)
+            return stacks
+
+        finally:
+            _profile_lock.release()
+
+    def _collapse(self, thread_name: str, frame: typing.Any) -> str:
+        labels = []
+        while frame is not None:
+            key = (frame.f_code, frame.f_lineno)
+            if (label := self._frame_labels.get(key)) is None:
+                label = self._frame_labels[key] = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+            labels.append(label)
+            frame = frame.f_back
+
+        labels.append(thread_name)
+        return ";".join(reversed(labels))
+
+    @staticmethod
+    def collapsed(stacks: typing.Counter[str]) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def profile_to_file(seconds: float = DiagnosticsConfig.profile_seconds, *, profile_dir: typing.Optional[str] = DiagnosticsConfig.profile_dir) -> typing.Optional[str]:
+    """ Profiles the process and writes <profile dir>/profile-<pid>-<epoch seconds>.collapsed, returns its path """
+    profile_dir = profile_dir or tempfile.gettempdir()
+    logger.info(f"Profiling all threads for {seconds} seconds")
+    try:
+        stacks = SamplingProfiler().profile(seconds)
+    except RuntimeError as e:
+        logger.warning(f"Profile not started: {e}")
+        return None
+
+    profile_path = os.path.join(profile_dir, f"profile-{os.getpid()}-{int(time.time())}.collapsed")
+    with open(profile_path, 'w') as profile_file:
+        profile_file.write(SamplingProfiler.collapsed(stacks))
+    logger.info(f"Wrote {sum(stacks.values())} samples to {profile_path}")
+    return profile_path
+
+
+def install_profile_signal(signal_name: str = DiagnosticsConfig.profile_signal) -> None:
+    """ The signal profiles the process for DiagnosticsConfig.profile_seconds, e.g. kill -USR2 <server pid> """
+    signum = getattr(signal, signal_name, None)
+    if signum is None:  # No SIGUSR2 on Windows
+        logger.info(f"{signal_name} isn't available, profiles are served by the metrics endpoint only")
+        return
+
+    # The handler runs in the main thread between two bytecodes, the profile itself runs in its own thread
+    signal.signal(signum, lambda *_: threading.Thread(target=profile_to_file, name="profiler", daemon=True).start())
@@ -0,0 +1,106 @@
+import threading
+import typing
+
+ClientT = typing.TypeVar('ClientT')
+
+class _Room(typing.Generic[ClientT]):
+    __slots__ = ('lock', 'members', 'snapshot', 'closed', 'joins', 'leaves')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members: typing.Dict[int, ClientT] = {}  # Keyed by client object identity
+        self.snapshot: typing.Optional[typing.Tuple[ClientT, ...]] = ()
+        self.closed = False
+        self.joins = 0  # Counted under the room's lock, folded into the registry totals when the room is removed
+        self.leaves = 0
+
+
+class RoomRegistry(typing.Generic[ClientT]):
+    """
+    Thread safe mapping of room name to its active clients.
+    Join and leave are O(1) dict operations under the room's own lock, so different rooms never contend.
+    Broadcasts iterate an immutable snapshot of the members which is rebuilt once after a change, not on every read,
+    so they never hold a lock while sending and a join in the middle of a broadcast doesn't block either.
+    """
+    def __init__(self):
+        self._rooms: typing.Dict[str, _Room[ClientT]] = {}
+        self._rooms_lock = threading.Lock()  # Guards creating and removing rooms only
+
+        # Joins and leaves of the removed rooms, updated under the rooms lock
+        self._removed_joins = 0
+        self._removed_leaves = 0
+
+    def join(self, room_name: str, client: ClientT) -> None:
+        while True:
+            with self._rooms_lock:
+                room = self._rooms.get(room_name)
+                if room is None:
+                    room = self._rooms[room_name] = _Room()
+
+            with room.lock:
+                # Room could be removed (emptied) between the two locks, then retry with a fresh one
+                if room.closed:
+                    continue
+                room.members[id(client)] = client
+                room.snapshot = None
+                room.joins += 1
+                return
+
+    def leave(self, room_name: str, client: ClientT) -> bool:
+        room = self._rooms.get(room_name)
+        if room is None:
+            return False
+
+        with room.lock:
+            if room.members.pop(id(client), None) is None:
+                return False
+            room.snapshot = None
+            room.leaves += 1
+            is_empty = not room.members
+
+        if is_empty:
+            self._remove_if_empty(room_name, room)
+        return True
+
+    def members(self, room_name: str) -> typing.Tuple[ClientT, ...]:
+        room = self._rooms.get(room_name)
+        if room is None:
+            return ()
+
+        if (snapshot := room.snapshot) is None:
+            with room.lock:
+                if room.snapshot is None:
+                    room.snapshot = tuple(room.members.values())
+                snapshot = room.snapshot
+        return snapshot
+
+    def room_size(self, room_name: str) -> int:
+        room = self._rooms.get(room_name)
+        return len(room.members) if room else 0
+
+    def occupancy(self) -> typing.Dict[str, int]:
+        return {room_name: len(room.members) for room_name, room in list(self._rooms.items())}
+
+    def stats(self) -> typing.Dict[str, int]:
+        occupancy = self.occupancy()
+        with self._rooms_lock:
+            rooms = list(self._rooms.values())
+            total_joins = self._removed_joins + sum(room.joins for room in rooms)
+            total_leaves = self._removed_leaves + sum(room.leaves for room in rooms)
+        return {
+            "rooms": len(occupancy),
+            "active_clients": sum(occupancy.values()),
+            "largest_room_size": max(occupancy.values(), default=0),
+            "total_joins": total_joins,
+            "total_leaves": total_leaves,
+        }
+
+    def _remove_if_empty(self, room_name: str, room: _Room[ClientT]) -> None:
+        # Same lock order as join (rooms lock, then room lock)
+        with self._rooms_lock:
+            with room.lock:
+                if not room.members and self._rooms.get(room_name) is room:
+                    room.closed = True
+                    del self._rooms[room_name]
+                    self._removed_joins += room.joins
+                    self._removed_leaves += room.leaves
@@ -1,23 +1,31 @@
-import datetime
-import json
+import argparse
+import asyncio
 import logging
 import socket
 import sqlite3
 import threading
-import time
 import typing
-from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
-from config import MessageServerConfig, END_OF_MSG_INDICATOR
-from definitions import ClientInfo, MessageInfo, SetupRoomData, RoomTypes, MessageTypes
-from server.db.chat_db import ChatDB
+from config import MessageServerConfig, MetricsConfig
+from definitions import ClientInfo, MessageInfo, SetupRoomData, RoomTypes, MessageTypes, ServerModes, ConnectionStates, ProtocolError
+from server.async_server_chat import AsyncChatServer
+from server.chat_server_base import ChatServerBase
+from server.message_bus import MessageBus, UnixSocketMessageBus
+from server.metrics import METRICS, BROADCAST_BYTES, BROADCAST_SECONDS, HISTORY_FETCH_SECONDS, timed
+from server.profiler import install_profile_signal
+from server.tracing import TRACER, MessageTrace
+from server.db.message_writer import PendingMessage
+from server.fan_out import ClientOutbox
+from utils import FrameReader, encode_text_frame, epoch_ms_now
 
 logger = getLogger(__name__)
 
-class ChatServer:
-    def __init__(self, *, host: str, listen_port: int):
+HISTORY_CHANNEL = "history"  # Bus channel of the rooms whose stored messages changed, payload is the room name
+
+class ChatServer(ChatServerBase):
+    def __init__(self, *, host: str, listen_port: int, message_bus: typing.Optional[MessageBus] = None):
         self._chat_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self._chat_server.bind((host, listen_port))
@@ -25,158 +33,288 @@ class ChatServer:
             logger.exception(f"Unable to bind to host and port : {repr(e)}")
 
         self._chat_server.listen(MessageServerConfig.listener_limit_number)
+        self._setup_state(message_bus=message_bus)
 
+    def _setup_state(self, *, message_bus: typing.Optional[MessageBus] = None) -> None:
         self.active_clients: typing.Set[ClientInfo] = set()
-        self.room_name_to_active_clients: typing.DefaultDict[str, typing.List[ClientInfo]] = defaultdict(list)
-
-        self.chat_db = ChatDB()
+        self._setup_chat_state()
 
-        self.room_setup_done_flag = threading.Event()
+        # Shares the rooms with other nodes: broadcasts are published to the room channel, which a node subscribes
+        # to while it has members in the room, and stored messages invalidate the room history cached by the others
+        self.message_bus = message_bus
+        if message_bus:
+            message_bus.start(on_message=self._on_bus_message)
+            message_bus.subscribe(HISTORY_CHANNEL)
 
     @property
     def chat_server(self) -> socket.socket:
         return self._chat_server
 
-    def client_handler(self, conn: socket.socket):
-        sender_name = conn.recv(1024).decode('utf-8')
+    def client_handler(self, conn: socket.socket, *, prelude: bytes = b''):
+        # prelude holds bytes someone else already read from the connection (a sharded server's acceptor)
+        frame_reader = FrameReader(conn)
+        if prelude:
+            frame_reader.decoder.feed(prelude)
 
-        with self.chat_db.session() as db_conn:
-            self.chat_db.setup_database(db_conn=db_conn)
-            self.chat_db.store_user(db_conn=db_conn, sender_name=sender_name.strip())
+        sender_name = frame_reader.read_frame().text()
 
-        client_info = ClientInfo(client_conn=conn, username=sender_name)
+        self._store_user(sender_name.strip())
 
-        room_setup_thread = threading.Thread(target=self._setup_room, args=(conn, client_info))
-        room_setup_thread.start()
+        client_info = ClientInfo(client_conn=conn, username=sender_name, outbox=ClientOutbox(conn, username=sender_name))
+        self._enter_state(client_info, ConnectionStates.SETUP)
 
-        # Listen for chat massages after setup thread has finished
-        received_messages_thread = threading.Thread(target=self._receive_messages, args=(conn, client_info,))
-        received_messages_thread.start()
+        # One thread per client, it sets up the room and then listens for chat messages
+        client_thread = threading.Thread(target=self._serve_client, args=(frame_reader, client_info), name=f"client-{sender_name}")
+        client_thread.start()
 
-    def _setup_room(self, conn: socket.socket, client_info: ClientInfo) -> None:
-        json_data = conn.recv(1024).decode('utf-8')
-        setup_room_data = SetupRoomData(**json.loads(json_data))
+    def _serve_client(self, frame_reader: FrameReader, client_info: ClientInfo) -> None:
+        try:
+            self._setup_room(frame_reader, client_info)
+            self._receive_messages(frame_reader, client_info)
 
-        room_type = setup_room_data.room_type
+        except ConnectionError:
+            logger.info(f"Client {client_info.username} disconnected")
 
-        if RoomTypes[room_type.upper()] == RoomTypes.PRIVATE:
-            join_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            group_name = setup_room_data.group_name
-            self._private_room_setup_handler(conn=conn, username=client_info.username, join_timestamp=join_timestamp, group_name=group_name)
+        except (ProtocolError, ValueError) as e:  # Malformed frames and setup JSON
+            logger.warning(f"Closing connection of {client_info.username} after an invalid request: {e!r}")
 
-        else:
-            group_name = room_type
-            self._global_room_setup_handler(conn=conn, group_name=group_name)
+        except Exception:
+            logger.exception(f"Unexpected error while handling client {client_info.username}")
 
-        client_info.room_type = RoomTypes(room_type.upper())
-        client_info.current_room = group_name
-        self.room_name_to_active_clients[group_name].append(client_info)
+        finally:
+            # Also after a failed /switch, leaving a room the client already left is a no-op
+            self._remove_client_in_current_room(current_room=client_info.current_room, client_info=client_info)
+            client_info.outbox.abort()
+            client_info.client_conn.close()
 
-        client_info.room_setup_done_flag.set()
+    def _setup_room(self, frame_reader: FrameReader, client_info: ClientInfo) -> None:
+        setup_room_data = SetupRoomData.from_json(frame_reader.read_frame().json())
 
-        time.sleep(0.1)  # Ensure displaying joining msg after fetching messages from db (I know that's weird, just for displaying)
-        msg_obj = MessageInfo( type=MessageTypes.SYSTEM, text_message=f"{client_info.username} joined '{group_name}' group")
-        self._broadcast_to_all_active_clients_in_room(msg=msg_obj, current_room=client_info.current_room)
+        room_type = setup_room_data.room_type
+        group_name = self.setup_room_name(setup_room_data)
 
-    def _private_room_setup_handler(self, *, conn: socket.socket, username: str, join_timestamp: str, group_name: str) -> None:
-        with self.chat_db.session() as db_conn:
-            room_id = self.chat_db.get_room_id_from_rooms(db_conn=db_conn, room_name=group_name)
+        client_info.join_timestamp = None
+        client_info.history_cursor = None
 
-            user_join_timestamp = self.chat_db.get_user_join_timestamp(
-                db_conn=db_conn,
-                sender_name=username,
-                room_name=group_name
-            )
-            # If room still not exist, then create and add to 'checkin_room' table
-            if not room_id:
-                self.chat_db.create_room(db_conn=db_conn, room_name=group_name)
-                user_join_timestamp = join_timestamp
-                self.chat_db.create_user_checkin_room(db_conn=db_conn, sender_name=username, room_name=group_name, join_timestamp=user_join_timestamp)
+        if RoomTypes[room_type.upper()] == RoomTypes.PRIVATE:
+            join_timestamp = epoch_ms_now()
+            self._private_room_setup_handler(client_info=client_info, join_timestamp=join_timestamp, group_name=group_name)
 
-            # If room exists but user haven't checkin to this room yet
-            if not user_join_timestamp:
-                user_join_timestamp = join_timestamp
-                self.chat_db.create_user_checkin_room(db_conn=db_conn, sender_name=username, room_name=group_name, join_timestamp=user_join_timestamp)
+        else:
+            self._global_room_setup_handler(client_info=client_info, group_name=group_name)
 
-            # Users in private rooms will get only messages came after their first joining group timestamp
-            self._fetch_history_messages(conn=conn, db_conn=db_conn, group_name=group_name, join_timestamp=user_join_timestamp)
+        client_info.room_type = RoomTypes(room_type.upper())
+        client_info.current_room = group_name
+        self._add_client_to_room(current_room=group_name, client_info=client_info)
 
-    def _global_room_setup_handler(self, *, conn: socket.socket, group_name: str) -> None:
-        with self.chat_db.session() as db_conn:
-            self.chat_db.create_room(db_conn=db_conn, room_name=group_name)
-            self._fetch_history_messages(conn=conn, db_conn=db_conn, group_name=group_name)
+        # History frames are already in the client outbox, so the join notice and then the ack follow them in order
+        msg_obj = MessageInfo( type=MessageTypes.SYSTEM, text_message=f"{client_info.username} joined '{group_name}' group")
+        self._publish_to_room(msg=msg_obj, current_room=client_info.current_room)
+        self._enter_state(client_info, ConnectionStates.CHATTING)
 
-    def _fetch_history_messages(self, *, conn: socket.socket, db_conn: sqlite3.Connection, group_name: str, join_timestamp: typing.Optional[str] = None) -> None:
-        formated_messages_from_db = self.chat_db.send_previous_messages_in_room(db_conn=db_conn, room_name=group_name, join_timestamp=join_timestamp)
+    def _private_room_setup_handler(self, *, client_info: ClientInfo, join_timestamp: int, group_name: str) -> None:
+        username = client_info.username
 
-        first_msg = next(formated_messages_from_db, None)
+        # Check-ins of a cached room are cached as well, so joining it again doesn't touch the db
+        if (user_join_timestamp := self.history_cache.get_join_timestamp(group_name, username)) is None:
+            user_join_timestamp = self._check_in_private_room(username=username, join_timestamp=join_timestamp, group_name=group_name)
 
-        if not first_msg:
-            msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message=f"No messages in this chat yet ...{END_OF_MSG_INDICATOR}")
-            conn.send((msg_obj.formatted_msg()).encode('utf-8'))
+        # Users in private rooms will get only messages came after their first joining group timestamp
+        client_info.join_timestamp = user_join_timestamp
+        self._send_latest_history_messages(client_info=client_info, group_name=group_name)
+        self.history_cache.set_join_timestamp(group_name, username, user_join_timestamp)
 
-        else:
-            msg_with_indicator = first_msg + END_OF_MSG_INDICATOR
-            conn.send(msg_with_indicator.encode('utf-8'))
+    def _global_room_setup_handler(self, *, client_info: ClientInfo, group_name: str) -> None:
+        # A cached room is known to exist
+        if not self.history_cache.is_cached(group_name):
+            self._create_room(group_name)
 
-            for msg in formated_messages_from_db:
-                msg_with_indicator = msg + END_OF_MSG_INDICATOR
-                conn.send(msg_with_indicator.encode('utf-8'))
+        self._send_latest_history_messages(client_info=client_info, group_name=group_name)
 
-    def _receive_messages(self, conn: socket.socket, client_info: ClientInfo) -> None:
-        client_info.room_setup_done_flag.wait()
+    def _fetch_older_history_messages(self, client_info: ClientInfo) -> None:
+        if not client_info.has_older_history:
+            msg_obj = MessageInfo(type=MessageTypes.SYSTEM, text_message=f"No older messages in '{client_info.current_room}'")
+            client_info.outbox.put_many([msg_obj.wire_frame()])
+            return
 
+        with self.chat_db.session() as db_conn:
+            self._fetch_history_messages(client_info=client_info, db_conn=db_conn, group_name=client_info.current_room)
+
+    def _send_latest_history_messages(self, *, client_info: ClientInfo, group_name: str) -> None:
+        # Newest page on join, served from the cache (the room is loaded from the db on a miss)
+        history_page = self.history_cache.get_history_page(
+            group_name,
+            limit=MessageServerConfig.history_page_size,
+            join_timestamp=client_info.join_timestamp
+        )
+        client_info.history_cursor = history_page.oldest_message_id
+        client_info.has_older_history = history_page.has_more
+        self._send_history_frames(client_info=client_info, frames=history_page.frames, has_more=history_page.has_more)
+
+    @timed(HISTORY_FETCH_SECONDS)
+    def _fetch_history_messages(self, *, client_info: ClientInfo, db_conn: sqlite3.Connection, group_name: str) -> None:
+        # Sends the next older page on every /history
+        history_page = self._load_history_page(client_info=client_info, db_conn=db_conn, group_name=group_name)
+        self._send_history_frames(client_info=client_info, frames=[encode_text_frame(msg) for msg in history_page.messages], has_more=history_page.has_more)
+
+    def _receive_messages(self, frame_reader: FrameReader, client_info: ClientInfo) -> None:
         while True:
-            if msg := conn.recv(2048).decode('utf-8'):
-                if msg == '/switch':
-                    client_info.room_setup_done_flag.clear() # Clear flag so all messages will be sent to the setup from this time
+            msg = frame_reader.read_frame().text()
 
-                    self._remove_client_in_current_room(current_room=client_info.current_room, sender_username=client_info.username)
+            if msg:
+                if msg == '/switch':
+                    self._remove_client_in_current_room(current_room=client_info.current_room, client_info=client_info)
 
                     msg_obj = MessageInfo( type=MessageTypes.SYSTEM, text_message=f"{client_info.username} disconnected from '{client_info.current_room}'")
-                    self._broadcast_to_all_active_clients_in_room(
+                    self._publish_to_room(
                         msg= msg_obj,
                         current_room=client_info.current_room
                     )
 
-                    self._setup_room(conn, client_info)
+                    self._enter_state(client_info, ConnectionStates.SWITCHING)
+                    self._setup_room(frame_reader, client_info)
+
+                elif msg == '/history':
+                    self._fetch_older_history_messages(client_info)
 
                 else:
-                    msg_timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    trace = TRACER.start(client_info.current_room)
+                    msg_timestamp = epoch_ms_now()
                     msg_obj = MessageInfo(type=MessageTypes.CHAT, text_message=msg, sender_name=client_info.username, msg_timestamp=msg_timestamp)
+                    self._publish_to_room(msg=msg_obj, current_room=client_info.current_room, trace=trace)
+
+    def _publish_to_room(self, *, msg: MessageInfo, current_room: str, trace: typing.Optional[MessageTrace] = None) -> None:
+        final_msg = self._broadcast_to_all_active_clients_in_room(msg=msg, current_room=current_room)
+        if trace:
+            trace.span("broadcast")
+
+        if msg.type == MessageTypes.CHAT:
+            # Persisted in batches by the writer thread, blocks only when the writer queue is full.
+            # The encoded frame goes along to the history cache once the message is stored
+            self.message_writer.put(
+                PendingMessage(
+                    text_message=msg.text_message,
+                    sender_name=msg.sender_name,
+                    room_name=current_room,
+                    timestamp=msg.msg_timestamp,
+                    frame=final_msg,
+                    trace=trace
+                )
+            )
 
-                    self._broadcast_to_all_active_clients_in_room(
-                        msg=msg_obj,
-                        current_room=client_info.current_room
-                    )
-
-                    with self.chat_db.session() as db_conn:
-                        self.chat_db.store_message(db_conn=db_conn, text_message=msg, sender_name=client_info.username, room_name=client_info.current_room, timestamp=msg_timestamp)
-
-    def _broadcast_to_all_active_clients_in_room(self, *, msg: MessageInfo, current_room: str) -> None:
+    @timed(BROADCAST_SECONDS)
+    def _broadcast_to_all_active_clients_in_room(self, *, msg: MessageInfo, current_room: str) -> bytes:
         #clients who are connected to the client current room gets messages in real-time, and clients
         #connected to another room will fetch the messages from db while joining . e.g. chat, joining chat, leaving chat messages ...
-        if clients_in_room := self.room_name_to_active_clients.get(current_room):
-            for client in clients_in_room:
-                final_msg = msg.formatted_msg() + END_OF_MSG_INDICATOR
-                client.client_conn.send(final_msg.encode('utf-8'))
-
-    def _remove_client_in_current_room(self, *, current_room: str, sender_username: str) -> None:
-        self.room_name_to_active_clients[current_room] = [
-            client for client in self.room_name_to_active_clients[current_room] if client.username != sender_username
-        ]
+        # Formatted and encoded once (kept on the message), every client's writer sends the same immutable payload
+        final_msg = msg.wire_frame()
+        clients_in_room = self.room_registry.members(current_room)
+        for client in clients_in_room:
+            client.outbox.put(final_msg)
+        BROADCAST_BYTES.inc(len(final_msg) * len(clients_in_room))
+
+        if self.message_bus:
+            self.message_bus.publish(self._room_channel(current_room), final_msg)
+        return final_msg
+
+    def _add_client_to_room(self, *, current_room: str, client_info: ClientInfo) -> None:
+        if self.message_bus:
+            self.message_bus.subscribe(self._room_channel(current_room))
+        self.room_registry.join(current_room, client_info)
+
+    def _remove_client_in_current_room(self, *, current_room: str, client_info: ClientInfo) -> bool:
+        removed = self.room_registry.leave(current_room, client_info)
+        if removed and self.message_bus:
+            self.message_bus.unsubscribe(self._room_channel(current_room))
+        return removed
+
+    @staticmethod
+    def _room_channel(room_name: str) -> str:
+        return f"room:{room_name}"
+
+    def _on_messages_stored(self, messages: typing.Sequence[PendingMessage], message_ids: typing.Optional[range]) -> None:
+        super()._on_messages_stored(messages, message_ids)
+
+        if self.message_bus:
+            for room_name in {message.room_name for message in messages}:
+                self.message_bus.publish(HISTORY_CHANNEL, room_name.encode('utf-8'))
+
+    def _on_bus_message(self, channel: str, payload: bytes) -> None:
+        if channel == HISTORY_CHANNEL:
+            # Another node committed messages to the room, its cached history is behind the db now
+            self.history_cache.invalidate(payload.decode('utf-8'))
+            return
+
+        # A broadcast of another node, payload is the encoded frame
+        room_name = channel[len("room:"):]
+        for client in self.room_registry.members(room_name):
+            client.outbox.put(payload)
 
     def start(self):
         print("Chat Server started...")
-        while True:
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                client_sock, addr = self.chat_server.accept()
-                logger.info(f"Successfully connected client {addr[0]} {addr[1]} to messages server\n")
-                executor.submit(self.client_handler, client_sock)
+        try:
+            while True:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    client_sock, addr = self.chat_server.accept()
+                    logger.info(f"Successfully connected client {addr[0]} {addr[1]} to messages server\n")
+                    executor.submit(self.client_handler, client_sock)
+        finally:
+            self.message_writer.close()
 
 def main():
-    chat_server = ChatServer(host='127.0.0.1', listen_port=MessageServerConfig.listening_port)
-    chat_server.start()
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument(
+        "--mode",
+        choices=[mode.value for mode in ServerModes],
+        default=MessageServerConfig.server_mode,
+        type=str.upper,
+        help="THREADED spawns threads per client, ASYNC serves all clients from a single event loop, "
+             "SHARDED spreads the rooms over --shards threaded worker processes (Linux only)"
+    )
+    parser.add_argument("--shards", type=int, default=MessageServerConfig.shards, help="Worker processes of the SHARDED mode")
+    parser.add_argument("--port", type=int, default=MessageServerConfig.listening_port)
+    parser.add_argument(
+        "--bus-socket",
+        default=None,
+        help="THREADED only, shares the rooms with the other chat servers connected to the message bus broker on this Unix socket"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=MetricsConfig.chat_port if MetricsConfig.enabled else None,
+        help="Serves Prometheus metrics on http://127.0.0.1:<port>/metrics (SHARDED workers on the following ports), off when not set"
+    )
+    parser.add_argument(
+        "--trace-slow-ms",
+        type=float,
+        default=None,
+        help="Traces every chat message from receipt to commit and logs the spans of those slower than this"
+    )
+    args = parser.parse_args()
+
+    # SHARDED workers are forked from this process and inherit both
+    install_profile_signal()
+    if args.trace_slow_ms is not None:
+        TRACER.enabled = True
+        TRACER.slow_ms = args.trace_slow_ms
+
+    if args.metrics_port and ServerModes(args.mode) != ServerModes.SHARDED:
+        METRICS.serve(port=args.metrics_port)
+
+    if ServerModes(args.mode) == ServerModes.ASYNC:
+        async_chat_server = AsyncChatServer(host='127.0.0.1', listen_port=args.port)
+        asyncio.run(async_chat_server.start())
+
+    elif ServerModes(args.mode) == ServerModes.SHARDED:
+        from server.sharded_server_chat import ShardedChatServer  # Imports this module
+
+        sharded_chat_server = ShardedChatServer(host='127.0.0.1', listen_port=args.port, shards=args.shards, metrics_port=args.metrics_port)
+        sharded_chat_server.start()
+
+    else:
+        message_bus = UnixSocketMessageBus(args.bus_socket) if args.bus_socket else None
+        chat_server = ChatServer(host='127.0.0.1', listen_port=args.port, message_bus=message_bus)
+        chat_server.start()
 
 if __name__ == '__main__':
     logging.basicConfig(
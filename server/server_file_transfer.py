@@ -1,18 +1,29 @@
-import json
+import argparse
 import logging
 import os
 import socket
+import threading
+import typing
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from logging import getLogger
 
-from config import FileServerConfig
-from db import ChatDB
-from definitions import DownloadFileError, UploadFileError, FileHandlerTypes, FileTransferStatus, UploadFileData, DownloadFileData
-from utils import chunkify
+from config import FileServerConfig, MetricsConfig
+from server.blob_store import BlobStore, blobs_root_dir
+from server.db.chat_db import ChatDB, FileRecord, PartialUpload
+from server.metrics import METRICS, timed
+from server.profiler import install_profile_signal
+from definitions import DownloadFileError, UploadFileError, ProtocolError, FileHandlerTypes, FileTransferStatus, UploadFileData, UploadFilePartData, UploadCommitData, UploadFileOffer, DownloadFileData, DownloadFileHeader
+from utils import chunkify, epoch_ms_now, hash_file_prefix, FrameReader, encode_text_frame, encode_json_frame
 
 logger = getLogger(__name__)
 
+UPLOAD_SECONDS = METRICS.histogram("file_upload_seconds", "Time to serve an upload request, parts uploaded in parallel are timed on their own")
+UPLOAD_PART_SECONDS = METRICS.histogram("file_upload_part_seconds", "Time to receive one part of a parallel upload")
+DOWNLOAD_SECONDS = METRICS.histogram("file_download_seconds", "Time to serve a download request")
+RECEIVED_BYTES = METRICS.counter("file_received_bytes", "File bytes received by uploads")
+SENT_BYTES = METRICS.counter("file_sent_bytes", "File bytes streamed by downloads")
+
 class FileTransferServer:
     def __init__(self, host: str, listen_port: int):
         self._file_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -24,93 +35,399 @@ class FileTransferServer:
         self._file_server.listen(FileServerConfig.listener_limit_number)
 
         self.chat_db = ChatDB()
+        with self.chat_db.session() as db_conn:
+            self.chat_db.setup_database(db_conn=db_conn)
+
+        self.blob_store = BlobStore(chat_db=self.chat_db, root_dir=blobs_root_dir())
+
+        self._active_uploads: typing.Set[typing.Tuple[str, typing.Optional[int]]] = set()  # (file id, part index)
+        self._active_uploads_lock = threading.Lock()
 
     @property
     def file_server(self) -> socket.socket:
         return self._file_server
 
     def file_handler(self, conn: socket.socket) -> None:
-        while True:
-            handler = conn.recv(1024).decode()
-            try:
-                handler_type = FileHandlerTypes[handler]
+        frame_reader = FrameReader(conn)
+        try:
+            while True:
+                handler = frame_reader.read_frame().text()
 
-            except Exception:
-                logger.exception(f"Got an unexpected handler type {handler}")
-                raise KeyError(f"Got an unexpected handler type {handler}")
+                try:
+                    handler_type = FileHandlerTypes[handler]
 
-            else:
-                json_data = conn.recv(1024).decode()
+                except Exception:
+                    logger.exception(f"Got an unexpected handler type {handler}")
+                    raise KeyError(f"Got an unexpected handler type {handler}")
+
+                else:
+                    json_data = frame_reader.read_frame().json()
+
+                    if handler_type == FileHandlerTypes.UPLOAD:
+                        upload_data = UploadFileData.from_json(json_data)
+                        self._upload_file(conn=conn, frame_reader=frame_reader, data=upload_data)
+
+                    elif handler_type == FileHandlerTypes.UPLOAD_PART:
+                        upload_part_data = UploadFilePartData.from_json(json_data)
+                        self._upload_file_part(conn=conn, frame_reader=frame_reader, data=upload_part_data)
+
+                    elif handler_type == FileHandlerTypes.UPLOAD_COMMIT:
+                        upload_commit_data = UploadCommitData.from_json(json_data)
+                        self._commit_upload(conn=conn, data=upload_commit_data)
 
-                if handler_type == FileHandlerTypes.UPLOAD:
-                    upload_data = UploadFileData(**json.loads(json_data))
-                    self._upload_file(conn=conn, data=upload_data)
+                    elif handler_type == FileHandlerTypes.DOWNLOAD:
+                        download_data = DownloadFileData.from_json(json_data)
+                        self._download_file(conn=conn, data=download_data)
 
-                elif handler_type == FileHandlerTypes.DOWNLOAD:
-                    download_data = DownloadFileData(**json.loads(json_data))
-                    self._download_file(conn=conn, data=download_data)
+        except ConnectionError:
+            logger.info("Client disconnected from files server")
 
-    def _upload_file(self, *, conn: socket.socket, data: UploadFileData) -> None:
+        except (ProtocolError, KeyError, ValueError) as e:
+            # Also bad JSON and unknown handler types, the stream can't be trusted after them
+            logger.warning(f"Closing files connection after an invalid request: {e!r}")
+
+        except (UploadFileError, DownloadFileError) as e:
+            # Already answered with FAILED, the client reconnects and resumes
+            logger.warning(f"Closing files connection after a failed transfer: {e}")
+
+        finally:
+            conn.close()
+
+    @timed(UPLOAD_SECONDS)
+    def _upload_file(self, *, conn: socket.socket, frame_reader: FrameReader, data: UploadFileData) -> None:
         logger.info("Server got upload request")
-        file_id = self._generate_file_id(file_name=data.filename)
-        file_size = data.file_size
 
-        if file_size > FileServerConfig.max_file_size:
-            conn.send(FileTransferStatus.EXCEEDED.value.encode('utf-8'))
-            logger.warning(f"File {data.filename} has exceeded 16 MB")
+        if data.file_size > FileServerConfig.max_file_size:
+            conn.sendall(encode_text_frame(FileTransferStatus.EXCEEDED.value))
+            logger.warning(f"File {data.filename} has exceeded {FileServerConfig.max_file_size} bytes")
+            return
+
+        if not self._is_plain_file_name(data.filename):
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.warning(f"Rejected upload of {data.filename!r}, file names can't contain a path")
+            return
+
+        if not 1 <= data.parts <= FileServerConfig.max_upload_parts:
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.warning(f"Upload of {data.filename} asked for {data.parts} parts, up to {FileServerConfig.max_upload_parts} are allowed")
+            return
+
+        partial_upload = self._resume_or_start_upload(data)
+        if partial_upload.parts > 1:
+            self._offer_upload_parts(conn=conn, partial_upload=partial_upload)
+            return
+
+        with self._claim_upload((partial_upload.file_id, None)) as claimed:
+            if not claimed:
+                conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+                logger.warning(f"Upload of {partial_upload.file_id} is already in progress")
+                return
+
+            self._receive_file(conn=conn, frame_reader=frame_reader, data=data, file_id=partial_upload.file_id)
+
+    def _resume_or_start_upload(self, data: UploadFileData) -> PartialUpload:
+        with self.chat_db.session() as db_conn:
+            if data.file_id:
+                partial_upload = self.chat_db.get_partial_upload(db_conn=db_conn, file_id=data.file_id)
+
+                # Resumed only if it's the same file sent the same way, otherwise the upload starts over under a new id
+                if partial_upload and partial_upload[1:] == (data.filename, data.file_size, data.checksum, data.parts):
+                    logger.info(f"Resuming upload of {data.file_id}")
+                    return partial_upload
+
+            partial_upload = PartialUpload(
+                file_id=self._generate_file_id(file_name=data.filename),
+                file_name=data.filename,
+                file_size=data.file_size,
+                checksum=data.checksum,
+                parts=data.parts
+            )
+            self.chat_db.store_partial_upload(db_conn=db_conn, created_at=epoch_ms_now(), **partial_upload._asdict())
+            return partial_upload
+
+    @contextmanager
+    def _claim_upload(self, upload_key: typing.Tuple[str, typing.Optional[int]]) -> typing.Generator[bool, None, None]:
+        # Two connections writing the same file (or the same part of it) would corrupt each other
+        with self._active_uploads_lock:
+            claimed = upload_key not in self._active_uploads
+            self._active_uploads.add(upload_key)
+
+        if not claimed:
+            yield False
             return
 
-        uploaded_file_path = os.path.join(FileServerConfig.upload_dir_dst_path(), file_id)
-        aggregated_chunks = b""
+        try:
+            yield True
+        finally:
+            with self._active_uploads_lock:
+                self._active_uploads.discard(upload_key)
+
+    def _receive_file(self, *, conn: socket.socket, frame_reader: FrameReader, data: UploadFileData, file_id: str) -> None:
+        partial_file_path = self._partial_file_path(file_id)
 
         try:
-            with open(uploaded_file_path, 'wb') as file:
-                while True:
-                    chunk = conn.recv(1024)
-                    if not chunk:
-                        break
+            file = open(partial_file_path, 'r+b' if os.path.exists(partial_file_path) else 'w+b')
+        except OSError as e:
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.exception(f"Failed write to {partial_file_path}")
+            raise UploadFileError(f"Failed write to {partial_file_path}") from e
 
-                    aggregated_chunks += chunk
+        with file:
+            # Only verified chunks are written, so whatever is on disk is a valid prefix to resume from
+            offset = min(os.fstat(file.fileno()).st_size, data.file_size)
+            file_hash = hash_file_prefix(reader_file=file, size=offset)
+            file.truncate(offset)
+
+            conn.sendall(encode_json_frame(UploadFileOffer(file_id=file_id, offset=offset).as_dict()))
+
+            received_bytes = offset
+            try:
+                for chunk in self._receive_chunks(frame_reader=frame_reader, length=data.file_size - offset):
                     file.write(chunk)
+                    file_hash.update(chunk)
+                    received_bytes += len(chunk)
 
-                    if len(aggregated_chunks) == file_size:
-                        break
+            except ProtocolError as e:
+                # The stream can't be resynced, the client reconnects and resumes after the last good chunk
+                conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+                logger.warning(f"Upload of {file_id} stopped at {received_bytes} of {data.file_size} bytes: {e}")
+                raise UploadFileError(f"Upload of {file_id} is incomplete") from e
 
-        except Exception as e:
-            conn.send(FileTransferStatus.FAILED.value.encode('utf-8'))
-            logger.exception(f"Failed write to {uploaded_file_path}")
-            raise UploadFileError(f"Failed write to {uploaded_file_path}") from e
+            except ConnectionError:
+                logger.info(f"Connection closed after {received_bytes} of {data.file_size} bytes of {file_id}, kept for resuming")
+                raise
+
+        self._complete_upload(conn=conn, file_id=file_id, file_size=data.file_size, checksum=data.checksum, received_checksum=file_hash.hexdigest())
+
+    def _offer_upload_parts(self, *, conn: socket.socket, partial_upload: PartialUpload) -> None:
+        partial_file_path = self._partial_file_path(partial_upload.file_id)
+
+        # Parts are written in place, so the file gets its final size up front (sparse where the file system allows)
+        try:
+            with open(partial_file_path, 'ab') as file:
+                file.truncate(partial_upload.file_size)
+        except OSError as e:
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.exception(f"Failed write to {partial_file_path}")
+            raise UploadFileError(f"Failed write to {partial_file_path}") from e
+
+        with self.chat_db.session() as db_conn:
+            uploaded_parts = self.chat_db.get_uploaded_parts(db_conn=db_conn, file_id=partial_upload.file_id)
+
+        missing_parts = [part_index for part_index in range(partial_upload.parts) if part_index not in uploaded_parts]
+        upload_offer = UploadFileOffer(file_id=partial_upload.file_id, offset=0, missing_parts=missing_parts)
+        conn.sendall(encode_json_frame(upload_offer.as_dict()))
+
+    @timed(UPLOAD_PART_SECONDS)
+    def _upload_file_part(self, *, conn: socket.socket, frame_reader: FrameReader, data: UploadFilePartData) -> None:
+        with self.chat_db.session() as db_conn:
+            partial_upload = self.chat_db.get_partial_upload(db_conn=db_conn, file_id=data.file_id)
+            uploaded_parts = self.chat_db.get_uploaded_parts(db_conn=db_conn, file_id=data.file_id) if partial_upload else set()
+
+        if not partial_upload or partial_upload.parts == 1 or not 0 <= data.part_index < partial_upload.parts or data.part_index in uploaded_parts:
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.warning(f"Part {data.part_index} of {data.file_id} isn't expected")
+            return
+
+        with self._claim_upload((data.file_id, data.part_index)) as claimed:
+            if not claimed:
+                conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+                logger.warning(f"Part {data.part_index} of {data.file_id} is already in progress")
+                return
+
+            self._receive_file_part(conn=conn, frame_reader=frame_reader, partial_upload=partial_upload, part_index=data.part_index)
+
+    def _receive_file_part(self, *, conn: socket.socket, frame_reader: FrameReader, partial_upload: PartialUpload, part_index: int) -> None:
+        # A part that didn't finish is sent again from its start, finished parts are kept across reconnects
+        part_offset, part_length = partial_upload.part_range(part_index)
+        partial_file_path = self._partial_file_path(partial_upload.file_id)
+
+        try:
+            fd = os.open(partial_file_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        except OSError as e:
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.exception(f"Failed write to {partial_file_path}")
+            raise UploadFileError(f"Failed write to {partial_file_path}") from e
+
+        try:
+            conn.sendall(encode_json_frame(UploadFileOffer(file_id=partial_upload.file_id, offset=part_offset, length=part_length).as_dict()))
+
+            written_bytes = 0
+            try:
+                for chunk in self._receive_chunks(frame_reader=frame_reader, length=part_length):
+                    self._write_at(fd=fd, chunk=chunk, offset=part_offset + written_bytes)
+                    written_bytes += len(chunk)
+
+            except ProtocolError as e:
+                conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+                logger.warning(f"Part {part_index} of {partial_upload.file_id} stopped at {written_bytes} of {part_length} bytes: {e}")
+                raise UploadFileError(f"Part {part_index} of {partial_upload.file_id} is incomplete") from e
+
+        finally:
+            os.close(fd)
+
+        with self.chat_db.session() as db_conn:
+            self.chat_db.store_upload_part(db_conn=db_conn, file_id=partial_upload.file_id, part_index=part_index)
+
+        conn.sendall(encode_text_frame(FileTransferStatus.SUCCEED.value))
+
+    def _commit_upload(self, *, conn: socket.socket, data: UploadCommitData) -> None:
+        with self.chat_db.session() as db_conn:
+            partial_upload = self.chat_db.get_partial_upload(db_conn=db_conn, file_id=data.file_id)
+            uploaded_parts = self.chat_db.get_uploaded_parts(db_conn=db_conn, file_id=data.file_id) if partial_upload else set()
+
+        if not partial_upload or len(uploaded_parts) < partial_upload.parts:
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.warning(f"Upload of {data.file_id} can't be committed, parts are missing")
+            return
+
+        with self._claim_upload((data.file_id, None)) as claimed:
+            if not claimed:
+                conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+                logger.warning(f"Upload of {data.file_id} is already being committed")
+                return
+
+            # Parts arrive out of order, so the whole file checksum is computed once they're all on disk
+            with open(self._partial_file_path(data.file_id), 'rb') as file:
+                file_hash = hash_file_prefix(reader_file=file, size=partial_upload.file_size)
+
+            self._complete_upload(
+                conn=conn,
+                file_id=data.file_id,
+                file_size=partial_upload.file_size,
+                checksum=partial_upload.checksum,
+                received_checksum=file_hash.hexdigest()
+            )
 
+    def _complete_upload(self, *, conn: socket.socket, file_id: str, file_size: int, checksum: str, received_checksum: str) -> None:
+        partial_file_path = self._partial_file_path(file_id)
+
+        if received_checksum != checksum:
+            os.remove(partial_file_path)
+            with self.chat_db.session() as db_conn:
+                self.chat_db.delete_partial_upload(db_conn=db_conn, file_id=file_id)
+
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            logger.warning(f"Checksum mismatch for {file_id}, upload is discarded")
+            return
+
+        # The file is stored (or found already stored) by its content only once it's complete and verified
+        self.blob_store.store(file_path=partial_file_path, file_id=file_id, file_size=file_size, checksum=checksum)
         with self.chat_db.session() as db_conn:
-            self.chat_db.store_file_in_files(db_conn=db_conn, file_path=uploaded_file_path, file_id=file_id)
+            self.chat_db.delete_partial_upload(db_conn=db_conn, file_id=file_id)
 
-        conn.send(file_id.encode('utf-8'))
+        conn.sendall(encode_text_frame(file_id))
         logger.info(f"Uploading done, File id has sent to client ...")
 
+    @staticmethod
+    def _receive_chunks(*, frame_reader: FrameReader, length: int) -> typing.Generator[memoryview, None, None]:
+        # Every chunk is CRC32 checked and received straight into one reused buffer, valid until the next one
+        buffer = memoryview(bytearray(FileServerConfig.upload_buffer_size))
+        received_bytes = 0
+        while received_bytes < length:
+            chunk = frame_reader.read_chunk_into(buffer)
+            if not chunk or received_bytes + len(chunk) > length:
+                raise ProtocolError(f"Unexpected chunk of {len(chunk)} bytes at {received_bytes} of {length} bytes")
+
+            received_bytes += len(chunk)
+            RECEIVED_BYTES.inc(len(chunk))
+            yield chunk
+
+    @staticmethod
+    def _write_at(*, fd: int, chunk: memoryview, offset: int) -> None:
+        # pwrite doesn't use the file position, Windows lacks it but every part has its own fd anyway
+        while chunk:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, chunk, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, chunk)
+
+            chunk = chunk[written:]
+            offset += written
+
+    @staticmethod
+    def _partial_file_path(file_id: str) -> str:
+        # Named by the server generated uuid of the file id only, the client's file name never reaches the path
+        upload_uuid = uuid.UUID(file_id[len("file_id-"):len("file_id-") + 36])
+        return os.path.join(FileServerConfig.upload_dir_dst_path(), f"{upload_uuid}.part")
+
+    @timed(DOWNLOAD_SECONDS)
     def _download_file(self, *, conn: socket.socket, data: DownloadFileData) -> None:
         logger.info("Server got download request")
         file_id = data.file_id
-        user_dir_dst_path = data.dst_path
 
         with self.chat_db.session() as db_conn:
-            uploaded_file_path = self.chat_db.get_file_path_by_file_id(db_conn=db_conn, file_id=file_id)
+            file_record = self.chat_db.get_file_by_file_id(db_conn=db_conn, file_id=file_id)
 
-        if uploaded_file_path:
-            file_name = os.path.basename(uploaded_file_path).rsplit('-', 1)[1]
-            try:
-                with open(uploaded_file_path, 'rb') as src_file, open(os.path.join(user_dir_dst_path, file_name), 'wb') as dst_file:
-                    for chunk in chunkify(reader_file=src_file):
-                        dst_file.write(chunk)
-                conn.send(FileTransferStatus.SUCCEED.value.encode('utf-8'))
+        if not file_record:
+            logger.warning(f"File id was not found")
+            conn.sendall(encode_text_frame(FileTransferStatus.NOT_FOUND.value))
+            return
 
-            except Exception as e:
-                logger.exception(f"Download failed, probably cannot write to {data.dst_path} ")
-                conn.send(FileTransferStatus.FAILED.value.encode('utf-8'))
-                raise DownloadFileError(f"Failed to download {file_id}") from e
+        if file_record.checksum:
+            self.blob_store.touch(file_record.checksum)  # Recently downloaded blobs are evicted last
 
+        if data.dst_path:
+            self._copy_file_to_shared_dir(conn=conn, file_id=file_id, uploaded_file_path=file_record.file_path, dst_path=data.dst_path)
         else:
-            logger.warning(f"File id was not found")
-            conn.send(FileTransferStatus.NOT_FOUND.value.encode('utf-8'))
+            self._stream_file(conn=conn, file_id=file_id, file_record=file_record, offset=data.offset, length=data.length)
+
+    def _stream_file(self, *, conn: socket.socket, file_id: str, file_record: FileRecord, offset: int, length: typing.Optional[int]) -> None:
+        # Header first, then the requested range as raw bytes with sendfile (os.sendfile on Linux, the file never enters user space)
+        try:
+            file = open(file_record.file_path, 'rb')
+        except OSError as e:
+            logger.exception(f"Download failed, cannot read {file_record.file_path}")
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            raise DownloadFileError(f"Failed to download {file_id}") from e
+
+        with file:
+            file_size = os.fstat(file.fileno()).st_size
+            if not 0 <= offset <= file_size or (length is not None and length < 0):
+                logger.warning(f"Requested range ({offset}, {length}) is out of {file_id} ({file_size} bytes)")
+                conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+                return
+
+            length = file_size - offset if length is None else min(length, file_size - offset)
+            download_header = DownloadFileHeader(
+                file_name=self._file_name_from_file_id(file_id),
+                file_size=file_size,
+                offset=offset,
+                length=length,
+                checksum=file_record.checksum
+            )
+            conn.sendall(encode_json_frame(download_header.as_dict()))
+
+            # Once the header is out a failure can't be reported in band, the connection is dropped and the client resumes
+            if length:
+                conn.sendfile(file, offset, length)
+                SENT_BYTES.inc(length)
+        logger.info(f"Streamed {length} bytes of {file_id} from offset {offset}")
+
+    def _copy_file_to_shared_dir(self, *, conn: socket.socket, file_id: str, uploaded_file_path: str, dst_path: str) -> None:
+        # Only works when client and server share a disk
+        file_name = self._file_name_from_file_id(file_id)
+        try:
+            with open(uploaded_file_path, 'rb') as src_file, open(os.path.join(dst_path, file_name), 'wb') as dst_file:
+                for chunk in chunkify(reader_file=src_file):
+                    dst_file.write(chunk)
+            conn.sendall(encode_text_frame(FileTransferStatus.SUCCEED.value))
+
+        except Exception as e:
+            logger.exception(f"Download failed, probably cannot write to {dst_path} ")
+            conn.sendall(encode_text_frame(FileTransferStatus.FAILED.value))
+            raise DownloadFileError(f"Failed to download {file_id}") from e
+
+    @staticmethod
+    def _file_name_from_file_id(file_id: str) -> str:
+        # file_id-<uuid>-<file name>, the uuid is 36 chars with dashes of its own
+        return file_id[len("file_id-") + 37:]
+
+    @staticmethod
+    def _is_plain_file_name(file_name: str) -> bool:
+        # The name ends up in the file id, which names the file in downloads and shared dir copies
+        return file_name not in ('', '.', '..') and not any(separator in file_name for separator in ('/', '\\', '\0'))
 
     @staticmethod
     def _generate_file_id(*, file_name: str) -> str:
@@ -118,13 +435,27 @@ class FileTransferServer:
 
     def start(self):
         print("File Server started...")
-        with ThreadPoolExecutor(max_workers=FileServerConfig.max_threads_number) as executor:
-            while True:
-                client_sock, addr = self.file_server.accept()
-                logger.info(f"Successfully connected client {addr[0]} {addr[1]} to files server \n")
-                executor.submit(self.file_handler, client_sock)
+        # One thread per connection like the chat server: every chat client keeps an idle file connection open,
+        # so a bounded pool would leave the short lived upload part connections waiting behind them
+        while True:
+            client_sock, addr = self.file_server.accept()
+            logger.info(f"Successfully connected client {addr[0]} {addr[1]} to files server \n")
+            threading.Thread(target=self.file_handler, args=(client_sock,), name=f"files-{addr[1]}", daemon=True).start()
 
 def main():
+    parser = argparse.ArgumentParser(description="File transfer server")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=MetricsConfig.file_port if MetricsConfig.enabled else None,
+        help="Serves Prometheus metrics on http://127.0.0.1:<port>/metrics, off when not set"
+    )
+    args = parser.parse_args()
+
+    install_profile_signal()
+    if args.metrics_port:
+        METRICS.serve(port=args.metrics_port)
+
     file_transfer_server = FileTransferServer(host='127.0.0.1', listen_port=FileServerConfig.listening_port)
     file_transfer_server.start()
 
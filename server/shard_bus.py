@@ -0,0 +1,113 @@
+import collections
+import json
+import os
+import socket
+import threading
+import time
+import typing
+from logging import getLogger
+
+from utils import FrameReader, encode_json_frame, encode_text_frame, send_frames
+
+logger = getLogger(__name__)
+
+BusEventHandler = typing.Callable[[typing.Dict[str, typing.Any], typing.Optional[str]], None]
+
+def connect_unix_socket(path: str, *, sock_type: int = socket.SOCK_STREAM, timeout_seconds: float = 10.0) -> socket.socket:
+    """ Connects to a Unix socket that another process may not be listening on yet """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        sock = socket.socket(socket.AF_UNIX, sock_type)
+        try:
+            sock.connect(path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class _BusPeer:
+    """ Outbound events to one shard, sent by their own writer thread so the sender (e.g. a bus reader) never blocks on it """
+    def __init__(self, path: str):
+        self.path = path
+        self._frames: typing.Deque[bytes] = collections.deque()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name=f"bus-writer-{os.path.basename(path)}", daemon=True).start()
+
+    def put(self, frames: typing.Sequence[bytes]) -> None:
+        with self._condition:
+            self._frames.extend(frames)
+            self._condition.notify()
+
+    def _run(self) -> None:
+        sock = connect_unix_socket(self.path)
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._frames)
+                frames = list(self._frames)
+                self._frames.clear()
+            # Everything queued meanwhile goes out in one gathered write
+            send_frames(sock, frames)
+
+
+class ShardBus:
+    """
+    Links the worker processes of a sharded chat server over Unix stream sockets, every shard listens on
+    <run_dir>/bus-<shard index>.sock and connects to a peer on its first event for it.
+    An event is a JSON frame, optionally followed by a text frame (a chat message), and the events from one
+    process to another arrive in the order they were sent. on_event is called from the bus reader threads.
+    """
+    def __init__(self, *, shard_index: int, run_dir: str, on_event: BusEventHandler):
+        self.shard_index = shard_index
+        self.run_dir = run_dir
+        self.on_event = on_event
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path(run_dir, shard_index))
+        self._listener.listen()
+
+        self._peers: typing.Dict[int, _BusPeer] = {}
+        self._peers_lock = threading.Lock()
+
+    @staticmethod
+    def socket_path(run_dir: str, shard_index: int) -> str:
+        return os.path.join(run_dir, f"bus-{shard_index}.sock")
+
+    def start(self) -> None:
+        threading.Thread(target=self._accept_peers, name=f"bus-{self.shard_index}", daemon=True).start()
+
+    def send(self, shard_index: int, event: typing.Dict[str, typing.Any], text: typing.Optional[str] = None) -> None:
+        frames = [encode_json_frame({**event, "has_text": text is not None})]
+        if text is not None:
+            frames.append(encode_text_frame(text))
+
+        if (peer := self._peers.get(shard_index)) is None:
+            with self._peers_lock:
+                if (peer := self._peers.get(shard_index)) is None:
+                    peer = self._peers[shard_index] = _BusPeer(self.socket_path(self.run_dir, shard_index))
+        # Both frames of an event are queued together, and events to a peer keep their order
+        peer.put(frames)
+
+    def _accept_peers(self) -> None:
+        while True:
+            peer, _ = self._listener.accept()
+            threading.Thread(target=self._read_events, args=(peer,), name=f"bus-{self.shard_index}-reader", daemon=True).start()
+
+    def _read_events(self, peer: socket.socket) -> None:
+        frame_reader = FrameReader(peer)
+        try:
+            while True:
+                event = frame_reader.read_frame().json()
+                text = frame_reader.read_frame().text() if event.pop("has_text") else None
+                try:
+                    self.on_event(event, text)
+                except Exception:
+                    logger.exception(f"Shard {self.shard_index} failed to handle bus event {json.dumps(event)}")
+
+        except ConnectionError:
+            logger.info(f"Shard {self.shard_index} lost a bus peer")
+
+        finally:
+            peer.close()
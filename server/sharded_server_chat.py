@@ -0,0 +1,337 @@
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import time
+import typing
+from logging import getLogger
+
+from config import MessageServerConfig, ProtocolConfig
+from definitions import ClientInfo, MessageInfo, MessageTypes, SetupRoomData, ProtocolError, ConnectionStates
+from server.metrics import METRICS
+from server.server_chat import ChatServer
+from server.tracing import MessageTrace
+from server.shard_bus import ShardBus, connect_unix_socket
+from utils import FrameDecoder, encode_text_frame, encode_json_frame
+
+logger = getLogger(__name__)
+
+# Handed over connections carry the username and setup frames the acceptor read, and whatever came after them.
+# Sent as a single Unix datagram, so it must stay well under the socket buffer size
+MAX_PRELUDE_SIZE = ProtocolConfig.frame_buffer_size
+
+class HashRing:
+    """
+    Consistent hashing of room names to shards. Every shard owns virtual_nodes points on the ring and a room
+    belongs to the first point after its hash, so rooms spread evenly and adding a shard moves only ~1/n of them.
+    Hashed with blake2b rather than hash(), which is salted per process.
+    """
+    def __init__(self, shards: int, *, virtual_nodes: int = MessageServerConfig.shard_virtual_nodes):
+        self.shards = shards
+        points = sorted(
+            (self._hash(f"shard-{shard_index}-{node_index}"), shard_index)
+            for shard_index in range(shards)
+            for node_index in range(virtual_nodes)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._shard_indexes = [shard_index for _, shard_index in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def shard_for(self, room_name: str) -> int:
+        index = bisect.bisect(self._hashes, self._hash(room_name)) % len(self._hashes)
+        return self._shard_indexes[index]
+
+
+class _PendingHandoff:
+    """ A client the acceptor hasn't handed off yet, its frames are decoded as they arrive """
+    __slots__ = ('conn', 'decoder', 'sender_name', 'last_active')
+
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+        self.decoder = FrameDecoder()
+        self.sender_name: typing.Optional[str] = None
+        self.last_active = time.monotonic()
+
+
+class ShardChatServer(ChatServer):
+    """
+    One worker process of a sharded chat server. It gets its clients from the acceptor instead of a tcp listener,
+    and every room is owned by one shard of the ring: the owner broadcasts and stores all of the room messages, so
+    the room history and its cache live in a single process.
+    A client that switches to a room of another shard stays connected here, its messages are posted to the owner
+    over the shard bus and the owner delivers every room message back to the shards that have members in it.
+    """
+    def __init__(self, *, shard_index: int, ring: HashRing, run_dir: str):
+        self.shard_index = shard_index
+        self.ring = ring
+
+        self._chat_server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._chat_server.bind(ShardedChatServer.handoff_socket_path(run_dir, shard_index))
+        self._chat_server.listen(1)
+        self._setup_state()
+
+        self.bus = ShardBus(shard_index=shard_index, run_dir=run_dir, on_event=self._on_bus_event)
+
+        self._subscriptions_lock = threading.Lock()
+        self._room_subscribers: typing.Dict[str, typing.FrozenSet[int]] = {}  # Owned room -> other shards with members in it
+        self._remote_room_members: typing.Dict[str, int] = {}  # Other shards' room -> members connected here
+        self._pending_acks: typing.Dict[int, ClientInfo] = {}  # Sync token -> client joining another shard's room
+        self._sync_tokens = itertools.count()
+
+    def is_owner(self, room_name: str) -> bool:
+        return self.ring.shard_for(room_name) == self.shard_index
+
+    def _add_client_to_room(self, *, current_room: str, client_info: ClientInfo) -> None:
+        if not self.is_owner(current_room):
+            with self._subscriptions_lock:
+                self._remote_room_members[current_room] = self._remote_room_members.get(current_room, 0) + 1
+                if self._remote_room_members[current_room] == 1:
+                    # Sent before anything is posted to the room from here, so the owner delivers the join message back
+                    self.bus.send(self.ring.shard_for(current_room), {"type": "subscribe", "room": current_room, "shard": self.shard_index})
+
+        super()._add_client_to_room(current_room=current_room, client_info=client_info)
+
+    def _remove_client_in_current_room(self, *, current_room: str, client_info: ClientInfo) -> bool:
+        removed = super()._remove_client_in_current_room(current_room=current_room, client_info=client_info)
+
+        if removed and not self.is_owner(current_room):
+            with self._subscriptions_lock:
+                self._remote_room_members[current_room] -= 1
+                if not self._remote_room_members[current_room]:
+                    del self._remote_room_members[current_room]
+                    self.bus.send(self.ring.shard_for(current_room), {"type": "unsubscribe", "room": current_room, "shard": self.shard_index})
+
+        return removed
+
+    def _enter_state(self, client_info: ClientInfo, state: ConnectionStates) -> None:
+        if state != ConnectionStates.CHATTING or self.is_owner(client_info.current_room):
+            super()._enter_state(client_info, state)
+            return
+
+        # The join notice comes back from the owner over the bus. The owner answers the sync after it, on the same
+        # ordered connection, so the ack is queued once the client has its join notice
+        token = next(self._sync_tokens)
+        with self._subscriptions_lock:
+            self._pending_acks[token] = client_info
+        self.bus.send(self.ring.shard_for(client_info.current_room), {"type": "sync", "room": client_info.current_room, "shard": self.shard_index, "token": token})
+
+    def _publish_to_room(self, *, msg: MessageInfo, current_room: str, trace: typing.Optional[MessageTrace] = None) -> None:
+        if self.is_owner(current_room):
+            super()._publish_to_room(msg=msg, current_room=current_room, trace=trace)
+            return
+        # Traces don't cross the shard bus, the owner stores the message untraced
+
+        self.bus.send(
+            self.ring.shard_for(current_room),
+            {"type": "post", "room": current_room, "message_type": msg.type.value, "sender_name": msg.sender_name, "msg_timestamp": msg.msg_timestamp},
+            msg.text_message
+        )
+
+    def _broadcast_to_all_active_clients_in_room(self, *, msg: MessageInfo, current_room: str) -> bytes:
+        final_msg = super()._broadcast_to_all_active_clients_in_room(msg=msg, current_room=current_room)
+
+        for shard_index in self._room_subscribers.get(current_room, ()):
+            self.bus.send(shard_index, {"type": "deliver", "room": current_room}, msg.formatted_msg())
+        return final_msg
+
+    def _send_latest_history_messages(self, *, client_info: ClientInfo, group_name: str) -> None:
+        if self.is_owner(group_name):
+            super()._send_latest_history_messages(client_info=client_info, group_name=group_name)
+            return
+
+        # Only the owner caches the room, read from the db (messages the owner hasn't flushed yet are missing)
+        with self.chat_db.session() as db_conn:
+            self._fetch_history_messages(client_info=client_info, db_conn=db_conn, group_name=group_name)
+
+    def _on_bus_event(self, event: typing.Dict[str, typing.Any], text: typing.Optional[str]) -> None:
+        room_name = event["room"]
+
+        if event["type"] == "post":
+            msg_obj = MessageInfo(
+                type=MessageTypes(event["message_type"]),
+                text_message=text,
+                sender_name=event["sender_name"],
+                msg_timestamp=event["msg_timestamp"]
+            )
+            self._publish_to_room(msg=msg_obj, current_room=room_name)
+
+        elif event["type"] == "deliver":
+            final_msg = encode_text_frame(text)
+            for client in self.room_registry.members(room_name):
+                client.outbox.put(final_msg)
+
+        elif event["type"] == "sync":
+            self.bus.send(event["shard"], {"type": "synced", "room": room_name, "token": event["token"]})
+
+        elif event["type"] == "synced":
+            with self._subscriptions_lock:
+                client_info = self._pending_acks.pop(event["token"], None)
+            # Skipped when the client left or switched again meanwhile
+            if client_info and client_info.current_room == room_name and client_info.state != ConnectionStates.CHATTING:
+                super()._enter_state(client_info, ConnectionStates.CHATTING)
+
+        elif event["type"] == "subscribe":
+            with self._subscriptions_lock:
+                # Replaced rather than mutated, broadcasts iterate the set without the lock
+                self._room_subscribers[room_name] = self._room_subscribers.get(room_name, frozenset()) | {event["shard"]}
+
+        elif event["type"] == "unsubscribe":
+            with self._subscriptions_lock:
+                if subscribers := self._room_subscribers.get(room_name, frozenset()) - {event["shard"]}:
+                    self._room_subscribers[room_name] = subscribers
+                else:
+                    self._room_subscribers.pop(room_name, None)
+
+    def start(self):
+        self.bus.start()
+        handoff_conn, _ = self.chat_server.accept()
+        try:
+            while True:
+                prelude, fds, _, _ = socket.recv_fds(handoff_conn, MAX_PRELUDE_SIZE, 1)
+                if not fds:  # The acceptor is gone
+                    break
+                self.client_handler(socket.socket(fileno=fds[0]), prelude=prelude)
+        finally:
+            self.message_writer.close()
+
+
+class ShardedChatServer:
+    """
+    Front of the SHARDED mode: accepts clients, reads their username and first room and hands the connection
+    (its file descriptor, over a Unix socket) to the worker process that owns the room, so chat fan out runs
+    on as many cores as there are shards. Linux only.
+    The username and room are read without blocking from a single selector loop, so clients still typing them
+    at the prompt don't hold anything up for the others.
+    """
+    def __init__(self, *, host: str, listen_port: int, shards: int = MessageServerConfig.shards, metrics_port: typing.Optional[int] = None):
+        self._chat_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self._chat_server.bind((host, listen_port))
+        except Exception as e:
+            logger.exception(f"Unable to bind to host and port : {repr(e)}")
+
+        self._chat_server.listen(MessageServerConfig.async_listener_limit_number)
+
+        self.ring = HashRing(shards)
+        self.run_dir = MessageServerConfig.shard_run_dir or tempfile.mkdtemp(prefix='chat-shards-')
+        self.metrics_port = metrics_port  # The acceptor's, shard i serves its own metrics on metrics_port + 1 + i
+        self._handoffs = [METRICS.counter("chat_shard_handoffs", "Clients handed off to a shard", shard=str(shard_index)) for shard_index in range(shards)]
+        self._shard_processes: typing.List[multiprocessing.Process] = []
+        self._handoff_sockets: typing.List[socket.socket] = []
+        self._selector = selectors.DefaultSelector()
+
+    @property
+    def chat_server(self) -> socket.socket:
+        return self._chat_server
+
+    @staticmethod
+    def handoff_socket_path(run_dir: str, shard_index: int) -> str:
+        return os.path.join(run_dir, f"handoff-{shard_index}.sock")
+
+    def _start_shards(self) -> None:
+        # Forked before any thread of this process is started
+        context = multiprocessing.get_context('fork')
+        for shard_index in range(self.ring.shards):
+            shard_process = context.Process(target=self._run_shard, args=(shard_index,), name=f"chat-shard-{shard_index}", daemon=True)
+            shard_process.start()
+            self._shard_processes.append(shard_process)
+
+        for shard_index in range(self.ring.shards):
+            self._handoff_sockets.append(connect_unix_socket(self.handoff_socket_path(self.run_dir, shard_index), sock_type=socket.SOCK_SEQPACKET))
+
+    def _run_shard(self, shard_index: int) -> None:
+        self._chat_server.close()  # Inherited from the acceptor, clients reach the shard only through it
+        logging.basicConfig(level=logging.INFO, format=f"%(asctime)s - shard {shard_index} - %(levelname)s - %(message)s")
+        if self.metrics_port:
+            METRICS.serve(port=self.metrics_port + 1 + shard_index)
+        ShardChatServer(shard_index=shard_index, ring=self.ring, run_dir=self.run_dir).start()
+
+    def _accept_client(self) -> None:
+        client_sock, addr = self.chat_server.accept()
+        logger.info(f"Successfully connected client {addr[0]} {addr[1]} to messages server\n")
+        client_sock.setblocking(False)
+        self._selector.register(client_sock, selectors.EVENT_READ, _PendingHandoff(client_sock))
+
+    def _read_handoff(self, pending: _PendingHandoff) -> None:
+        try:
+            received = pending.conn.recv_into(pending.decoder.writable_view())
+            if not received:
+                raise ConnectionResetError("Connection closed by peer")
+            pending.decoder.commit(received)
+            pending.last_active = time.monotonic()
+
+            if pending.sender_name is None:
+                if (frame := pending.decoder.next_frame()) is None:
+                    return
+                pending.sender_name = frame.text()
+
+            if (frame := pending.decoder.next_frame()) is None:
+                return
+            setup_room_json = frame.json()
+            room_name = ChatServer.setup_room_name(SetupRoomData.from_json(setup_room_json))
+
+            prelude = encode_text_frame(pending.sender_name) + encode_json_frame(setup_room_json) + pending.decoder.take_buffered()
+            if len(prelude) > MAX_PRELUDE_SIZE:
+                raise ProtocolError(f"{len(prelude)} bytes were sent before the room setup completed")
+
+            # The shard shares the file description, it reads the connection blocking
+            self._selector.unregister(pending.conn)
+            pending.conn.setblocking(True)
+            shard_index = self.ring.shard_for(room_name)
+            socket.send_fds(self._handoff_sockets[shard_index], [prelude], [pending.conn.fileno()])
+            self._handoffs[shard_index].inc()
+            pending.conn.close()  # The shard holds its own descriptor of the connection
+
+        except BlockingIOError:
+            pass
+
+        except (ConnectionError, ProtocolError, KeyError, ValueError) as e:
+            logger.info(f"Dropped a client before its room setup: {repr(e)}")
+            self._drop_pending(pending)
+
+    def _drop_pending(self, pending: _PendingHandoff) -> None:
+        if self._selector.get_map().get(pending.conn.fileno()) is not None:
+            self._selector.unregister(pending.conn)
+        pending.conn.close()
+
+    def _drop_idle_handoffs(self) -> None:
+        idle_since = time.monotonic() - MessageServerConfig.shard_handoff_timeout_seconds
+        for key in list(self._selector.get_map().values()):
+            pending = key.data
+            if pending is not None and pending.last_active < idle_since:
+                logger.info("Dropped a client idle before its room setup")
+                self._drop_pending(pending)
+
+    def start(self):
+        self._start_shards()
+        if self.metrics_port:
+            METRICS.serve(port=self.metrics_port)
+        print(f"Chat Server started ({self.ring.shards} shards)...")
+        self._selector.register(self.chat_server, selectors.EVENT_READ)
+        next_sweep = time.monotonic() + MessageServerConfig.shard_handoff_sweep_seconds
+        try:
+            while True:
+                for key, _ in self._selector.select(timeout=MessageServerConfig.shard_handoff_sweep_seconds):
+                    if key.data is None:
+                        self._accept_client()
+                    else:
+                        self._read_handoff(key.data)
+
+                if time.monotonic() >= next_sweep:
+                    self._drop_idle_handoffs()
+                    next_sweep = time.monotonic() + MessageServerConfig.shard_handoff_sweep_seconds
+        finally:
+            self._selector.close()
+            for handoff_socket in self._handoff_sockets:
+                handoff_socket.close()
+            for shard_process in self._shard_processes:
+                shard_process.join(timeout=5)
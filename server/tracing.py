@@ -0,0 +1,56 @@
+import itertools
+import os
+import time
+import typing
+from logging import getLogger
+
+from config import DiagnosticsConfig
+from server.metrics import METRICS
+
+logger = getLogger(__name__)
+
+MESSAGE_PERSIST_SECONDS = METRICS.histogram("chat_message_persist_seconds", "Time from receiving a traced chat message to its stored batch being handled")
+
+class MessageTrace:
+    """
+    Spans of one chat message, from the frame being read off the client socket to its batch being committed and
+    handed to on_stored. Every span is the time since the previous one, so they add up to the total.
+    """
+    __slots__ = ('trace_id', 'room_name', 'received_ns', 'spans', '_last_ns')
+
+    def __init__(self, *, trace_id: str, room_name: str):
+        self.trace_id = trace_id
+        self.room_name = room_name
+        self.received_ns = self._last_ns = time.perf_counter_ns()
+        self.spans: typing.List[typing.Tuple[str, int]] = []
+
+    def span(self, name: str) -> None:
+        now = time.perf_counter_ns()
+        self.spans.append((name, now - self._last_ns))
+        self._last_ns = now
+
+    def finish(self, *, slow_ms: float) -> None:
+        total_ns = self._last_ns - self.received_ns
+        MESSAGE_PERSIST_SECONDS.observe(total_ns / 1e9)
+        if total_ns >= slow_ms * 1e6:
+            spans = ", ".join(f"{name} {duration_ns / 1e6:.2f}ms" for name, duration_ns in self.spans)
+            logger.warning(f"Slow message trace {self.trace_id} in '{self.room_name}': {total_ns / 1e6:.2f}ms ({spans})")
+
+
+class Tracer:
+    """ Hands out MessageTrace objects while tracing is enabled, None otherwise so untraced messages cost a flag check """
+    def __init__(self):
+        self.enabled = DiagnosticsConfig.trace_messages
+        self.slow_ms = DiagnosticsConfig.slow_trace_ms
+        self._ids = itertools.count()  # next() is atomic, the pid keeps the ids of sharded workers apart
+
+    def start(self, room_name: str) -> typing.Optional[MessageTrace]:
+        if not self.enabled:
+            return None
+        return MessageTrace(trace_id=f"{os.getpid():x}-{next(self._ids):x}", room_name=room_name)
+
+    def finish(self, trace: MessageTrace) -> None:
+        trace.finish(slow_ms=self.slow_ms)
+
+
+TRACER = Tracer()
@@ -1 +1,2 @@
-from .utils import chunkify
\ No newline at end of file
+from .utils import chunkify, epoch_ms_now, new_file_hash, hash_file_prefix, file_checksum
+from .protocol import Frame, FrameDecoder, FrameReader, AsyncFrameReader, encode_frame, encode_text_frame, encode_json_frame, send_frames, send_chunk
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import socket
+import struct
+import typing
+import zlib
+
+from config import ProtocolConfig
+from definitions import FrameTypes, ProtocolError
+from definitions.frames import FRAME_HEADER, encode_frame, encode_text_frame, encode_json_frame  # Encoders live with the structs that cache frames
+
+# Resumable upload body: every chunk is prefixed with its length and CRC32 (4 bytes each, big endian)
+CHUNK_HEADER = struct.Struct('!II')
+
+# Max buffers per sendmsg call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+class Frame(typing.NamedTuple):
+    type: FrameTypes
+    payload: memoryview  # Points into the decoder buffer, valid only until the next read
+
+    def text(self) -> str:
+        return str(self.payload, 'utf-8')
+
+    def json(self) -> typing.Any:
+        return json.loads(self.text())
+
+
+def send_chunk(sock: socket.socket, chunk: memoryview) -> None:
+    # Header and chunk leave in one gathered write
+    send_frames(sock, [CHUNK_HEADER.pack(len(chunk), zlib.crc32(chunk)), chunk])
+
+
+def send_frames(sock: socket.socket, frames: typing.Sequence[bytes]) -> None:
+    """
+    Writes many encoded frames with as few syscalls as possible, sendmsg gathers up to IOV_MAX frames per call
+    without joining them into one buffer first. Partial writes resume from the first unsent byte.
+    """
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(b''.join(frames))
+        return
+
+    pending: typing.List[typing.Union[bytes, memoryview]] = list(frames)
+    index = 0
+    while index < len(pending):
+        sent = sock.sendmsg(pending[index:index + IOV_MAX])
+
+        while sent:
+            frame_size = len(pending[index])
+            if sent < frame_size:
+                pending[index] = memoryview(pending[index])[sent:]
+                break
+            sent -= frame_size
+            index += 1
+
+
+class FrameDecoder:
+    """
+    Incremental frame decoder over a single reusable bytearray.
+    Bytes are received straight into the free tail of the buffer, complete frames are handed out as memoryview
+    slices of it, and only the trailing partial frame is moved back to the start when the tail runs out.
+    """
+    def __init__(self, *, buffer_size: int = ProtocolConfig.frame_buffer_size, max_payload_size: int = ProtocolConfig.max_frame_payload_size):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # First byte not consumed yet
+        self._end = 0  # First free byte
+        self.max_payload_size = max_payload_size
+
+    @property
+    def buffered(self) -> int:
+        return self._end - self._start
+
+    def writable_view(self, min_size: int = 1) -> memoryview:
+        if len(self._buffer) - self._end < min_size:
+            self._compact(min_size)
+        return self._view[self._end:]
+
+    def commit(self, nbytes: int) -> None:
+        self._end += nbytes
+
+    def feed(self, data: bytes) -> None:
+        self.writable_view(len(data))[:len(data)] = data
+        self.commit(len(data))
+
+    def next_frame(self) -> typing.Optional[Frame]:
+        if self.buffered < FRAME_HEADER.size:
+            return None
+
+        version, frame_type, payload_size = FRAME_HEADER.unpack_from(self._buffer, self._start)
+
+        if version != ProtocolConfig.version:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+
+        if payload_size > self.max_payload_size:
+            raise ProtocolError(f"Frame payload of {payload_size} bytes exceeds {self.max_payload_size} bytes")
+
+        frame_end = self._start + FRAME_HEADER.size + payload_size
+        if frame_end > self._end:
+            # Make sure the whole frame will fit, so the next reads complete it
+            self.writable_view(frame_end - self._end)
+            return None
+
+        try:
+            frame = Frame(type=FrameTypes(frame_type), payload=self._view[self._start + FRAME_HEADER.size:frame_end])
+        except ValueError as e:
+            raise ProtocolError(f"Unknown frame type {frame_type}") from e
+
+        self._start = frame_end
+        return frame
+
+    def read_buffered_into(self, view: memoryview) -> int:
+        # Raw (unframed) bytes that were already received after the last frame, e.g. the beginning of a file body
+        nbytes = min(len(view), self.buffered)
+        view[:nbytes] = self._view[self._start:self._start + nbytes]
+        self._start += nbytes
+        return nbytes
+
+    def take_buffered(self) -> bytes:
+        # Everything received but not consumed yet, e.g. to hand a connection over to another reader
+        buffered = bytes(self._view[self._start:self._end])
+        self._start = self._end
+        return buffered
+
+    def _compact(self, min_size: int) -> None:
+        buffered = self.buffered
+        required_size = buffered + min_size
+
+        if required_size > len(self._buffer):
+            new_buffer = bytearray(max(required_size, len(self._buffer) * 2))
+            new_buffer[:buffered] = self._view[self._start:self._end]
+            self._buffer = new_buffer
+            self._view = memoryview(new_buffer)
+
+        elif buffered:
+            self._buffer[:buffered] = self._buffer[self._start:self._end]
+
+        self._start = 0
+        self._end = buffered
+
+
+class FrameReader:
+    """ Reads frames from a blocking socket """
+    def __init__(self, sock: socket.socket, *, decoder: typing.Optional[FrameDecoder] = None):
+        self.sock = sock
+        self.decoder = decoder or FrameDecoder()
+
+    def read_frame(self) -> Frame:
+        while (frame := self.decoder.next_frame()) is None:
+            received = self.sock.recv_into(self.decoder.writable_view())
+            if not received:
+                raise ConnectionResetError("Connection closed by peer")
+            self.decoder.commit(received)
+        return frame
+
+    def recv_into(self, view: memoryview) -> int:
+        if self.decoder.buffered:
+            return self.decoder.read_buffered_into(view)
+        return self.sock.recv_into(view)
+
+    def recv_exactly_into(self, view: memoryview) -> None:
+        received = 0
+        while received < len(view):
+            nbytes = self.recv_into(view[received:])
+            if not nbytes:
+                raise ConnectionResetError("Connection closed by peer")
+            received += nbytes
+
+    def read_chunk_into(self, buffer: memoryview) -> memoryview:
+        """ Receives one checksummed upload chunk into buffer, returns the verified chunk view """
+        header = bytearray(CHUNK_HEADER.size)
+        self.recv_exactly_into(memoryview(header))
+        chunk_size, crc = CHUNK_HEADER.unpack(header)
+
+        if chunk_size > len(buffer):
+            raise ProtocolError(f"Chunk of {chunk_size} bytes exceeds the {len(buffer)} bytes buffer")
+
+        chunk = buffer[:chunk_size]
+        self.recv_exactly_into(chunk)
+        if zlib.crc32(chunk) != crc:
+            raise ProtocolError(f"Chunk of {chunk_size} bytes failed CRC32 check")
+        return chunk
+
+    def recv(self, bufsize: int) -> bytes:
+        chunk = bytearray(bufsize)
+        received = self.recv_into(memoryview(chunk))
+        return bytes(chunk[:received])
+
+
+class AsyncFrameReader:
+    """ Reads frames from an asyncio StreamReader """
+    def __init__(self, reader: asyncio.StreamReader, *, decoder: typing.Optional[FrameDecoder] = None):
+        self.reader = reader
+        self.decoder = decoder or FrameDecoder()
+
+    async def read_frame(self) -> Frame:
+        while (frame := self.decoder.next_frame()) is None:
+            data = await self.reader.read(len(self.decoder.writable_view()))
+            if not data:
+                raise ConnectionResetError("Connection closed by peer")
+            self.decoder.feed(data)
+        return frame
@@ -1,3 +1,6 @@
+import hashlib
+import os
+import time
 import typing
 from typing import IO
 
@@ -11,3 +14,29 @@ def chunkify(*, reader_file: IO[bytes], chunk_size: typing.Optional[int] = 65_53
 
         yield chunk
 
+
+def epoch_ms_now() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def new_file_hash() -> hashlib.blake2b:
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file_prefix(*, reader_file: IO[bytes], size: int, chunk_size: int = 1_048_576) -> hashlib.blake2b:
+    """ Hashes the first size bytes of reader_file, used to continue a checksum when a transfer is resumed """
+    file_hash = new_file_hash()
+    reader_file.seek(0)
+    remaining = size
+    while remaining:
+        chunk = reader_file.read(min(chunk_size, remaining))
+        if not chunk:
+            raise EOFError(f"File is shorter than {size} bytes")
+        file_hash.update(chunk)
+        remaining -= len(chunk)
+    return file_hash
+
+
+def file_checksum(file_path: str) -> str:
+    with open(file_path, 'rb') as file:
+        return hash_file_prefix(reader_file=file, size=os.fstat(file.fileno()).st_size).hexdigest()